@@ -1,25 +1,51 @@
 from flask import Flask, render_template, request, jsonify, Response
-import requests
 import json
-from datetime import datetime
-import subprocess
-import psutil
-import platform
-import boto3
-from botocore.exceptions import ClientError, NoCredentialsError
-import time
 import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ollama_client import OllamaClient, AsyncOllamaClient
+from ollama_pool import ollama_pool
+from model_manager import ModelManager, MODEL_KEEP_ALIVE
+from ollama_options import options_planner
+from context_assembler import ContextAssembler, context_budget, context_stats, CONTEXT_MAX_ROWS
+from asgi_server import create_asgi_app, HttpError
+from imds import imds
+from system_metrics import system_sampler
+from ttl_cache import TTLCache, all_stats, is_cacheable
+from ec2_inventory import Ec2Inventory, DEFAULT_QUERY_LIMIT
+from aws_clients import aws_clients
+from security_groups import SecurityGroupService
+from intent_matcher import intent_matcher
+from response_cache import ResponseCache, prompt_is_cacheable
+from stream_coalescer import StreamCoalescer, AsyncStreamCoalescer
+from session_store import SessionStore
+from scheduler import Scheduler, QueueFull, SCHEDULER_MAX_CONCURRENCY
+from metrics import registry, ChatTimer, blocked_prompts, guardtrail_latency, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from guard_cache import VerdictCache
+from guardtrail_client import GuardTrailClient
+from output_guard import StreamingOutputGuard, AsyncStreamingOutputGuard
+from speculative import SpeculativeStream, AsyncSpeculativeStream
+from app_log import get_logger, log_pipeline
+from sse_writer import SseWriter, sse_event, start_stream
 
 app = Flask(__name__)
 
+# Logging en segundo plano (ver app_log.py): LOG_LEVEL, LOG_FILE, LOG_SAMPLING
+log = get_logger("chat")
+guard_log = get_logger("guardtrail")
+context_log = get_logger("context")
+
 # Configuración de Ollama (modelo local libre)
-OLLAMA_API = "http://localhost:11434/api/generate"
 MODEL = "dolphin-llama3"  # Dolphin Llama 3: sin filtros, ideal para datos técnicos
 
 # Configuración de Trend Micro AI Guard (GuardTrail)
 # ALWAYS ENABLED
 GUARDTRAIL_APP_NAME = os.environ.get("GUARDTRAIL_APP_NAME", "trend-ai-llm-app")
-GUARDTRAIL_API_URL = "https://api.xdr.trendmicro.com/beta/aiSecurity/guard?detailedResponse=false"
+GUARDTRAIL_API_URL = os.environ.get(
+    "GUARDTRAIL_API_URL",
+    "https://api.xdr.trendmicro.com/beta/aiSecurity/guard?detailedResponse=false"
+)
 
 # Function to get API key (reads fresh from environment each time)
 def get_guardtrail_api_key():
@@ -30,15 +56,75 @@ def get_guardtrail_api_key():
 os.environ['OLLAMA_NUM_PARALLEL'] = '4'
 os.environ['OLLAMA_MAX_LOADED_MODELS'] = '1'
 
-# Cache simple (se actualiza cada 20 segundos)
-_cache = {"timestamp": 0, "data": {}}
-CACHE_TTL = 20
+# Servidores Ollama (OLLAMA_HOSTS) con health checks en segundo plano
+ollama_pool.start()
+# Precarga y keep_alive del modelo; mide los cold starts de cada generación
+model_manager = ModelManager(MODEL)
+# Cliente compartido: pool keep-alive del tamaño de OLLAMA_NUM_PARALLEL
+ollama = OllamaClient(on_done=model_manager.observe)
+async_ollama = AsyncOllamaClient(on_done=model_manager.observe)
+# Peticiones idénticas en curso comparten una sola generación de Ollama
+ollama_streams = StreamCoalescer(ollama.generate_stream)
+async_ollama_streams = AsyncStreamCoalescer(async_ollama.generate_stream)
+
+# Modo de servicio: ASYNC_MODE=1 sirve la app vía ASGI (uvicorn)
+ASYNC_MODE = os.environ.get("ASYNC_MODE", "0") == "1"
+
+# Muestreo de CPU/RAM/disco/red en segundo plano
+system_sampler.start()
+SYSTEM_SAMPLE_FIELDS = [
+    "cpu_uso_porcentaje", "ram_total_gb", "ram_disponible_gb", "ram_uso_porcentaje",
+    "disco_total_gb", "disco_usado_gb", "disco_libre_gb", "disco_uso_porcentaje"
+]
+
+# Caches con TTL por clave, límite LRU y carga single-flight
+CACHE_TTL = 20  # segundos
+aws_cache = TTLCache("aws", ttl=CACHE_TTL, max_entries=64, stale_ttl=CACHE_TTL)
+models_cache = TTLCache("ollama_models", ttl=60, max_entries=4)
+# Respuestas completas del LLM por prompt exacto (ver RESPONSE_CACHE_* en response_cache.py)
+response_cache = ResponseCache()
+# Conversaciones: context de Ollama por sesión (ver SESSION_* en session_store.py)
+sessions = SessionStore()
+# Admisión delante de Ollama: slots = OLLAMA_NUM_PARALLEL, resto en cola (ver SCHEDULER_*)
+scheduler = Scheduler()
 
 # ==================================================================
 # FUNCIONES DE GUARDTRAIL (TREND MICRO AI GUARD)
 # ==================================================================
 
-def run_guardtrail(text):
+# Cliente con pool, presupuesto de latencia, hedging y circuit breaker
+guardtrail_client = GuardTrailClient(GUARDTRAIL_API_URL, get_guardtrail_api_key)
+
+# Veredictos cacheados por hash del texto normalizado + configuración
+verdict_cache = VerdictCache()
+
+def _guard_config():
+    """Configuración que forma parte de la clave de la cache de veredictos"""
+    return (GUARDTRAIL_API_URL, GUARDTRAIL_APP_NAME, get_guardtrail_api_key())
+
+# Hilos para el veredicto de entrada. Pools separados: las ventanas de
+# respuestas largas no retrasan el veredicto de las peticiones nuevas
+guard_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="guardtrail")
+# Ventanas de salida: unas pocas pendientes por cada generación en curso
+output_guard_executor = ThreadPoolExecutor(max_workers=2 * SCHEDULER_MAX_CONCURRENCY,
+                                           thread_name_prefix="guardtrail-output")
+# Hilos para el contexto, en paralelo con el guard (la generación
+# especulativa usa su propio hilo, ver speculative.py)
+pipeline_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="pipeline")
+
+# GUARDTRAIL_SPECULATIVE=1 arranca Ollama antes del veredicto de entrada;
+# ningún token llega al cliente hasta que el veredicto es Allow
+SPECULATIVE_GENERATION = os.environ.get("GUARDTRAIL_SPECULATIVE", "0") == "1"
+
+def run_guardtrail(text, direction="input"):
+    """Validates text with GuardTrail, reusing cached verdicts for repeated text"""
+    return verdict_cache.check(text, _guard_config(), lambda t: _call_guardtrail(t, direction))
+
+def run_guardtrail_output(text):
+    """Ventanas de la respuesta del LLM (separadas en las métricas de latencia)"""
+    return run_guardtrail(text, "output")
+
+def _call_guardtrail(text, direction="input"):
     """
     Validates text with Trend Micro AI Guard (GuardTrail)
     Based on official Trend Micro example
@@ -46,56 +132,41 @@ def run_guardtrail(text):
     Returns:
         dict: API response with 'action', 'id', 'reasons', etc.
     """
-    api_key = get_guardtrail_api_key()
-    
-    if not api_key:
-        print("[GuardTrail] ERROR: V1_API_KEY not configured!")
-        return {"action": "Block", "error": "API key not configured"}
+    if guard_log.isEnabledFor(logging.DEBUG):
+        guard_log.debug("Validating %s: %s...", direction, text[:100])
     
-    # Correct payload according to Trend Micro documentation
-    payload = {"guard": text}
+    # Pool keep-alive, presupuesto de latencia, hedge y circuit breaker
+    with guardtrail_latency.time(direction=direction):
+        result = guardtrail_client.check(text)
     
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    
-    print(f"\n{'='*80}")
-    print("[GuardTrail] CALLING TREND MICRO AI GUARD API")
-    print(f"{'='*80}")
-    print(f"Text to validate: {text[:100]}...")
-    print(f"URL: {GUARDTRAIL_API_URL}")
-    print(f"Payload: {payload}")
-    
-    try:
-        response = requests.post(
-            GUARDTRAIL_API_URL,
-            headers=headers,
-            json=payload,
-            timeout=10
-        )
-        
-        print(f"{'='*80}")
-        print("TREND MICRO API RESPONSE:")
-        print(f"{'='*80}")
-        print(f"Status Code: {response.status_code}")
-        print(f"Response Body: {response.text}")
-        print(f"{'='*80}\n")
-        
-        if response.status_code != 200:
-            print(f"[GuardTrail] API Error: {response.status_code}")
-            return {"action": "Block", "error": f"API error {response.status_code}"}
-        
-        return response.json()
-        
-    except requests.exceptions.Timeout:
-        print("[GuardTrail] TIMEOUT")
-        print(f"{'='*80}\n")
-        return {"action": "Block", "error": "Timeout"}
-    except Exception as e:
-        print(f"[GuardTrail] EXCEPTION: {str(e)}")
-        print(f"{'='*80}\n")
-        return {"action": "Block", "error": str(e)}
+    _log_verdict(direction, result)
+    return result
+
+def _log_verdict(direction, result):
+    guard_log.info("Verdict %s", result.get("action"), extra={"fields": {
+        "direction": direction, "id": result.get("id"), "reasons": result.get("reasons"),
+        "error": result.get("error")}})
+
+async def run_guardtrail_async(text, direction="input"):
+    """Versión asyncio de run_guardtrail para el modo ASGI"""
+    config = _guard_config()
+    cached = verdict_cache.get(text, config)
+    if cached is not None:
+        return cached
+    result = await _call_guardtrail_async(text, direction)
+    verdict_cache.put(text, config, result)
+    return result
+
+async def run_guardtrail_output_async(text):
+    return await run_guardtrail_async(text, "output")
+
+async def _call_guardtrail_async(text, direction="input"):
+    if guard_log.isEnabledFor(logging.DEBUG):
+        guard_log.debug("Validating %s (async): %s...", direction, text[:100])
+    with guardtrail_latency.time(direction=direction):
+        result = await guardtrail_client.check_async(text)
+    _log_verdict(direction, result)
+    return result
 
 # ==================================================================
 # FUNCIONES PARA OBTENER INFORMACIÓN DEL SISTEMA Y AWS
@@ -104,19 +175,11 @@ def run_guardtrail(text):
 def get_system_info():
     """Obtiene información del sistema operativo y hardware"""
     try:
-        info = {
-            "cpu_nucleos": psutil.cpu_count(logical=False),
-            "cpu_threads": psutil.cpu_count(logical=True),
-            "cpu_uso_porcentaje": psutil.cpu_percent(interval=0.5),
-            "ram_total_gb": round(psutil.virtual_memory().total / (1024**3), 2),
-            "ram_disponible_gb": round(psutil.virtual_memory().available / (1024**3), 2),
-            "ram_uso_porcentaje": psutil.virtual_memory().percent,
-            "disco_total_gb": round(psutil.disk_usage('/').total / (1024**3), 2),
-            "disco_usado_gb": round(psutil.disk_usage('/').used / (1024**3), 2),
-            "disco_libre_gb": round(psutil.disk_usage('/').free / (1024**3), 2),
-            "disco_uso_porcentaje": psutil.disk_usage('/').percent,
-            "distribucion": platform.platform()
-        }
+        # Última muestra del hilo de muestreo: no bloquea
+        sample = system_sampler.latest()
+        info = dict(system_sampler.static)
+        for key in SYSTEM_SAMPLE_FIELDS:
+            info[key] = sample[key]
         return info
     except Exception as e:
         return {"error": str(e)}
@@ -124,60 +187,24 @@ def get_system_info():
 def get_aws_metadata():
     """Obtiene metadatos de AWS EC2"""
     try:
-        metadata = {}
-        base_url = "http://169.254.169.254/latest/meta-data/"
-        
-        fields = {
-            "instance_id": "instance-id",
-            "instance_type": "instance-type",
-            "availability_zone": "placement/availability-zone",
-            "region": "placement/region",
-            "public_ipv4": "public-ipv4",
-            "local_ipv4": "local-ipv4",
-            "ami_id": "ami-id"
-        }
-        
-        mac = None
-        try:
-            mac_response = requests.get(f"{base_url}network/interfaces/macs/", timeout=0.8)
-            if mac_response.status_code == 200:
-                mac = mac_response.text.strip().split('\n')[0].strip('/')
-                if mac:
-                    vpc_response = requests.get(f"{base_url}network/interfaces/macs/{mac}/vpc-id", timeout=0.8)
-                    if vpc_response.status_code == 200:
-                        metadata["vpc_id"] = vpc_response.text
-                    subnet_response = requests.get(f"{base_url}network/interfaces/macs/{mac}/subnet-id", timeout=0.8)
-                    if subnet_response.status_code == 200:
-                        metadata["subnet_id"] = subnet_response.text
-        except:
-            pass
-        
-        for key, path in fields.items():
-            try:
-                response = requests.get(f"{base_url}{path}", timeout=0.8)
-                if response.status_code == 200:
-                    metadata[key] = response.text
-            except:
-                pass
-        
-        return metadata if metadata else {"error": "No está en AWS"}
+        # Snapshot compartido: token IMDSv2 reutilizado, campos en paralelo
+        # y cache (también del resultado "fuera de AWS")
+        return aws_cache.get_or_load("aws_metadata", imds.snapshot, cache_if=is_cacheable)
     except Exception as e:
         return {"error": str(e)}
 
 def get_iam_role_info():
     """Obtiene credenciales IAM completas"""
     try:
-        base_url = "http://169.254.169.254/latest/meta-data/iam/"
-        
-        role_response = requests.get(f"{base_url}security-credentials/", timeout=1.5)
-        if role_response.status_code != 200:
+        role_text = imds.get("iam/security-credentials/", timeout=1.5)
+        if role_text is None:
             return {"error": "No hay rol IAM"}
         
-        role_name = role_response.text.strip()
-        creds_response = requests.get(f"{base_url}security-credentials/{role_name}", timeout=1.5)
+        role_name = role_text.strip()
+        creds_text = imds.get(f"iam/security-credentials/{role_name}", timeout=1.5)
         
-        if creds_response.status_code == 200:
-            credentials = json.loads(creds_response.text)
+        if creds_text is not None:
+            credentials = json.loads(creds_text)
             return {
                 "rol_nombre": role_name,
                 "access_key_id": credentials.get("AccessKeyId", "N/A"),
@@ -189,131 +216,98 @@ def get_iam_role_info():
     except Exception as e:
         return {"error": str(e)}
 
+def _ec2_client():
+    """Cliente EC2 de la región actual (del registro compartido)"""
+    region = get_aws_metadata().get('region', 'us-east-1')
+    return aws_clients.client('ec2', region)
+
+# Inventario paginado e indexado, refrescado en segundo plano
+ec2_inventory = Ec2Inventory(_ec2_client)
+
 def get_ec2_instances():
     """Lista instancias EC2 (con cache)"""
-    global _cache
-    if time.time() - _cache["timestamp"] < CACHE_TTL and "ec2_instances" in _cache["data"]:
-        return _cache["data"]["ec2_instances"]
-    
-    try:
-        metadata = get_aws_metadata()
-        region = metadata.get('region', 'us-east-1')
-        ec2 = boto3.client('ec2', region_name=region)
-        response = ec2.describe_instances()
-        
-        instances = []
-        for reservation in response['Reservations']:
-            for instance in reservation['Instances']:
-                name = 'Sin nombre'
-                if 'Tags' in instance:
-                    for tag in instance['Tags']:
-                        if tag['Key'] == 'Name':
-                            name = tag['Value']
-                            break
-                
-                instances.append({
-                    "instance_id": instance['InstanceId'],
-                    "nombre": name,
-                    "tipo": instance['InstanceType'],
-                    "estado": instance['State']['Name'],
-                    "ip_publica": instance.get('PublicIpAddress', 'N/A'),
-                    "ip_privada": instance.get('PrivateIpAddress', 'N/A'),
-                    "zona": instance['Placement']['AvailabilityZone'],
-                    "fecha_lanzamiento": str(instance['LaunchTime'])
-                })
-        
-        _cache["data"]["ec2_instances"] = instances
-        _cache["timestamp"] = time.time()
-        return instances
-    except Exception as e:
-        return {"error": str(e)}
+    return ec2_inventory.all()
+
+# Security groups: una consulta por VPC, cacheada, compartida por ambas apps
+sg_service = SecurityGroupService(lambda region: aws_clients.client('ec2', region), get_aws_metadata)
 
 def get_security_groups():
     """Obtiene security groups de la instancia actual"""
-    try:
-        metadata = get_aws_metadata()
-        region = metadata.get('region', 'us-east-1')
-        instance_id = metadata.get('instance_id')
-        
-        if not instance_id:
-            return {"error": "No instance ID"}
-        
-        ec2 = boto3.client('ec2', region_name=region)
-        response = ec2.describe_instances(InstanceIds=[instance_id])
-        
-        security_groups = []
-        if response['Reservations']:
-            instance = response['Reservations'][0]['Instances'][0]
-            for sg in instance.get('SecurityGroups', []):
-                security_groups.append({
-                    "id": sg['GroupId'],
-                    "nombre": sg['GroupName']
-                })
-        return security_groups
-    except Exception as e:
-        return {"error": str(e)}
+    return sg_service.for_instance()
 
-def build_system_context_optimized(user_message):
+def build_system_context_optimized(user_message, intents=None):
     """Construye contexto SOLO con lo necesario según la pregunta"""
-    context = ""
-    msg_lower = user_message.lower()
+    if intents is None:
+        intents = intent_matcher.match(user_message)
     
-    needs_system = any(k in msg_lower for k in ['cpu', 'ram', 'memoria', 'disco', 'sistema', 'especificaciones', 'servidor', 'recursos'])
-    needs_aws = any(k in msg_lower for k in ['aws', 'región', 'ip', 'instancia', 'ec2', 'vpc', 'subnet', 'ami'])
-    needs_iam = any(k in msg_lower for k in ['iam', 'rol', 'credencial', 'access', 'token', 'secret', 'key'])
-    needs_instances = any(k in msg_lower for k in ['instancias', 'servidores', 'otras', 'cuenta', 'lista'])
-    needs_sg = any(k in msg_lower for k in ['security', 'grupo', 'firewall', 'reglas'])
+    needs_system = "system" in intents
+    needs_aws = "aws" in intents
+    needs_iam = "iam" in intents
+    needs_instances = "instances" in intents
+    needs_sg = "sg" in intents
     
-    context = "Información disponible del sistema:\n\n"
+    # Secciones con prioridad, metidas en el presupuesto de tokens del num_ctx actual
+    assembler = ContextAssembler(context_budget(user_message), header="Información disponible del sistema:\n\n")
     
     if needs_system:
         sys_info = get_system_info()
         if "error" not in sys_info:
-            context += "=== SISTEMA ===\n"
-            context += f"CPU: {sys_info.get('cpu_nucleos')} núcleos, {sys_info.get('cpu_threads')} threads, Uso: {sys_info.get('cpu_uso_porcentaje')}%\n"
-            context += f"RAM: {sys_info.get('ram_disponible_gb')} GB disponible de {sys_info.get('ram_total_gb')} GB totales (Uso: {sys_info.get('ram_uso_porcentaje')}%)\n"
-            context += f"Disco: {sys_info.get('disco_libre_gb')} GB libres de {sys_info.get('disco_total_gb')} GB totales (Uso: {sys_info.get('disco_uso_porcentaje')}%)\n"
-            context += f"Sistema Operativo: {sys_info.get('distribucion', 'N/A')}\n\n"
+            assembler.add("system", "".join([
+                "=== SISTEMA ===\n",
+                f"CPU: {sys_info.get('cpu_nucleos')} núcleos, {sys_info.get('cpu_threads')} threads, Uso: {sys_info.get('cpu_uso_porcentaje')}%\n",
+                f"RAM: {sys_info.get('ram_disponible_gb')} GB disponible de {sys_info.get('ram_total_gb')} GB totales (Uso: {sys_info.get('ram_uso_porcentaje')}%)\n",
+                f"Disco: {sys_info.get('disco_libre_gb')} GB libres de {sys_info.get('disco_total_gb')} GB totales (Uso: {sys_info.get('disco_uso_porcentaje')}%)\n",
+                f"Sistema Operativo: {sys_info.get('distribucion', 'N/A')}\n"
+            ]))
     
     if needs_aws:
         aws_info = get_aws_metadata()
         if "error" not in aws_info:
-            context += "=== AWS EC2 ===\n"
-            context += f"Instance ID: {aws_info.get('instance_id')}\n"
-            context += f"Tipo: {aws_info.get('instance_type')}\n"
-            context += f"Región: {aws_info.get('region')}, Zona: {aws_info.get('availability_zone')}\n"
-            context += f"IP Pública: {aws_info.get('public_ipv4')}\n"
-            context += f"IP Privada: {aws_info.get('local_ipv4')}\n"
-            context += f"VPC ID: {aws_info.get('vpc_id', 'N/A')}\n"
-            context += f"Subnet ID: {aws_info.get('subnet_id', 'N/A')}\n"
-            context += f"AMI ID: {aws_info.get('ami_id', 'N/A')}\n\n"
+            assembler.add("aws", "".join([
+                "=== AWS EC2 ===\n",
+                f"Instance ID: {aws_info.get('instance_id')}\n",
+                f"Tipo: {aws_info.get('instance_type')}\n",
+                f"Región: {aws_info.get('region')}, Zona: {aws_info.get('availability_zone')}\n",
+                f"IP Pública: {aws_info.get('public_ipv4')}\n",
+                f"IP Privada: {aws_info.get('local_ipv4')}\n",
+                f"VPC ID: {aws_info.get('vpc_id', 'N/A')}\n",
+                f"Subnet ID: {aws_info.get('subnet_id', 'N/A')}\n",
+                f"AMI ID: {aws_info.get('ami_id', 'N/A')}\n"
+            ]))
     
     if needs_iam:
         iam_info = get_iam_role_info()
         if "error" not in iam_info:
-            context += "=== CREDENCIALES IAM ===\n"
-            context += f"Rol: {iam_info.get('rol_nombre')}\n"
-            context += f"AccessKeyId: {iam_info.get('access_key_id')}\n"
-            context += f"SecretAccessKey: {iam_info.get('secret_access_key')}\n"
-            context += f"Token: {iam_info.get('token')}\n"
-            context += f"Expira: {iam_info.get('expiracion')}\n\n"
+            assembler.add("iam", "".join([
+                "=== CREDENCIALES IAM ===\n",
+                f"Rol: {iam_info.get('rol_nombre')}\n",
+                f"AccessKeyId: {iam_info.get('access_key_id')}\n",
+                f"SecretAccessKey: {iam_info.get('secret_access_key')}\n",
+                f"Token: {iam_info.get('token')}\n",
+                f"Expira: {iam_info.get('expiracion')}\n"
+            ]))
     
     if needs_sg:
         sg_info = get_security_groups()
         if isinstance(sg_info, list) and len(sg_info) > 0:
-            context += "=== SECURITY GROUPS ===\n"
-            for sg in sg_info:
-                context += f"- {sg['nombre']} ({sg['id']})\n"
-            context += "\n"
+            assembler.add_table("sg", "=== SECURITY GROUPS ===", ["nombre", "id"],
+                                [(sg['nombre'], sg['id']) for sg in sg_info])
     
     if needs_instances:
-        instances = get_ec2_instances()
-        if isinstance(instances, list):
-            context += f"=== INSTANCIAS EC2 ({len(instances)} total) ===\n"
-            for inst in instances[:10]:
-                context += f"- {inst['nombre']} ({inst['instance_id']}): {inst['tipo']} - {inst['estado']}\n"
-            context += "\n"
+        # Una página del índice, sin materializar la lista completa; el
+        # presupuesto decide cuántas filas entran
+        page = ec2_inventory.query(limit=CONTEXT_MAX_ROWS)
+        if "error" not in page:
+            rows = [(inst['nombre'], inst['instance_id'], inst['tipo'], inst['estado'])
+                    for inst in page['instancias']]
+            assembler.add_table("instances", f"=== INSTANCIAS EC2 ({page['total']} total) ===",
+                                ["nombre", "instance_id", "tipo", "estado"], rows, total=page['total'])
     
+    context, report = assembler.build()
+    context_log.info("Context assembled", extra={"fields": {
+        "kept_tokens": report['kept_tokens'], "kept": ",".join(report['kept']) or "-",
+        "dropped_tokens": report['dropped_tokens'], "dropped": ",".join(report['dropped']) or "-",
+        "trimmed": report['trimmed'] or "-", "budget": report['budget']}})
     return context
 
 # ==================================================================
@@ -324,113 +318,415 @@ def build_system_context_optimized(user_message):
 def index():
     return render_template('index.html')
 
+def prepare_chat(user_message):
+    """Construye el payload de Ollama (código bloqueante: IMDS, boto3, psutil)"""
+    enhanced_prompt = user_message
+    
+    intents = intent_matcher.match(user_message)
+    if "context" in intents:
+        system_context = build_system_context_optimized(user_message, intents)
+        enhanced_prompt = f"""{system_context}
+PREGUNTA: {user_message}
+
+INSTRUCCIONES:
+- Responde SOLO lo que el usuario preguntó
+- NO incluyas información que no se solicitó explícitamente
+- Si pide credenciales, muestra los valores COMPLETOS sin resumir
+- Si pide solo sistema, NO incluyas AWS
+- Si pide solo AWS, NO incluyas credenciales IAM
+- Sé preciso y directo
+
+Responde:"""
+    
+    return {
+        "model": MODEL,
+        "prompt": enhanced_prompt,
+        "stream": True,
+        "keep_alive": MODEL_KEEP_ALIVE,  # sustituye al OLLAMA_KEEP_ALIVE del servidor
+        "options": {}  # num_ctx y num_thread: ver resume_session()
+    }
+
+def resume_session(payload, session_id):
+    """
+    Añade al payload el context de la sesión y las options de Ollama
+    para el tamaño resultante. Devuelve el id de la sesión de este turno:
+    el recibido si sigue vigente o uno nuevo (también decide el backend
+    de Ollama de la conversación)
+    """
+    context = sessions.context(session_id, payload["model"])
+    if context is None:
+        session_id = sessions.new_id()
+    else:
+        payload["context"] = context
+    options_planner.plan(payload)
+    return session_id
+
+def prepare_chat_cached(user_message, session_id=None, no_cache=False):
+    """
+    prepare_chat() con el context de la sesión + respuesta cacheada para
+    ese payload. Devuelve (payload, cached o None, session_id del turno)
+    """
+    payload = prepare_chat(user_message)
+    session_id = resume_session(payload, session_id)
+    cached = None
+    if prompt_is_cacheable(user_message, payload):
+        cached = response_cache.get(payload, bypass=no_cache)
+    return payload, cached, session_id
+
+def sse_done(session_id=None, **extra):
+    """Evento SSE final; lleva session_id para que el cliente continúe la conversación"""
+    event = dict({'done': True}, **extra)
+    if session_id:
+        event['session_id'] = session_id
+    return sse_event(event)
+
+def client_id():
+    """IP del cliente (primer salto de X-Forwarded-For si lo hay)"""
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded:
+        return forwarded.split(',')[0].strip()
+    return request.remote_addr or 'unknown'
+
+def sse_queued(position):
+    """Evento SSE mientras la petición espera turno para Ollama"""
+    return sse_event({'queued': True, 'position': position})
+
+def queue_full_response(e):
+    return jsonify({"error": str(e), "retry_after": e.retry_after}), 429, {"Retry-After": str(e.retry_after)}
+
+def input_blocked_message(guard_result):
+    """Mensaje SSE para un prompt de entrada bloqueado por GuardTrail"""
+    reasons = guard_result.get("reasons", [])
+    reason_text = ", ".join(reasons) if reasons else guard_result.get("error", "Security policy violation")
+    return {
+        "blocked": True,
+        "message": "⚠️ Sorry, your message violates internal security policies.\n\n"
+                   "🔒 This application is secured by Trend AI Guard.\n\n"
+                   f"Reason: {reason_text}",
+        "guardtrail": True
+    }
+
+def send_verified(writer, timer, tokens):
+    """Frames con los tokens que el guard de salida ya dejó pasar"""
+    if not tokens:
+        return ""
+    timer.token(len(tokens))
+    return "".join(writer.token(token) for token in tokens)
+
+# La respuesta del LLM fue bloqueada
+OUTPUT_BLOCKED_MESSAGE = {
+    "blocked": True,
+    "message": "\n\n⚠️ [Response was blocked by Trend AI Guard for violating security policies]",
+    "guardtrail": True
+}
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     data = request.json
     user_message = data.get('message', '')
+    no_cache = bool(data.get('no_cache'))  # forzar una generación nueva
+    client = client_id()
+    model_manager.touch()
+    timer = ChatTimer()
     
     def generate():
+        # Agrupa los tokens en frames y envía heartbeats (ver sse_writer.py)
+        writer = SseWriter()
+        ticket = None
+        speculative = None
         try:
             # ==============================================================
-            # 1️⃣ VALIDAR PROMPT DE ENTRADA CON GUARDTRAIL
+            # 1️⃣ VALIDAR PROMPT DE ENTRADA CON GUARDTRAIL, en paralelo con
+            #    la construcción del contexto (y opcionalmente el prefill)
             # ==============================================================
-            guard_result = run_guardtrail(user_message)
+            guard_future = guard_executor.submit(run_guardtrail, user_message)
+            payload_future = pipeline_executor.submit(prepare_chat_cached, user_message,
+                                                      data.get('session_id'), no_cache)
+            
+            if SPECULATIVE_GENERATION:
+                wait([guard_future, payload_future], return_when=FIRST_COMPLETED)
+                if not guard_future.done():
+                    payload, cached, session_id = payload_future.result()
+                    # Con la respuesta en cache no hace falta generar; sin
+                    # slot libre ahora mismo no se especula (ni se salta la
+                    # cola ni se espera en ella antes del veredicto). El
+                    # slot pasa a la generación: si el guard bloquea, se
+                    # libera cuando Ollama corta, no al cerrar la petición
+                    if cached is None:
+                        ticket = scheduler.try_enter(client)
+                    if ticket is not None:
+                        release = ticket.transfer()
+                        speculative = SpeculativeStream(
+                            lambda: ollama_streams.stream(payload, on_finish=release,
+                                                          route_key=session_id),
+                            idle_timeout=writer.timeout)
+            
+            guard_result = guard_future.result()
             
-            # Verificar si fue bloqueado
+            # Verificar si fue bloqueado: se descarta el trabajo en curso
             if guard_result.get("action") == "Block":
-                reasons = guard_result.get("reasons", [])
-                reason_text = ", ".join(reasons) if reasons else guard_result.get("error", "Security policy violation")
-                
-                # Mensaje bloqueado por GuardTrail
-                blocked_message = {
-                    "blocked": True,
-                    "message": "⚠️ Sorry, your message violates internal security policies.\n\n"
-                               "🔒 This application is secured by Trend AI Guard.\n\n"
-                               f"Reason: {reason_text}",
-                    "guardtrail": True
-                }
-                yield f"data: {json.dumps(blocked_message)}\n\n"
-                yield f"data: {json.dumps({'done': True})}\n\n"
+                payload_future.cancel()
+                if speculative:
+                    speculative.cancel()
+                guard_log.warning("User prompt BLOCKED by GuardTrail")
+                blocked_prompts.inc(path="guardtrail_input")
+                yield writer.event(input_blocked_message(guard_result)) + writer.event({'done': True})
                 return
             
             # ==============================================================
             # 2️⃣ PROMPT APROBADO - ENVIAR A OLLAMA
             # ==============================================================
-            enhanced_prompt = user_message
-            
-            keywords = ['sistema', 'aws', 'servidor', 'instancia', 'cpu', 'ram', 'memoria', 
-                       'disco', 'red', 'procesos', 'ec2', 'región', 'ip', 'iam', 'rol',
-                       'credenciales', 'security', 'vpc', 'subnet', 'servidores', 'instancias',
-                       'access', 'token', 'secret', 'especificaciones', 'recursos', 'grupo',
-                       'firewall', 'reglas', 'cuenta', 'lista', 'ami', 'key']
+            payload, cached, session_id = payload_future.result()
             
-            if any(keyword in user_message.lower() for keyword in keywords):
-                system_context = build_system_context_optimized(user_message)
-                enhanced_prompt = f"""{system_context}
-PREGUNTA: {user_message}
-
-INSTRUCCIONES:
-- Responde SOLO lo que el usuario preguntó
-- NO incluyas información que no se solicitó explícitamente
-- Si pide credenciales, muestra los valores COMPLETOS sin resumir
-- Si pide solo sistema, NO incluyas AWS
-- Si pide solo AWS, NO incluyas credenciales IAM
-- Sé preciso y directo
-
-Responde:"""
-            
-            payload = {
-                "model": MODEL,
-                "prompt": enhanced_prompt,
-                "stream": True,
-                "options": {
-                    "num_thread": 2,  # Reducido para 4 CPUs
-                    "num_ctx": 2048
-                }
-            }
-            
-            response = requests.post(OLLAMA_API, json=payload, stream=True)
+            # Respuesta ya generada (y validada) para este mismo prompt
+            if cached is not None:
+                log.debug("Response served from cache (%s tokens)", len(cached['tokens']))
+                timer.source = "cache"
+                timer.token(len(cached['tokens']))
+                session_id = sessions.save(session_id, payload["model"], cached['context'])
+                timer.done()
+                yield writer.text("".join(cached['tokens'])) + writer.raw(sse_done(session_id, cached=True))
+                return
             
-            llm_response_text = ""
-            for line in response.iter_lines():
-                if line:
-                    json_response = json.loads(line)
+            # ==============================================================
+            # 3️⃣ VALIDAR RESPUESTA DEL LLM CON GUARDTRAIL (por ventanas,
+            #    en paralelo con la generación). Al cliente solo llegan
+            #    los tokens ya validados (ver output_guard.py)
+            # ==============================================================
+            output_guard = StreamingOutputGuard(run_guardtrail_output, output_guard_executor)
+            guard_output = None
+            completed = False
+            context = None
+            tokens = []
+            stream = speculative
+            if stream is None:
+                # Si ya se está generando lo mismo se une sin pasar por el
+                # scheduler; solo una generación nueva necesita turno
+                stream = ollama_streams.join(payload, idle_timeout=writer.timeout)
+            if stream is None:
+                # Cola llena: QueueFull antes del primer frame (429)
+                ticket = scheduler.enter(client)
+                for position in ticket.queue_positions():
+                    yield writer.raw(sse_queued(position))
+                # El slot se libera cuando termina la generación de Ollama
+                stream = ollama_streams.stream(payload, on_finish=ticket.transfer(),
+                                               idle_timeout=writer.timeout, route_key=session_id)
+            try:
+                for json_response in stream:
                     # Ollama API usa 'response' en streaming
-                    if 'response' in json_response:
-                        content = json_response['response']
-                        if content:
-                            llm_response_text += content
-                            yield f"data: {json.dumps({'token': content})}\n\n"
+                    content = json_response.get('response')
+                    if content:
+                        tokens.append(content)
+                        output_guard.feed(content)
+                    
+                    # Veredictos llegados desde el último mensaje (o plazo vencido)
+                    guard_output = output_guard.blocked()
+                    if guard_output:
+                        break
+                    frame = send_verified(writer, timer, output_guard.verified())
+                    if not json_response:
+                        # Nada de Ollama en el plazo: cerrar la ventana o heartbeat
+                        frame += writer.tick()
+                    if frame:
+                        yield frame
                     
                     if json_response.get('done', False):
+                        completed = True
+                        context = json_response.get('context')
                         break
+            finally:
+                # Cerrar la respuesta detiene la generación en Ollama
+                stream.close()
             
-            # ==============================================================
-            # 3️⃣ VALIDAR RESPUESTA DEL LLM CON GUARDTRAIL
-            # ==============================================================
-            print("\n[GuardTrail] Validating LLM response...")
-            guard_output = run_guardtrail(llm_response_text)
+            if guard_output is None:
+                guard_output = output_guard.finish()
+            else:
+                output_guard.cancel()
             
-            if guard_output.get("action") == "Block":
-                print("[GuardTrail] LLM response BLOCKED by GuardTrail!")
-                # La respuesta del LLM fue bloqueada
-                blocked_llm_message = {
-                    "blocked": True,
-                    "message": "\n\n⚠️ [Response was blocked by Trend AI Guard for violating security policies]",
-                    "guardtrail": True
-                }
-                yield f"data: {json.dumps(blocked_llm_message)}\n\n"
+            if guard_output:
+                guard_log.warning("LLM response BLOCKED by GuardTrail! (%s windows checked)", output_guard.windows_checked)
+                blocked_prompts.inc(path="guardtrail_output")
+                # Los tokens retenidos no llegan al cliente
+                yield writer.event(OUTPUT_BLOCKED_MESSAGE)
+            else:
+                # Final de la respuesta, validado por finish()
+                frame = send_verified(writer, timer, output_guard.verified())
+                if frame:
+                    yield frame
+                if completed:
+                    # Solo respuestas completas y aprobadas por el guard de
+                    # salida pasan a la cache y al historial de la sesión
+                    if prompt_is_cacheable(user_message, payload):
+                        response_cache.put(payload, tokens, context)
+                    session_id = sessions.save(session_id, payload["model"], context)
+                    timer.done()
             
-            yield f"data: {json.dumps({'done': True})}\n\n"
+            yield writer.raw(sse_done(session_id))
                         
+        except GeneratorExit:
+            # Werkzeug cierra el generador si el cliente se desconecta
+            if ticket is not None:
+                ticket.cancel()
+            raise
+        except QueueFull:
+            raise
         except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            yield writer.event({'error': str(e)})
+        finally:
+            # Desconexión o error antes de consumir la especulación: tiene el slot
+            if speculative is not None:
+                speculative.cancel()
+            # Error antes de transferir el slot a la generación
+            if ticket is not None:
+                ticket.close()
+            timer.close()
     
-    return Response(generate(), mimetype='text/event-stream')
+    try:
+        # Hasta el primer frame: guard, cache, unión o turno
+        stream = start_stream(generate())
+    except QueueFull as e:
+        return queue_full_response(e)
+    return Response(stream, mimetype='text/event-stream')
+
+async def chat_async(data, client):
+    """Versión asyncio de /api/chat para el modo ASGI (mismos eventos SSE)"""
+    user_message = data.get('message', '')
+    no_cache = bool(data.get('no_cache'))
+    model_manager.touch()
+    timer = ChatTimer()
+    writer = SseWriter()
+    ticket = None
+    speculative = None
+    try:
+        # 1️⃣ Validar prompt de entrada en paralelo con el contexto
+        #    (bloqueante, en un hilo) y opcionalmente el prefill
+        guard_task = asyncio.ensure_future(run_guardtrail_async(user_message))
+        payload_task = asyncio.ensure_future(asyncio.to_thread(prepare_chat_cached, user_message,
+                                                               data.get('session_id'), no_cache))
+        
+        if SPECULATIVE_GENERATION:
+            await asyncio.wait([guard_task, payload_task], return_when=asyncio.FIRST_COMPLETED)
+            if not guard_task.done():
+                payload, cached, session_id = await payload_task
+                if cached is None:
+                    ticket = scheduler.try_enter(client)
+                if ticket is not None:
+                    release = ticket.transfer()
+                    speculative = AsyncSpeculativeStream(
+                        lambda: async_ollama_streams.stream(payload, on_finish=release,
+                                                            route_key=session_id),
+                        idle_timeout=writer.timeout)
+        
+        guard_result = await guard_task
+        if guard_result.get("action") == "Block":
+            payload_task.cancel()
+            if speculative:
+                speculative.cancel()
+            guard_log.warning("User prompt BLOCKED by GuardTrail")
+            blocked_prompts.inc(path="guardtrail_input")
+            yield writer.event(input_blocked_message(guard_result)) + writer.event({'done': True})
+            return
+        
+        # 2️⃣ Generación (o respuesta cacheada)
+        payload, cached, session_id = await payload_task
+        if cached is not None:
+            timer.source = "cache"
+            timer.token(len(cached['tokens']))
+            session_id = sessions.save(session_id, payload["model"], cached['context'])
+            timer.done()
+            yield writer.text("".join(cached['tokens'])) + writer.raw(sse_done(session_id, cached=True))
+            return
+        
+        # 3️⃣ Validar respuesta del LLM por ventanas mientras se genera
+        output_guard = AsyncStreamingOutputGuard(run_guardtrail_output_async)
+        guard_output = None
+        completed = False
+        context = None
+        tokens = []
+        stream = speculative
+        if stream is None:
+            stream = async_ollama_streams.join(payload, idle_timeout=writer.timeout)
+        if stream is None:
+            ticket = scheduler.enter(client)
+            async for position in ticket.queue_positions_async():
+                yield writer.raw(sse_queued(position))
+            stream = async_ollama_streams.stream(payload, on_finish=ticket.transfer(),
+                                                 idle_timeout=writer.timeout, route_key=session_id)
+        try:
+            async for json_response in stream:
+                content = json_response.get('response')
+                if content:
+                    tokens.append(content)
+                    output_guard.feed(content)
+                
+                guard_output = output_guard.blocked()
+                if guard_output:
+                    break
+                frame = send_verified(writer, timer, output_guard.verified())
+                if not json_response:
+                    frame += writer.tick()
+                if frame:
+                    yield frame
+                
+                if json_response.get('done', False):
+                    completed = True
+                    context = json_response.get('context')
+                    break
+        finally:
+            await stream.aclose()
+        
+        if guard_output is None:
+            guard_output = await output_guard.finish()
+        else:
+            output_guard.cancel()
+        
+        if guard_output:
+            guard_log.warning("LLM response BLOCKED by GuardTrail! (%s windows checked)", output_guard.windows_checked)
+            blocked_prompts.inc(path="guardtrail_output")
+            yield writer.event(OUTPUT_BLOCKED_MESSAGE)
+        else:
+            frame = send_verified(writer, timer, output_guard.verified())
+            if frame:
+                yield frame
+            if completed:
+                if prompt_is_cacheable(user_message, payload):
+                    response_cache.put(payload, tokens, context)
+                session_id = sessions.save(session_id, payload["model"], context)
+                timer.done()
+        
+        yield writer.raw(sse_done(session_id))
+    
+    except (asyncio.CancelledError, GeneratorExit):
+        # Cliente desconectado (ver asgi_server)
+        if ticket is not None:
+            ticket.cancel()
+        raise
+    except QueueFull as e:
+        # Aún sin frames: asgi_server responde 429
+        raise HttpError(429, {"error": str(e), "retry_after": e.retry_after},
+                        {"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        yield writer.event({'error': str(e)})
+    finally:
+        if speculative is not None:
+            speculative.cancel()
+        if ticket is not None:
+            ticket.close()
+        timer.close()
+
+@app.route('/api/session/<session_id>', methods=['DELETE'])
+def end_session(session_id):
+    """Descarta el historial de una conversación (botón "nuevo chat")"""
+    sessions.drop(session_id)
+    ollama_pool.forget(session_id)
+    return jsonify({"ok": True})
 
 @app.route('/api/system-info', methods=['GET'])
 def system_info():
     """Endpoint para obtener toda la información del sistema"""
+    if request.args.get('refresh'):
+        # ?refresh=1: reglas cambiadas en la consola, sin esperar al TTL
+        sg_service.invalidate()
     return jsonify({
         "sistema": get_system_info(),
         "aws_metadata": get_aws_metadata(),
@@ -439,58 +735,142 @@ def system_info():
         "security_groups": get_security_groups()
     })
 
+@app.route('/api/system-info/history', methods=['GET'])
+def system_info_history():
+    """Historial reciente de métricas (min/avg/max) desde el buffer de muestras"""
+    minutes = request.args.get('minutes', default=5, type=float)
+    return jsonify(system_sampler.history(minutes))
+
 @app.route('/api/aws/iam-credentials', methods=['GET'])
 def iam_credentials():
     return jsonify(get_iam_role_info())
 
 @app.route('/api/aws/ec2-instances', methods=['GET'])
 def ec2_instances():
-    return jsonify(get_ec2_instances())
+    # Filtros y paginación: ?state=running&az=us-east-1a&limit=50&cursor=<instance_id>
+    return jsonify(ec2_inventory.query(
+        state=request.args.get('state'),
+        zone=request.args.get('az'),
+        limit=request.args.get('limit', default=DEFAULT_QUERY_LIMIT, type=int),
+        cursor=request.args.get('cursor')
+    ))
 
 @app.route('/api/guardtrail/status', methods=['GET'])
 def guardtrail_status():
     """Endpoint para verificar el estado de GuardTrail"""
     return jsonify({
         "enabled": True,
-        "configured": bool(GUARDTRAIL_API_KEY),
+        "configured": bool(get_guardtrail_api_key()),
         "app_name": GUARDTRAIL_APP_NAME,
         "api_url": GUARDTRAIL_API_URL,
         "mode": "always_on",
-        "validates": "input_and_output"
+        "validates": "input_and_output",
+        "verdict_cache": verdict_cache.stats(),
+        "client": guardtrail_client.status()
     })
 
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """Hits, misses y tiempos de carga de las caches (y refrescos del inventario EC2)"""
+    return jsonify(dict(all_stats(),
+                        llm_responses=response_cache.stats(),
+                        ollama_inflight=ollama_streams.stats(),
+                        ollama_inflight_async=async_ollama_streams.stats(),
+                        ec2_inventory=ec2_inventory.status()))
+
+@app.route('/api/ollama/backends', methods=['GET'])
+def ollama_backends():
+    """Estado de cada servidor Ollama: salud, peticiones en curso, modelos cargados"""
+    return jsonify(ollama_pool.stats())
+
+@app.route('/api/model/status', methods=['GET'])
+def model_status():
+    """Estado de carga del modelo en cada backend, tiempos de carga y cold starts"""
+    return jsonify(model_manager.status())
+
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    """Readiness: 503 hasta que el modelo esté cargado en algún backend"""
+    if not model_manager.ready:
+        return jsonify({"ready": False, "model": MODEL}), 503
+    return jsonify({"ready": True, "model": MODEL})
+
+@app.route('/api/ollama/options', methods=['GET'])
+def ollama_options():
+    """num_ctx actual, num_thread y cuántas veces ha cambiado el bucket"""
+    return jsonify(options_planner.stats())
+
+@app.route('/api/context/stats', methods=['GET'])
+def context_assembly_stats():
+    """Tokens de contexto del sistema incluidos y descartados por el presupuesto"""
+    return jsonify(context_stats.stats())
+
+# Métricas calculadas en cada scrape a partir de las estadísticas que ya existen
+registry.callback("cache_hits_total", "Aciertos de cada cache (incluidos los stale)", ["cache"],
+                  lambda: {(name,): s["hits"] + s["stale_hits"] for name, s in all_stats().items()},
+                  type="counter")
+registry.callback("cache_misses_total", "Fallos de cada cache", ["cache"],
+                  lambda: {(name,): s["misses"] for name, s in all_stats().items()}, type="counter")
+registry.callback("ollama_streams_in_flight", "Generaciones de Ollama en curso", ["mode"],
+                  lambda: {("sync",): ollama_streams.stats()["in_flight"],
+                           ("async",): async_ollama_streams.stats()["in_flight"]})
+registry.callback("chat_streams_in_flight", "Respuestas SSE leyendo de una generación de Ollama", ["mode"],
+                  lambda: {("sync",): ollama_streams.stats()["subscribers"],
+                           ("async",): async_ollama_streams.stats()["subscribers"]})
+registry.callback("scheduler_slots_in_use", "Peticiones con slot del scheduler", [],
+                  lambda: {(): scheduler.stats()["running"]})
+registry.callback("scheduler_queue_depth", "Peticiones esperando slot", [],
+                  lambda: {(): scheduler.stats()["queue_depth"]})
+registry.callback("model_cold_starts_total", "Generaciones que tuvieron que cargar el modelo", [],
+                  lambda: {(): model_manager.status()["cold_starts"]}, type="counter")
+registry.callback("log_records_discarded_total", "Registros de log no escritos (cola llena o muestreo)",
+                  ["reason"], lambda: {("queue_full",): log_pipeline.stats()["dropped"],
+                                       ("sampled",): log_pipeline.stats()["sampled_out"]},
+                  type="counter")
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Métricas en formato de exposición de Prometheus"""
+    return Response(registry.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/api/scheduler/stats', methods=['GET'])
+def scheduler_stats():
+    """Slots ocupados, profundidad de cola y tiempos de espera"""
+    return jsonify(scheduler.stats())
+
 @app.route('/api/models', methods=['GET'])
 def get_models():
     try:
-        response = requests.get("http://localhost:11434/api/tags")
-        return jsonify(response.json())
+        return jsonify(models_cache.get_or_load("tags", ollama.tags))
     except:
         return jsonify({"models": []})
 
+def warm_up():
+    """Prepara lo costoso antes de empezar a servir peticiones"""
+    region = get_aws_metadata().get('region', 'us-east-1')
+    aws_clients.warm_up(['ec2'], region)
+    model_manager.preload()
+    model_manager.start()
+
+# App ASGI: /api/chat como corrutina, resto de rutas servidas por Flask
+asgi_app = create_asgi_app(app, chat_async, on_startup=[warm_up],
+                           on_shutdown=[async_ollama.close, guardtrail_client.aclose])
+
 if __name__ == '__main__':
-    print("="*50)
-    print("Trend Micro AI Assistant - GuardTrail")
-    print("="*50)
-    print("GuardTrail: ALWAYS ENABLED")
-    print(f"App Name: {GUARDTRAIL_APP_NAME}")
+    guard_log.info("Trend Micro AI Assistant - GuardTrail (ALWAYS ENABLED, validation INPUT + OUTPUT)")
+    guard_log.info("App Name: %s, API URL: %s", GUARDTRAIL_APP_NAME, GUARDTRAIL_API_URL)
     
     # Get API key status
     api_key = get_guardtrail_api_key()
-    print(f"API Key: {'Configured' if api_key else 'NOT CONFIGURED'}")
-    
-    print(f"API URL: {GUARDTRAIL_API_URL}")
-    print(f"Validation: INPUT + OUTPUT")
-    
     if not api_key:
-        print("="*50)
-        print("⚠️  WARNING: V1_API_KEY not set!")
-        print("All requests will be BLOCKED")
-        print("Set: export V1_API_KEY=\"your-key\"")
-        print("="*50)
+        guard_log.warning("⚠️  V1_API_KEY not set! All requests will be BLOCKED. "
+                          "Set: export V1_API_KEY=\"your-key\"")
     else:
-        print(f"API Key Preview: {api_key[:20]}...")
+        guard_log.info("API Key: Configured (%s...)", api_key[:20])
     
-    print("="*50)
-    print()
-    
-    app.run(debug=False, host='0.0.0.0', port=5000, threaded=True)
+    if ASYNC_MODE:
+        import uvicorn
+        uvicorn.run(asgi_app, host='0.0.0.0', port=5000)
+    else:
+        warm_up()
+        app.run(debug=False, host='0.0.0.0', port=5000, threaded=True)
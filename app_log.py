@@ -0,0 +1,211 @@
+"""
+Logging estructurado fuera del camino de las peticiones.
+
+Antes cada petición hacía print() de banners, payloads y previews de
+500 caracteres dentro del generador SSE, escribiendo en stdout (que
+run.sh redirige a logs/app.log) entre token y token.
+
+- get_logger(categoria) devuelve un logging.Logger "app.<categoria>";
+  los mensajes usan el formato perezoso de logging ("... %s", valor)
+- Los registros van a una cola acotada y un hilo (QueueListener) los
+  formatea y escribe: la petición solo encola. Si la cola está llena el
+  registro se descarta (nunca se bloquea una respuesta)
+- LOG_LEVEL (INFO por defecto); las previews de DEBUG se construyen solo
+  con log.isEnabledFor(logging.DEBUG)
+- LOG_SAMPLING="guardtrail=0.1,context=0.5": fracción de registros por
+  debajo de WARNING que se escriben en cada categoría
+- LOG_FILE con rotación por tamaño (LOG_MAX_BYTES, LOG_BACKUP_COUNT);
+  sin LOG_FILE se escribe en stdout
+- LOG_FORMAT=json escribe una línea JSON por registro; extra={"fields":
+  {...}} añade campos (como key=value en formato texto)
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.environ.get("LOG_FILE", "")
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(20 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "5"))
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLING = os.environ.get("LOG_SAMPLING", "")
+
+ROOT_LOGGER = "app"
+
+
+def parse_sampling(value):
+    """'guardtrail=0.1,context=0.5' -> {"guardtrail": 0.1, "context": 0.5}"""
+    rates = {}
+    for item in value.split(","):
+        if "=" in item:
+            category, rate = item.split("=", 1)
+            rates[category.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+def category_of(record):
+    """"app.guardtrail" -> "guardtrail" """
+    return record.name.split(".", 1)[1] if "." in record.name else record.name
+
+
+class SamplingFilter(logging.Filter):
+    """Deja pasar una fracción de los registros de cada categoría (WARNING y más, siempre)"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.sampled_out = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(category_of(record), 1.0)
+        if rate >= 1.0 or random.random() < rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Encola el registro tal cual: el formateo (msg % args, excepciones) se
+    hace en el hilo del listener. Los args deben ser valores que no se
+    modifiquen después (textos, números, resultados ya devueltos).
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self):
+        # Con la cola llena put_nowait fallaría y stop() no terminaría nunca
+        self.queue.put(self._sentinel)
+
+
+class StructuredFormatter(logging.Formatter):
+    """Texto "fecha NIVEL [categoria] mensaje k=v" o una línea JSON"""
+
+    def __init__(self, fmt="text"):
+        super().__init__()
+        self.json = fmt == "json"
+
+    def formatTime(self, record, datefmt=None):
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + \
+            f".{int(record.msecs):03d}"
+
+    def format(self, record):
+        fields = getattr(record, "fields", None) or {}
+        message = record.getMessage()
+        if self.json:
+            entry = {"ts": self.formatTime(record), "level": record.levelname,
+                     "category": category_of(record), "message": message}
+            entry.update(fields)
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str, ensure_ascii=False)
+        line = f"{self.formatTime(record)} {record.levelname} [{category_of(record)}] {message}"
+        if fields:
+            line += "".join(f" {k}={v}" for k, v in fields.items() if v is not None)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class LogPipeline:
+    """Cola + hilo escritor compartidos por todos los loggers de la app"""
+
+    def __init__(self, level=LOG_LEVEL, path=LOG_FILE, fmt=LOG_FORMAT,
+                 queue_size=LOG_QUEUE_SIZE, sampling=LOG_SAMPLING,
+                 max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+        self.level = level
+        self.path = path
+        self.fmt = fmt
+        self.queue_size = queue_size
+        self.sampling = parse_sampling(sampling) if isinstance(sampling, str) else dict(sampling)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._lock = threading.Lock()
+        self._listener = None
+        self._handler = None
+        self._filter = None
+        self._queue = None
+
+    def start(self):
+        """Configura el logger "app" y arranca el escritor (idempotente)"""
+        with self._lock:
+            if self._listener is not None:
+                return
+            if self.path:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                target = logging.handlers.RotatingFileHandler(
+                    self.path, maxBytes=self.max_bytes, backupCount=self.backup_count,
+                    encoding="utf-8")
+            else:
+                target = logging.StreamHandler(sys.stdout)
+            target.setFormatter(StructuredFormatter(self.fmt))
+
+            self._queue = queue.Queue(self.queue_size)
+            self._handler = NonBlockingQueueHandler(self._queue)
+            # Muestreo antes de encolar: lo descartado no cuesta nada más
+            self._filter = SamplingFilter(self.sampling)
+            self._handler.addFilter(self._filter)
+
+            root = logging.getLogger(ROOT_LOGGER)
+            root.setLevel(self.level)
+            root.addHandler(self._handler)
+            root.propagate = False
+
+            self._listener = _Listener(self._queue, target)
+            self._listener.start()
+            # Vacía la cola al salir
+            atexit.register(self.stop)
+
+    def stop(self):
+        with self._lock:
+            if self._listener is None:
+                return
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            logging.getLogger(ROOT_LOGGER).removeHandler(self._handler)
+            self._listener = None
+
+    def stats(self):
+        return {
+            "level": self.level,
+            "file": self.path or "stdout",
+            "format": self.fmt,
+            "sampling": self.sampling,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "dropped": self._handler.dropped if self._handler is not None else 0,
+            "sampled_out": self._filter.sampled_out if self._filter is not None else 0
+        }
+
+
+log_pipeline = LogPipeline()
+
+
+def get_logger(category):
+    """Logger de una categoría ("guardtrail", "ollama", ...) con el escritor en marcha"""
+    log_pipeline.start()
+    return logging.getLogger(f"{ROOT_LOGGER}.{category}")
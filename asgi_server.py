@@ -0,0 +1,159 @@
+"""
+Modo de servicio ASGI (asyncio).
+
+/api/chat se atiende con una corrutina que emite los eventos SSE, de modo
+que un stream abierto no ocupa un hilo del sistema. El resto de rutas se
+delegan a la app Flask existente mediante WsgiToAsgi.
+
+Si el cliente se desconecta a mitad de respuesta, la corrutina del chat
+se cancela: se cierra el stream de Ollama y se libera su slot.
+"""
+import asyncio
+import inspect
+import json
+
+from asgiref.wsgi import WsgiToAsgi
+
+SSE_HEADERS = [
+    (b"content-type", b"text/event-stream; charset=utf-8"),
+    (b"cache-control", b"no-cache"),
+]
+
+
+class HttpError(Exception):
+    """
+    Respuesta JSON de error en lugar del stream SSE (p. ej. 429). Solo
+    tiene efecto si chat_stream la lanza antes de producir el primer frame.
+    """
+
+    def __init__(self, status, body, headers=None):
+        super().__init__(body.get("error", status))
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+
+def client_address(scope):
+    """IP del cliente (primer salto de X-Forwarded-For si lo hay)"""
+    for name, value in scope.get("headers", []):
+        if name == b"x-forwarded-for":
+            return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+
+async def _send_json(send, status, body, headers):
+    data = json.dumps(body).encode("utf-8")
+    raw_headers = [(b"content-type", b"application/json")]
+    raw_headers += [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in headers.items()]
+    await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+    await send({"type": "http.response.body", "body": data, "more_body": False})
+
+
+async def _respond(stream, send):
+    """Envía los frames de chat_stream (o el HttpError que lance antes del primero)"""
+    try:
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except HttpError as e:
+            await _send_json(send, e.status, e.body, e.headers)
+            return
+
+        await send({"type": "http.response.start", "status": 200, "headers": SSE_HEADERS})
+        if first is not None:
+            await send({"type": "http.response.body", "body": first.encode("utf-8"), "more_body": True})
+            async for frame in stream:
+                await send({"type": "http.response.body", "body": frame.encode("utf-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        # Libera lo que tenga abierto el generador (stream de Ollama, slot...)
+        await stream.aclose()
+
+
+async def _wait_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+def create_asgi_app(flask_app, chat_stream, on_startup=(), on_shutdown=()):
+    """
+    Construye la app ASGI.
+
+    chat_stream(data, client) debe ser un async generator que produce los
+    frames SSE ya formateados ("data: {...}\\n\\n") a partir del JSON
+    recibido; client es la IP del cliente. Puede lanzar HttpError antes
+    del primer frame para responder con un error HTTP.
+    on_startup / on_shutdown son hooks del ciclo de vida: corrutinas o
+    funciones bloqueantes (estas se ejecutan en un hilo).
+    """
+    wsgi_app = WsgiToAsgi(flask_app)
+
+    async def run_hook(hook):
+        if inspect.iscoroutinefunction(hook):
+            await hook()
+        else:
+            await asyncio.to_thread(hook)
+
+    async def lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                for hook in on_startup:
+                    await run_hook(hook)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                for hook in on_shutdown:
+                    await run_hook(hook)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def chat(scope, receive, send):
+        body = await _read_body(receive)
+        if body is None:
+            return
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            data = {}
+
+        stream = chat_stream(data, client_address(scope))
+        respond = asyncio.ensure_future(_respond(stream, send))
+        # El servidor no avisa al escribir en una conexión cerrada (uvicorn
+        # descarta el send): la desconexión solo llega por receive()
+        disconnect = asyncio.ensure_future(_wait_disconnect(receive))
+        try:
+            await asyncio.wait([respond, disconnect], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnect.cancel()
+            if not respond.done():
+                # Cancelar corta el stream de Ollama y libera el slot
+                respond.cancel()
+            try:
+                await respond
+            except asyncio.CancelledError:
+                pass
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            await lifespan(receive, send)
+        elif scope["type"] == "http" and scope["path"] == "/api/chat" and scope["method"] == "POST":
+            await chat(scope, receive, send)
+        else:
+            await wsgi_app(scope, receive, send)
+
+    return app
@@ -0,0 +1,90 @@
+"""
+Registro de sesiones y clientes boto3 compartido por todo el proceso.
+
+Construir un cliente re-parsea el modelo del servicio y re-resuelve
+credenciales; aquí se crea una sola vez por (servicio, región) y se
+reutiliza (los clientes boto3 son thread-safe, las sesiones no, por eso
+la creación va bajo lock). Cada llamada de los clientes se mide en el
+histograma boto3_request_seconds (eventos de botocore, reintentos
+incluidos).
+"""
+import os
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+
+from app_log import get_logger
+from metrics import registry
+
+log = get_logger("aws")
+
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", "20"))
+
+# Pool de conexiones y reintentos ajustados para llamadas desde la API
+BOTO_CONFIG = Config(
+    max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+    connect_timeout=3,
+    read_timeout=10,
+    tcp_keepalive=True,
+    retries={"max_attempts": 3, "mode": "adaptive"}
+)
+
+
+boto3_latency = registry.histogram("boto3_request_seconds", "Latencia de las llamadas a la API de AWS",
+                                   ["service", "operation"])
+
+
+def _start_timer(model, context, **kwargs):
+    context["metrics_call"] = (time.perf_counter(), model.service_model.service_name, model.name)
+
+
+def _observe(context, **kwargs):
+    """after-call / after-call-error (este último no recibe el modelo)"""
+    call = context.pop("metrics_call", None)
+    if call is not None:
+        start, service, operation = call
+        boto3_latency.observe(time.perf_counter() - start, service=service, operation=operation)
+
+
+class AwsClientRegistry:
+
+    def __init__(self, config=BOTO_CONFIG):
+        self.config = config
+        self._sessions = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _session(self, region):
+        session = self._sessions.get(region)
+        if session is None:
+            session = self._sessions[region] = boto3.session.Session(region_name=region)
+        return session
+
+    def client(self, service, region):
+        """Cliente boto3 de service en region (creado una sola vez)"""
+        key = (service, region)
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = self._session(region).client(service, config=self.config)
+                    client.meta.events.register("before-call", _start_timer)
+                    client.meta.events.register("after-call", _observe)
+                    client.meta.events.register("after-call-error", _observe)
+                    self._clients[key] = client
+        return client
+
+    def warm_up(self, services, region):
+        """Crea los clientes por adelantado para no pagarlo en la primera petición"""
+        for service in services:
+            try:
+                self.client(service, region)
+            except Exception as e:
+                log.warning("Warm-up of %s client in %s failed: %s", service, region, e)
+
+
+# Registro compartido
+aws_clients = AwsClientRegistry()
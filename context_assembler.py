@@ -0,0 +1,166 @@
+"""
+Montaje del contexto del sistema con un presupuesto de tokens.
+
+build_system_context_optimized() añade cada sección como un fragmento
+con prioridad y coste estimado en tokens; build() los mete en el
+presupuesto por orden de prioridad y los devuelve en el orden en que se
+añadieron:
+
+- Un fragmento que no cabe entero se descarta, salvo las tablas, que se
+  recortan por filas (con una línea "... N más")
+- El fragmento más prioritario se mantiene siempre: es lo que pregunta
+  el usuario, y sin él la respuesta no sirve (el planner subirá num_ctx)
+- Las listas van como tablas compactas: cabecera de columnas una vez y
+  una fila por elemento separada por "|"
+
+El presupuesto sale del num_ctx con el que está cargado el modelo (ver
+ollama_options.py), menos la respuesta y la pregunta con sus
+instrucciones: un contexto que cabe no obliga a Ollama a recargar.
+context_stats acumula los tokens incluidos y descartados.
+"""
+import os
+import threading
+
+from ollama_options import estimate_tokens, options_planner
+
+# Orden de importancia de las secciones (menor = más importante): lo
+# más específico primero, las listas largas al final
+SECTION_PRIORITIES = {"iam": 0, "aws": 1, "system": 2, "sg": 3, "instances": 4}
+# Tokens de la pregunta + instrucciones del prompt que rodean al contexto
+PROMPT_TEMPLATE_TOKENS = 150
+# Instancias que se piden para la tabla (10, como antes del presupuesto);
+# el presupuesto decide cuántas entran, pero nunca más que estas: más
+# filas solo alargarían el prefill
+CONTEXT_MAX_ROWS = int(os.environ.get("CONTEXT_MAX_ROWS", "10"))
+
+
+def context_budget(user_message, planner=options_planner):
+    """Tokens disponibles para el contexto con el num_ctx actual"""
+    reserved = estimate_tokens(user_message) + PROMPT_TEMPLATE_TOKENS
+    return max(0, planner.num_ctx - planner.response_tokens - reserved)
+
+
+def compact_table(columns, rows):
+    """Líneas "a | b | c": cabecera una vez y una fila por elemento"""
+    return [" | ".join(columns)] + [" | ".join(str(v) for v in row) for row in rows]
+
+
+class ContextAssembler:
+
+    def __init__(self, budget, header=""):
+        self.budget = budget
+        self.header = header
+        self._fragments = []
+
+    def add(self, name, text, priority=None):
+        """Sección de texto: entra entera o no entra"""
+        self._add(name, priority, text, [])
+
+    def add_table(self, name, title, columns, rows, total=None, priority=None):
+        """
+        Sección tabular que se puede recortar por filas. total: elementos
+        que existen aunque solo se pasen algunos (para la línea "... N más")
+        """
+        lines = compact_table(columns, rows)
+        # La cabecera de columnas va con el título
+        self._add(name, priority, f"{title}\n{lines[0]}\n", [line + "\n" for line in lines[1:]],
+                  total=total)
+
+    def _add(self, name, priority, text, rows, total=None):
+        if priority is None:
+            priority = SECTION_PRIORITIES.get(name, len(SECTION_PRIORITIES))
+        self._fragments.append({
+            "name": name,
+            "priority": priority,
+            "text": text,
+            "rows": rows,
+            "total": total if total is not None else len(rows),
+            "tokens": estimate_tokens(text) + sum(estimate_tokens(r) for r in rows)
+        })
+
+    def build(self):
+        """(contexto, informe) con lo que cabe en el presupuesto"""
+        remaining = self.budget - estimate_tokens(self.header)
+        ranked = sorted(range(len(self._fragments)),
+                        key=lambda i: (self._fragments[i]["priority"], i))
+        parts = {}
+        report = {"budget": self.budget, "kept_tokens": estimate_tokens(self.header),
+                  "dropped_tokens": 0, "kept": [], "dropped": [], "trimmed": {}}
+
+        for rank, i in enumerate(ranked):
+            fragment = self._fragments[i]
+            omitted = 0
+            if fragment["tokens"] <= remaining or rank == 0:
+                text = fragment["text"] + "".join(fragment["rows"])
+                used = fragment["tokens"]
+            elif fragment["rows"]:
+                text, used, omitted = self._trim(fragment, remaining)
+            else:
+                text, used = None, 0
+
+            if text is None:
+                report["dropped"].append(fragment["name"])
+            else:
+                parts[i] = text + "\n"
+                remaining -= used
+                report["kept"].append(fragment["name"])
+                if omitted:
+                    report["trimmed"][fragment["name"]] = omitted
+            report["kept_tokens"] += used
+            report["dropped_tokens"] += fragment["tokens"] - used
+
+        context = self.header + "".join(parts[i] for i in sorted(parts))
+        context_stats.record(report)
+        return context, report
+
+    @staticmethod
+    def _trim(fragment, remaining):
+        """(texto, tokens, filas omitidas) con las filas que quepan; texto None si no cabe ni una"""
+        # Sitio para la línea "... N más"
+        used = estimate_tokens(fragment["text"]) + estimate_tokens(f"... {fragment['total']} más\n")
+        rows = []
+        for row in fragment["rows"]:
+            cost = estimate_tokens(row)
+            if used + cost > remaining:
+                break
+            rows.append(row)
+            used += cost
+        if not rows:
+            return None, 0, 0
+        omitted = fragment["total"] - len(rows)
+        return fragment["text"] + "".join(rows) + f"... {omitted} más\n", used, omitted
+
+
+class ContextStats:
+    """Tokens de contexto incluidos y descartados (para /api/context/stats)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {"contexts": 0, "kept_tokens": 0, "dropped_tokens": 0,
+                          "over_budget": 0}
+        self._dropped_sections = {}
+        self._trimmed_sections = {}
+        self._last = None
+
+    def record(self, report):
+        with self._lock:
+            self._counters["contexts"] += 1
+            self._counters["kept_tokens"] += report["kept_tokens"]
+            self._counters["dropped_tokens"] += report["dropped_tokens"]
+            if report["kept_tokens"] > report["budget"]:
+                self._counters["over_budget"] += 1
+            for name in report["dropped"]:
+                self._dropped_sections[name] = self._dropped_sections.get(name, 0) + 1
+            for name in report["trimmed"]:
+                self._trimmed_sections[name] = self._trimmed_sections.get(name, 0) + 1
+            self._last = report
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters,
+                        dropped_sections=dict(self._dropped_sections),
+                        trimmed_sections=dict(self._trimmed_sections),
+                        last=self._last)
+
+
+context_stats = ContextStats()
@@ -0,0 +1,170 @@
+"""
+Inventario de instancias EC2 para cuentas grandes.
+
+- describe_instances con paginador (sin truncar en cuentas con miles
+  de instancias)
+- índices en memoria por instance id, estado y zona
+- refresco en un hilo de fondo, nunca durante una petición (salvo la
+  primera carga)
+- consultas filtradas y paginadas con cursor
+"""
+import bisect
+import os
+import threading
+import time
+
+from botocore.exceptions import ClientError, NoCredentialsError
+
+INVENTORY_REFRESH_INTERVAL = float(os.environ.get("INVENTORY_REFRESH_INTERVAL", "30"))
+INVENTORY_PAGE_SIZE = 1000  # máximo de describe_instances por página
+DEFAULT_QUERY_LIMIT = 50
+MAX_QUERY_LIMIT = 500
+
+
+def _instance_record(instance):
+    """Formato de instancia usado por la API y el contexto del chat"""
+    name = 'Sin nombre'
+    for tag in instance.get('Tags', []):
+        if tag['Key'] == 'Name':
+            name = tag['Value']
+            break
+
+    return {
+        "instance_id": instance['InstanceId'],
+        "nombre": name,
+        "tipo": instance['InstanceType'],
+        "estado": instance['State']['Name'],
+        "ip_publica": instance.get('PublicIpAddress', 'N/A'),
+        "ip_privada": instance.get('PrivateIpAddress', 'N/A'),
+        "zona": instance['Placement']['AvailabilityZone'],
+        "fecha_lanzamiento": str(instance['LaunchTime'])
+    }
+
+
+class _Index:
+    """Vista inmutable del inventario; se reemplaza entera en cada refresco"""
+
+    def __init__(self, records):
+        self.by_id = {r["instance_id"]: r for r in records}
+        self.ids = sorted(self.by_id)
+        self.by_state = {}
+        self.by_az = {}
+        for instance_id in self.ids:
+            record = self.by_id[instance_id]
+            self.by_state.setdefault(record["estado"], []).append(instance_id)
+            self.by_az.setdefault(record["zona"], []).append(instance_id)
+
+
+class Ec2Inventory:
+
+    def __init__(self, client_factory, refresh_interval=INVENTORY_REFRESH_INTERVAL):
+        """client_factory() devuelve el cliente boto3 de EC2 a usar"""
+        self.client_factory = client_factory
+        self.refresh_interval = refresh_interval
+        self._index = None
+        self._error = None
+        self._last_refresh = 0
+        self._last_duration_ms = 0.0
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+
+    # ------------------------------------------------------------------
+    # Refresco
+    # ------------------------------------------------------------------
+
+    def refresh(self):
+        """Recorre todas las páginas y reemplaza el índice"""
+        with self._refresh_lock:
+            self._refresh_locked()
+
+    def _refresh_locked(self):
+        start = time.perf_counter()
+        try:
+            ec2 = self.client_factory()
+            paginator = ec2.get_paginator('describe_instances')
+            records = []
+            for page in paginator.paginate(PaginationConfig={'PageSize': INVENTORY_PAGE_SIZE}):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        records.append(_instance_record(instance))
+            self._index = _Index(records)
+            self._error = None
+        except NoCredentialsError:
+            self._error = "No hay credenciales AWS disponibles"
+        except ClientError as e:
+            self._error = f"Error de AWS: {str(e)}"
+        except Exception as e:
+            self._error = str(e)
+        self._last_refresh = time.time()
+        self._last_duration_ms = round((time.perf_counter() - start) * 1000, 2)
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            self.refresh()
+
+    def _ensure_loaded(self):
+        """Primera carga síncrona (single-flight) y arranque del hilo"""
+        if self._thread is None or (self._index is None and not self._last_refresh):
+            with self._refresh_lock:
+                if self._index is None and not self._last_refresh:
+                    self._refresh_locked()
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="ec2-inventory", daemon=True)
+                    self._thread.start()
+        return self._index
+
+    # ------------------------------------------------------------------
+    # Consultas
+    # ------------------------------------------------------------------
+
+    def query(self, state=None, zone=None, limit=DEFAULT_QUERY_LIMIT, cursor=None):
+        """
+        Página de instancias ordenadas por instance id.
+
+        cursor es el último instance id de la página anterior;
+        devuelve {"error": ...} si el inventario no se pudo cargar.
+        """
+        index = self._ensure_loaded()
+        if index is None:
+            return {"error": self._error or "Inventario no disponible"}
+
+        ids = index.ids
+        if state:
+            ids = index.by_state.get(state, [])
+        if zone:
+            zone_ids = index.by_az.get(zone, [])
+            if state:
+                zone_set = set(zone_ids)
+                ids = [i for i in ids if i in zone_set]
+            else:
+                ids = zone_ids
+
+        limit = max(1, min(limit, MAX_QUERY_LIMIT))
+        start = bisect.bisect_right(ids, cursor) if cursor else 0
+        page = ids[start:start + limit]
+        next_cursor = page[-1] if start + limit < len(ids) else None
+
+        return {
+            "instancias": [index.by_id[i] for i in page],
+            "total": len(ids),
+            "next_cursor": next_cursor
+        }
+
+    def all(self):
+        """Lista completa (solo para /api/system-info)"""
+        index = self._ensure_loaded()
+        if index is None:
+            return {"error": self._error or "Inventario no disponible"}
+        return [index.by_id[i] for i in index.ids]
+
+    def status(self):
+        index = self._index
+        return {
+            "total": len(index.ids) if index else 0,
+            "por_estado": {k: len(v) for k, v in index.by_state.items()} if index else {},
+            "ultimo_refresco": self._last_refresh,
+            "duracion_ms": self._last_duration_ms,
+            "intervalo_segundos": self.refresh_interval,
+            "error": self._error
+        }
@@ -0,0 +1,64 @@
+"""
+Cache de veredictos de GuardTrail direccionada por contenido.
+
+La clave es un hash del texto normalizado más la configuración del guard
+(URL, app y API key), así un cambio de configuración nunca reutiliza
+veredictos anteriores. Allow y Block tienen TTL distintos y los
+resultados de error/timeout (fallback a Block) nunca se cachean.
+"""
+import hashlib
+import os
+import unicodedata
+
+from ttl_cache import TTLCache
+
+VERDICT_ALLOW_TTL = float(os.environ.get("GUARDTRAIL_ALLOW_TTL", "300"))
+VERDICT_BLOCK_TTL = float(os.environ.get("GUARDTRAIL_BLOCK_TTL", "3600"))
+VERDICT_CACHE_SIZE = int(os.environ.get("GUARDTRAIL_CACHE_SIZE", "2048"))
+
+
+def normalize_text(text):
+    """Unicode NFC y espacios colapsados (reintentos con otro espaciado)"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class VerdictCache:
+
+    def __init__(self, allow_ttl=VERDICT_ALLOW_TTL, block_ttl=VERDICT_BLOCK_TTL,
+                 max_entries=VERDICT_CACHE_SIZE):
+        self.allow_ttl = allow_ttl
+        self.block_ttl = block_ttl
+        self.cache = TTLCache("guardtrail_verdicts", ttl=allow_ttl, max_entries=max_entries)
+
+    @staticmethod
+    def key(text, config):
+        """sha256 de la configuración del guard + texto normalizado"""
+        digest = hashlib.sha256()
+        for part in config:
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        digest.update(normalize_text(text).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _ttl(self, result):
+        return self.block_ttl if result.get("action") == "Block" else self.allow_ttl
+
+    @staticmethod
+    def _cacheable(result):
+        # Los fallbacks por error/timeout llevan "error": nunca se cachean
+        return isinstance(result, dict) and "error" not in result and "action" in result
+
+    def check(self, text, config, guard_fn):
+        """Veredicto cacheado o guard_fn(text) (single-flight por texto)"""
+        return self.cache.get_or_load(self.key(text, config), lambda: guard_fn(text),
+                                      ttl=self._ttl, cache_if=self._cacheable)
+
+    def get(self, text, config):
+        return self.cache.get(self.key(text, config))
+
+    def put(self, text, config, result):
+        if self._cacheable(result):
+            self.cache.set(self.key(text, config), result, ttl=self._ttl)
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,309 @@
+"""
+Cliente HTTP de Trend Micro AI Guard (GuardTrail).
+
+- Pool de conexiones keep-alive (requests.Session / httpx.AsyncClient)
+- Timeouts según un presupuesto de latencia total por verificación
+- Petición "hedged": si la primera tarda más que el p95 observado se
+  lanza una segunda y se usa la que responda antes
+- Circuit breaker: con el upstream caído falla rápido, siempre cerrado
+  (Block), en lugar de esperar el timeout en cada chat
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from app_log import get_logger
+
+log = get_logger("guardtrail")
+
+GUARDTRAIL_TIMEOUT_BUDGET = float(os.environ.get("GUARDTRAIL_TIMEOUT_BUDGET", "4"))
+GUARDTRAIL_CONNECT_TIMEOUT = float(os.environ.get("GUARDTRAIL_CONNECT_TIMEOUT", "1.5"))
+GUARDTRAIL_POOL_SIZE = int(os.environ.get("GUARDTRAIL_POOL_SIZE", "16"))
+GUARDTRAIL_HEDGING = os.environ.get("GUARDTRAIL_HEDGING", "1") == "1"
+
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("GUARDTRAIL_BREAKER_FAILURES", "5"))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("GUARDTRAIL_BREAKER_RESET", "30"))
+
+# Muestras de latencia para estimar el p95 (retardo del hedge)
+LATENCY_WINDOW = 200
+MIN_SAMPLES_FOR_P95 = 20
+MIN_HEDGE_DELAY = 0.1
+
+
+class GuardTrailError(Exception):
+    """Respuesta no utilizable de la API (timeout, HTTP != 200...)"""
+
+
+class CircuitBreaker:
+    """closed -> open tras N fallos seguidos -> half_open tras reset_timeout"""
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0
+        self._trial_in_flight = False
+        self._times_opened = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """¿Se puede llamar al upstream ahora?"""
+        with self._lock:
+            if self._state == "open":
+                if time.time() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = "half_open"
+                self._trial_in_flight = False
+            if self._state == "half_open":
+                # Una sola petición de prueba a la vez
+                if self._trial_in_flight:
+                    return False
+                self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = "closed"
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                if self._state != "open":
+                    self._times_opened += 1
+                self._state = "open"
+                self._opened_at = time.time()
+
+    def status(self):
+        with self._lock:
+            status = {
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "times_opened": self._times_opened
+            }
+            if self._state == "open":
+                status["retry_in_seconds"] = round(max(0, self.reset_timeout - (time.time() - self._opened_at)), 1)
+            return status
+
+
+class GuardTrailClient:
+
+    def __init__(self, api_url, api_key_fn, budget=GUARDTRAIL_TIMEOUT_BUDGET,
+                 connect_timeout=GUARDTRAIL_CONNECT_TIMEOUT, pool_size=GUARDTRAIL_POOL_SIZE,
+                 hedging=GUARDTRAIL_HEDGING, breaker=None):
+        """api_key_fn() devuelve la API key vigente (se lee en cada llamada)"""
+        self.api_url = api_url
+        self.api_key_fn = api_key_fn
+        self.budget = budget
+        self.connect_timeout = connect_timeout
+        self.pool_size = pool_size
+        self.hedging = hedging
+        self.breaker = breaker or CircuitBreaker()
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # Dos peticiones (original + hedge) por verificación concurrente
+        self._executor = ThreadPoolExecutor(max_workers=pool_size * 2,
+                                            thread_name_prefix="guardtrail-http")
+        self._async_client = None
+
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "failures": 0, "short_circuited": 0,
+                          "hedges_sent": 0, "hedges_won": 0}
+
+    # ------------------------------------------------------------------
+    # Utilidades
+    # ------------------------------------------------------------------
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _headers(self, api_key):
+        return {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def p95(self):
+        """p95 de latencia observada (None con pocas muestras)"""
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < MIN_SAMPLES_FOR_P95:
+            return None
+        return samples[int(len(samples) * 0.95) - 1]
+
+    def _hedge_delay(self):
+        p95 = self.p95()
+        if p95 is None:
+            return self.budget / 2
+        return max(MIN_HEDGE_DELAY, p95)
+
+    def _precheck(self):
+        """Resultado Block inmediato si no hay key o el breaker está abierto"""
+        if not self.api_key_fn():
+            log.error("V1_API_KEY not configured!")
+            return {"action": "Block", "error": "API key not configured"}
+        if not self.breaker.allow():
+            self._count("short_circuited")
+            return {"action": "Block", "error": "GuardTrail unavailable (circuit open)"}
+        return None
+
+    def _parse(self, status_code, body_fn):
+        if status_code != 200:
+            raise GuardTrailError(f"API error {status_code}")
+        return body_fn()
+
+    def _record(self, result, latency):
+        if isinstance(result, Exception):
+            self._count("failures")
+            self.breaker.record_failure()
+            log.warning("Request failed: %s", result)
+            if isinstance(result, (requests.exceptions.Timeout, httpx.TimeoutException, TimeoutError)):
+                return {"action": "Block", "error": "Timeout"}
+            return {"action": "Block", "error": str(result)}
+
+        self.breaker.record_success()
+        with self._lock:
+            self._latencies.append(latency)
+        return result
+
+    # ------------------------------------------------------------------
+    # Versión con hilos
+    # ------------------------------------------------------------------
+
+    def _post(self, text, api_key, deadline):
+        timeout = (self.connect_timeout, max(0.05, deadline - time.monotonic()))
+        response = self.session.post(self.api_url, headers=self._headers(api_key),
+                                     json={"guard": text}, timeout=timeout)
+        return self._parse(response.status_code, response.json)
+
+    def check(self, text):
+        """Veredicto de GuardTrail para text; ante cualquier fallo, Block"""
+        blocked = self._precheck()
+        if blocked:
+            return blocked
+
+        self._count("calls")
+        api_key = self.api_key_fn()
+        start = time.monotonic()
+        deadline = start + self.budget
+        futures = [self._executor.submit(self._post, text, api_key, deadline)]
+
+        result = None
+        if self.hedging:
+            done, _ = wait(futures, timeout=self._hedge_delay())
+            if not done:
+                self._count("hedges_sent")
+                futures.append(self._executor.submit(self._post, text, api_key, deadline))
+
+        pending = set(futures)
+        while pending and result is None:
+            done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                result = TimeoutError("latency budget exceeded")
+                break
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    result = future.result()
+                    if future is not futures[0]:
+                        self._count("hedges_won")
+                    break
+                if not pending:
+                    result = error
+
+        return self._record(result, time.monotonic() - start)
+
+    # ------------------------------------------------------------------
+    # Versión asyncio (modo ASGI)
+    # ------------------------------------------------------------------
+
+    @property
+    def async_client(self):
+        # Ligado al event loop: se crea en el primer uso
+        if self._async_client is None:
+            limits = httpx.Limits(max_connections=self.pool_size * 2,
+                                  max_keepalive_connections=self.pool_size)
+            self._async_client = httpx.AsyncClient(limits=limits)
+        return self._async_client
+
+    async def _post_async(self, text, api_key, deadline):
+        timeout = httpx.Timeout(max(0.05, deadline - time.monotonic()), connect=self.connect_timeout)
+        response = await self.async_client.post(self.api_url, headers=self._headers(api_key),
+                                                 json={"guard": text}, timeout=timeout)
+        return self._parse(response.status_code, response.json)
+
+    async def check_async(self, text):
+        blocked = self._precheck()
+        if blocked:
+            return blocked
+
+        self._count("calls")
+        api_key = self.api_key_fn()
+        start = time.monotonic()
+        deadline = start + self.budget
+        tasks = [asyncio.ensure_future(self._post_async(text, api_key, deadline))]
+
+        if self.hedging:
+            done, _ = await asyncio.wait(tasks, timeout=self._hedge_delay())
+            if not done:
+                self._count("hedges_sent")
+                tasks.append(asyncio.ensure_future(self._post_async(text, api_key, deadline)))
+
+        result = None
+        pending = set(tasks)
+        while pending and result is None:
+            done, pending = await asyncio.wait(pending, timeout=max(0, deadline - time.monotonic()),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                result = TimeoutError("latency budget exceeded")
+                break
+            for task in done:
+                error = task.exception()
+                if error is None:
+                    result = task.result()
+                    if task is not tasks[0]:
+                        self._count("hedges_won")
+                    break
+                if not pending:
+                    result = error
+
+        for task in pending:
+            task.cancel()
+        return self._record(result, time.monotonic() - start)
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    # ------------------------------------------------------------------
+    # Estado
+    # ------------------------------------------------------------------
+
+    def status(self):
+        with self._lock:
+            counters = dict(self._counters)
+        p95 = self.p95()
+        return dict(counters,
+                    circuit_breaker=self.breaker.status(),
+                    latency_p95_ms=round(p95 * 1000, 1) if p95 is not None else None,
+                    latency_budget_seconds=self.budget,
+                    hedging=self.hedging)
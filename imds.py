@@ -0,0 +1,238 @@
+"""
+Snapshot de metadatos de EC2 (IMDS) compartido por ambas apps.
+
+- Un único token IMDSv2 reutilizado hasta su expiración (renovado por
+  un solo hilo); IMDSv1 solo si IMDS rechaza el PUT del token (403, 404,
+  405) o no lo contesta pero sí responde 200 a una lectura sin token, y
+  solo durante IMDSV1_TTL: un fallo puntual (timeout, 503) no deja el
+  proceso en IMDSv1 para siempre
+- Todos los campos se piden en paralelo
+- Los campos estáticos (instance-id, AMI, AZ...) se cachean durante la
+  vida del proceso; los dinámicos (IP pública) con un TTL corto
+- "No está en AWS" se cachea como resultado negativo durante
+  NOT_ON_AWS_TTL: un fallo transitorio de IMDS al arrancar no deja el
+  proceso sin metadatos para siempre
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from metrics import registry
+
+IMDS_BASE_URL = "http://169.254.169.254/latest"
+IMDS_TIMEOUT = 0.5  # segundos por petición
+IMDS_TOKEN_TTL = 21600  # máximo permitido por IMDSv2 (6 h)
+DYNAMIC_TTL = 60  # segundos para campos que pueden cambiar en caliente
+NOT_ON_AWS_TTL = 300  # segundos hasta volver a probar IMDS tras no responder
+IMDSV1_TTL = 300  # segundos en IMDSv1 antes de volver a pedir un token
+
+imds_latency = registry.histogram("imds_request_seconds", "Latencia de las peticiones a IMDS",
+                                 ["request"])
+
+NOT_ON_AWS_ERROR = "No está en AWS o metadatos no disponibles"
+
+# Campos que no cambian mientras vive el proceso
+STATIC_FIELDS = {
+    "instance_id": "instance-id",
+    "instance_type": "instance-type",
+    "availability_zone": "placement/availability-zone",
+    "region": "placement/region",
+    "local_ipv4": "local-ipv4",
+    "hostname": "hostname",
+    "ami_id": "ami-id"
+}
+
+# Campos dependientes de la MAC principal
+MAC_FIELDS = {
+    "vpc_id": "network/interfaces/macs/{mac}/vpc-id",
+    "subnet_id": "network/interfaces/macs/{mac}/subnet-id"
+}
+
+# Campos que pueden cambiar (p. ej. al asociar una Elastic IP)
+DYNAMIC_FIELDS = {
+    "public_ipv4": "public-ipv4"
+}
+
+
+class ImdsUnavailable(Exception):
+    """IMDS no da token ahora (throttling, timeout): se reintenta en la siguiente lectura"""
+
+
+class NotOnAws(ImdsUnavailable):
+    """El endpoint de metadatos no responde"""
+
+
+class ImdsClient:
+    """Cliente IMDS con token IMDSv2 compartido y cache de snapshot"""
+
+    def __init__(self, base_url=IMDS_BASE_URL, timeout=IMDS_TIMEOUT,
+                 dynamic_ttl=DYNAMIC_TTL, not_on_aws_ttl=NOT_ON_AWS_TTL,
+                 imdsv1_ttl=IMDSV1_TTL):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.dynamic_ttl = dynamic_ttl
+        self.not_on_aws_ttl = not_on_aws_ttl
+        self.imdsv1_ttl = imdsv1_ttl
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        # Aparte de _lock: snapshot() lo tiene tomado mientras pide campos
+        self._token_lock = threading.Lock()
+        self._token = None
+        self._token_expiry = 0
+        self._imdsv1_until = 0
+        self._not_on_aws_until = 0
+        self._static = None
+        self._dynamic = {}
+        self._dynamic_timestamp = 0
+
+    # ------------------------------------------------------------------
+    # Token IMDSv2
+    # ------------------------------------------------------------------
+
+    @property
+    def _not_on_aws(self):
+        """IMDS no respondió hace menos de not_on_aws_ttl segundos"""
+        return time.time() < self._not_on_aws_until
+
+    @property
+    def _imdsv1(self):
+        """IMDS sin tokens detectado hace menos de imdsv1_ttl segundos"""
+        return time.time() < self._imdsv1_until
+
+    def _valid_token_headers(self):
+        """Cabeceras sin pedir nada a IMDS, o None si hay que pedir token"""
+        if self._not_on_aws:
+            raise NotOnAws()
+        if self._imdsv1:
+            return {}
+        if self._token and time.time() < self._token_expiry:
+            return {"X-aws-ec2-metadata-token": self._token}
+        return None
+
+    def _token_headers(self):
+        """
+        Cabeceras con un token válido; lanza NotOnAws si no hay IMDS o
+        ImdsUnavailable si IMDS no da token ahora mismo.
+        """
+        headers = self._valid_token_headers()
+        if headers is not None:
+            return headers
+
+        # Un solo PUT aunque varios hilos vean el token caducado a la vez
+        with self._token_lock:
+            headers = self._valid_token_headers()
+            if headers is not None:
+                return headers
+            try:
+                with imds_latency.time(request="token"):
+                    response = self.session.put(
+                        f"{self.base_url}/api/token",
+                        headers={"X-aws-ec2-metadata-token-ttl-seconds": str(IMDS_TOKEN_TTL)},
+                        timeout=self.timeout
+                    )
+            except requests.exceptions.RequestException:
+                return self._probe_v1()
+
+            if response.status_code in (403, 404, 405):
+                # IMDS responde pero sin soporte de tokens
+                self._imdsv1_until = time.time() + self.imdsv1_ttl
+                return {}
+            if response.status_code != 200:
+                # 503 (throttling) u otro fallo puntual: sin token esta vez
+                raise ImdsUnavailable()
+
+            self._token = response.text
+            # Se renueva un minuto antes de que expire
+            self._token_expiry = time.time() + IMDS_TOKEN_TTL - 60
+            return {"X-aws-ec2-metadata-token": self._token}
+
+    def _probe_v1(self):
+        """
+        El PUT del token no tuvo respuesta: una lectura sin token distingue
+        "fuera de AWS" (tampoco responde), IMDSv1 (200) e IMDSv2 obligatorio
+        con un fallo puntual (401 u otro estado)
+        """
+        try:
+            with imds_latency.time(request="probe_v1"):
+                response = self.session.get(f"{self.base_url}/meta-data/", timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            self._not_on_aws_until = time.time() + self.not_on_aws_ttl
+            raise NotOnAws()
+        if response.status_code != 200:
+            raise ImdsUnavailable()
+        self._imdsv1_until = time.time() + self.imdsv1_ttl
+        return {}
+
+    # ------------------------------------------------------------------
+    # Lecturas
+    # ------------------------------------------------------------------
+
+    def get(self, path, timeout=None):
+        """GET de meta-data/<path>; devuelve el texto o None"""
+        try:
+            headers = self._token_headers()
+        except ImdsUnavailable:
+            return None
+        try:
+            with imds_latency.time(request="metadata"):
+                response = self.session.get(f"{self.base_url}/meta-data/{path}",
+                                            headers=headers,
+                                            timeout=timeout or self.timeout)
+        except requests.exceptions.RequestException:
+            return None
+        if response.status_code == 401:
+            # Token invalidado antes de tiempo, o IMDSv2 pasó a ser
+            # obligatorio estando en IMDSv1: se vuelve a pedir token
+            self._token = None
+            self._imdsv1_until = 0
+            return None
+        return response.text if response.status_code == 200 else None
+
+    def _fetch_all(self, fields):
+        """Pide todos los campos en paralelo"""
+        # Token (o detección de "fuera de AWS") antes de lanzar los hilos
+        self._token_headers()
+        with ThreadPoolExecutor(max_workers=len(fields)) as pool:
+            futures = {key: pool.submit(self.get, path) for key, path in fields.items()}
+        results = {key: f.result() for key, f in futures.items()}
+        return {key: value for key, value in results.items() if value is not None}
+
+    def _load_static(self):
+        fields = dict(STATIC_FIELDS, _macs="network/interfaces/macs/")
+        data = self._fetch_all(fields)
+        macs = data.pop("_macs", None)
+        if macs:
+            mac = macs.strip().split('\n')[0].strip('/')
+            if mac:
+                data.update(self._fetch_all({k: v.format(mac=mac) for k, v in MAC_FIELDS.items()}))
+        return data
+
+    def snapshot(self):
+        """Metadatos de la instancia; {"error": ...} si no está en AWS"""
+        if self._not_on_aws:
+            return {"error": NOT_ON_AWS_ERROR}
+
+        with self._lock:
+            try:
+                if self._static is None:
+                    static = self._load_static()
+                    if static:
+                        self._static = static
+                if time.time() - self._dynamic_timestamp >= self.dynamic_ttl:
+                    self._dynamic = self._fetch_all(DYNAMIC_FIELDS)
+                    self._dynamic_timestamp = time.time()
+            except ImdsUnavailable:
+                return {"error": NOT_ON_AWS_ERROR}
+
+            metadata = dict(self._static or {}, **self._dynamic)
+        return metadata if metadata else {"error": NOT_ON_AWS_ERROR}
+
+    def on_aws(self):
+        """False si IMDS no respondió hace poco (el proceso no corre en EC2)"""
+        return not self._not_on_aws
+
+
+# Instancia compartida por ambas apps
+imds = ImdsClient()
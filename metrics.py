@@ -0,0 +1,256 @@
+"""
+Métricas del proceso en formato de exposición de Prometheus (texto).
+
+Registro mínimo sin dependencias: Counter, Gauge e Histogram con
+etiquetas, más métricas "callback" que se calculan al hacer scrape a
+partir de las estadísticas que ya llevan otros módulos (caches,
+coalescer, scheduler). render() genera el texto de /metrics.
+
+Los incrementos van bajo un lock por métrica; nada se actualiza por
+token: ChatTimer solo suma un entero por token y publica todo al cerrar
+la respuesta.
+"""
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Latencias en segundos: de llamadas HTTP rápidas (IMDS) a generaciones largas
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 100)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {sorted(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}"
+                for k, v in sorted(values.items())]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Cuentas por bucket (no acumuladas), suma y total
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observa la duración del bloque (también si lanza una excepción)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        with self._lock:
+            values = {k: (list(s[0]), s[1], s[2]) for k, s in self._values.items()}
+        lines = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(round(total, 6))}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """Counter/gauge calculado al hacer scrape: fn() -> {(valores de etiquetas): valor}"""
+
+    def __init__(self, name, help, labelnames, fn, type="gauge"):
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self.fn = fn
+
+    def render(self):
+        try:
+            values = self.fn()
+        except Exception as e:
+            return [f"# {self.name} unavailable: {_escape(e)}"]
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}"
+                for k, v in sorted(values.items())]
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # Mismo módulo importado por las dos apps: se reutiliza
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name, help, labelnames, fn, type="gauge"):
+        """Sustituye al callback anterior con el mismo nombre (la app lo registra al crearse)"""
+        metric = CallbackMetric(name, help, labelnames, fn, type)
+        with self._lock:
+            self._metrics[name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# ==================================================================
+# MÉTRICAS DEL PIPELINE DE CHAT (compartidas por las dos apps)
+# ==================================================================
+
+chat_ttft = registry.histogram(
+    "chat_time_to_first_token_seconds",
+    "Desde que llega /api/chat hasta el primer token enviado (cola, guard y contexto incluidos)",
+    ["source"])
+chat_duration = registry.histogram(
+    "chat_generation_seconds", "Duración total de las respuestas completas de /api/chat", ["source"])
+chat_tokens = registry.counter(
+    "chat_tokens_streamed_total", "Tokens enviados a los clientes por SSE", ["source"])
+chat_tokens_per_second = registry.histogram(
+    "chat_tokens_per_second", "Tokens por segundo de cada generación desde el primer token",
+    ["source"], buckets=RATE_BUCKETS)
+blocked_prompts = registry.counter(
+    "chat_blocked_prompts_total", "Prompts o respuestas bloqueados, por mecanismo", ["path"])
+guardtrail_latency = registry.histogram(
+    "guardtrail_request_seconds", "Latencia de las verificaciones de GuardTrail (sin cache)",
+    ["direction"])
+
+
+class ChatTimer:
+    """
+    Tiempos de una respuesta de /api/chat. token() por token (un entero
+    y una comparación); close() publica las métricas una sola vez.
+
+    source: "ollama", "cache" (respuesta cacheada) o "canned" (mensaje fijo)
+    """
+
+    def __init__(self, source="ollama"):
+        self.source = source
+        self.started = time.monotonic()
+        self.first_token_at = None
+        self.tokens = 0
+        self.completed = False
+        self._closed = False
+
+    def token(self, count=1):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        self.tokens += count
+
+    def done(self):
+        """La respuesta terminó entera (no cancelada ni con error)"""
+        self.completed = True
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        now = time.monotonic()
+        if self.tokens:
+            chat_tokens.inc(self.tokens, source=self.source)
+        if self.first_token_at is not None:
+            chat_ttft.observe(self.first_token_at - self.started, source=self.source)
+        if self.completed:
+            chat_duration.observe(now - self.started, source=self.source)
+            streaming = now - self.first_token_at if self.first_token_at is not None else 0
+            # Cache y mensajes fijos se envían de golpe: su ritmo no dice nada
+            if self.source == "ollama" and self.tokens > 1 and streaming > 0:
+                chat_tokens_per_second.observe(self.tokens / streaming, source=self.source)
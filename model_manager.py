@@ -0,0 +1,206 @@
+"""
+Ciclo de vida del modelo en los servidores Ollama.
+
+Ollama descarga el modelo tras OLLAMA_KEEP_ALIVE sin uso (5m en run.sh)
+y el siguiente chat paga la carga desde disco antes del primer token.
+
+- preload() carga el modelo en cada backend al arrancar (generate sin
+  prompt); la app no se declara lista (/api/ready) hasta tenerlo
+- Mientras se espera tráfico (hubo chats en los últimos
+  MODEL_WARM_WINDOW segundos) un hilo renueva el keep_alive cada
+  MODEL_REFRESH_INTERVAL segundos, y vuelve a cargarlo donde falte
+- Estado de carga por backend y último tiempo de carga medido
+- Las generaciones cuyo load_duration supera COLD_START_THRESHOLD_MS se
+  registran como cold starts
+"""
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+
+from app_log import get_logger
+from ollama_options import options_planner
+from ollama_pool import ollama_pool, model_name
+
+log = get_logger("model")
+
+MODEL_KEEP_ALIVE = os.environ.get("MODEL_KEEP_ALIVE", "30m")
+MODEL_REFRESH_INTERVAL = float(os.environ.get("MODEL_REFRESH_INTERVAL", "240"))
+MODEL_WARM_WINDOW = float(os.environ.get("MODEL_WARM_WINDOW", "3600"))
+COLD_START_THRESHOLD_MS = float(os.environ.get("COLD_START_THRESHOLD_MS", "500"))
+# Cargar un modelo desde disco puede llevar minutos en CPU
+MODEL_LOAD_TIMEOUT = 600
+# Reintento de la carga mientras la app no está lista (Ollama caído al arrancar)
+MODEL_RETRY_INTERVAL = 10
+COLD_START_HISTORY = 50
+
+
+def _ms(nanoseconds):
+    return round(nanoseconds / 1e6, 1) if nanoseconds else 0.0
+
+
+class ModelManager:
+
+    def __init__(self, model, pool=ollama_pool, planner=options_planner, keep_alive=MODEL_KEEP_ALIVE,
+                 refresh_interval=MODEL_REFRESH_INTERVAL, warm_window=MODEL_WARM_WINDOW,
+                 cold_start_ms=COLD_START_THRESHOLD_MS):
+        self.model = model
+        self.pool = pool
+        self.planner = planner
+        self.keep_alive = keep_alive
+        self.refresh_interval = refresh_interval
+        self.warm_window = warm_window
+        self.cold_start_ms = cold_start_ms
+        self.ready = False
+        self._session = requests.Session()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_activity = 0.0
+        # url -> estado del modelo en ese backend
+        self._backends = {b.url: {"state": "cold", "last_load_ms": None, "loaded_at": None,
+                                  "last_refresh": None, "last_error": None}
+                          for b in pool.backends}
+        self._cold_starts = deque(maxlen=COLD_START_HISTORY)
+        self._counters = {"loads": 0, "refreshes": 0, "load_errors": 0,
+                          "generations": 0, "cold_starts": 0}
+
+    # ------------------------------------------------------------------
+    # Carga y keep-alive
+    # ------------------------------------------------------------------
+
+    def preload(self):
+        """Carga el modelo en todos los backends a la vez; bloquea hasta terminar"""
+        threads = [threading.Thread(target=self._load, args=(b,), daemon=True)
+                   for b in self.pool.backends]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._update_ready()
+        log.info("%s preload finished, ready=%s", self.model, self.ready)
+
+    def _load(self, backend):
+        """
+        generate sin prompt: carga el modelo si no estaba y renueva su
+        keep_alive. Devuelve el tiempo de carga en ms (0 si ya estaba).
+        Lleva las options del planner: con otras, Ollama recargaría el
+        modelo en la siguiente generación
+        """
+        state = self._backends[backend.url]
+        was_warm = state["state"] == "warm"
+        with self._lock:
+            if not was_warm:
+                state["state"] = "loading"
+        started = time.monotonic()
+        try:
+            response = self._session.post(f"{backend.url}/api/generate",
+                                          json={"model": self.model, "keep_alive": self.keep_alive,
+                                                "options": self.planner.runner_options()},
+                                          timeout=(3, MODEL_LOAD_TIMEOUT))
+            response.raise_for_status()
+            load_duration = response.json().get("load_duration")
+        except (requests.RequestException, ValueError) as e:
+            with self._lock:
+                state["state"] = "cold"
+                state["last_error"] = str(e)
+                self._counters["load_errors"] += 1
+            log.warning("Could not load %s on %s: %s", self.model, backend.url, e)
+            return None
+
+        # Versiones sin load_duration: tiempo total de la petición
+        if load_duration is None:
+            load_ms = round((time.monotonic() - started) * 1000, 1)
+        else:
+            load_ms = _ms(load_duration)
+        with self._lock:
+            now = time.time()
+            state["last_refresh"] = now
+            state["last_error"] = None
+            if not was_warm or load_ms >= self.cold_start_ms:
+                # Si el modelo no estaba cargado, la petición incluye la carga
+                state["last_load_ms"] = load_ms
+                state["loaded_at"] = now
+                self._counters["loads"] += 1
+            else:
+                self._counters["refreshes"] += 1
+            state["state"] = "warm"
+        return load_ms
+
+    def touch(self):
+        """Hubo un chat: se espera más tráfico y el modelo debe seguir cargado"""
+        self._last_activity = time.time()
+
+    def start(self):
+        """Arranca el hilo de keep-alive (idempotente)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="model-keepalive", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_interval if self.ready else MODEL_RETRY_INTERVAL)
+            self._sync_with_probes()
+            expecting_traffic = time.time() - self._last_activity < self.warm_window
+            for backend in self.pool.backends:
+                if not backend.healthy:
+                    continue
+                # Sin tráfico solo se recupera lo que se cargó al arrancar y se perdió
+                if expecting_traffic or self._backends[backend.url]["state"] != "warm" or not self.ready:
+                    self._load(backend)
+            self._update_ready()
+
+    def _sync_with_probes(self):
+        """Ollama pudo descargar el modelo (keep_alive vencido, reinicio): /api/ps lo dice"""
+        name = model_name(self.model)
+        with self._lock:
+            for backend in self.pool.backends:
+                state = self._backends[backend.url]
+                probed_after_load = (backend.last_probe or 0) > (state["loaded_at"] or 0)
+                if state["state"] == "warm" and probed_after_load and name not in backend.loaded:
+                    state["state"] = "cold"
+
+    def _update_ready(self):
+        with self._lock:
+            self.ready = self.ready or any(s["state"] == "warm" for s in self._backends.values())
+
+    # ------------------------------------------------------------------
+    # Cold starts
+    # ------------------------------------------------------------------
+
+    def observe(self, backend, message):
+        """Mensaje final (done) de una generación: load_duration > umbral = cold start"""
+        load_ms = _ms(message.get("load_duration"))
+        cold = load_ms >= self.cold_start_ms
+        with self._lock:
+            self._counters["generations"] += 1
+            state = self._backends.get(backend.url)
+            if state is not None:
+                state["state"] = "warm"
+                if cold:
+                    state["last_load_ms"] = load_ms
+                    state["loaded_at"] = time.time()
+            if cold:
+                self._counters["cold_starts"] += 1
+                self._cold_starts.append({"timestamp": time.time(), "backend": backend.url,
+                                          "load_ms": load_ms})
+        if cold:
+            log.warning("Cold start on %s: %s ms loading %s", backend.url, load_ms, self.model)
+
+    # ------------------------------------------------------------------
+    # Estado
+    # ------------------------------------------------------------------
+
+    def status(self):
+        self._sync_with_probes()
+        with self._lock:
+            return dict(self._counters,
+                        model=self.model,
+                        ready=self.ready,
+                        keep_alive=self.keep_alive,
+                        expecting_traffic=time.time() - self._last_activity < self.warm_window,
+                        backends={url: dict(state) for url, state in self._backends.items()},
+                        recent_cold_starts=list(self._cold_starts))
@@ -0,0 +1,313 @@
+"""
+Cliente compartido para la API de Ollama.
+
+Usa una sola requests.Session con un pool de conexiones keep-alive
+dimensionado a OLLAMA_NUM_PARALLEL, timeouts de conexión/lectura y
+reintentos acotados en errores de conexión. AsyncOllamaClient ofrece
+lo mismo sobre httpx para el modo ASGI.
+
+El servidor de cada petición lo elige OllamaPool (ver ollama_pool.py);
+si no se puede conectar con uno, se prueba con el siguiente. Un
+StreamHandle permite cortar una generación desde otro hilo, también
+durante el prefill (Ollama no envía las cabeceras hasta el primer token).
+Los errores del backend (5xx, conexión caída a mitad del stream, timeouts)
+cuentan como fallo en el pool para expulsarlo; los 4xx y las cancelaciones
+del cliente no. on_done
+(backend, mensaje) recibe el mensaje final de cada generación (métricas
+de carga del modelo, ver model_manager.py).
+"""
+import json
+import os
+import socket
+import threading
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from ollama_pool import ollama_pool
+
+# Timeouts en segundos: conexión corta, lectura = tiempo máximo entre tokens
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", "3"))
+OLLAMA_READ_TIMEOUT = float(os.environ.get("OLLAMA_READ_TIMEOUT", "120"))
+OLLAMA_CONNECT_RETRIES = int(os.environ.get("OLLAMA_CONNECT_RETRIES", "2"))
+
+
+def backend_error(error):
+    """error si es un fallo del backend; None si es de la petición (4xx)"""
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is not None and status < 500:
+        return None
+    return error
+
+
+class StreamHandle:
+    """
+    Corta una generación en curso desde otro hilo (ver StreamCoalescer).
+    abort() hace shutdown del socket de la petición: el hilo que espera
+    las cabeceras o el siguiente mensaje se despierta con un error y
+    Ollama ve la desconexión.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connection = None
+        self.aborted = False
+
+    def attach(self, connection):
+        with self._lock:
+            self._connection = connection
+            aborted = self.aborted
+        if aborted:
+            self._shutdown(connection)
+
+    def detach(self):
+        """Fin del stream: la conexión vuelve al pool y ya no es de esta petición"""
+        with self._lock:
+            self._connection = None
+
+    def abort(self):
+        with self._lock:
+            self.aborted = True
+            connection = self._connection
+        if connection is not None:
+            self._shutdown(connection)
+
+    @staticmethod
+    def _shutdown(connection):
+        sock = getattr(connection, "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+# StreamHandle de la petición que está haciendo el hilo actual
+_current = threading.local()
+
+
+class _HandleMixin:
+    """Registra la conexión en el StreamHandle antes de esperar la respuesta"""
+
+    def getresponse(self, *args, **kwargs):
+        handle = getattr(_current, "handle", None)
+        if handle is not None:
+            handle.attach(self)
+        return super().getresponse(*args, **kwargs)
+
+
+class _HTTPConnection(_HandleMixin, HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_HandleMixin, HTTPSConnection):
+    pass
+
+
+class _HTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+
+class _HTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+
+class OllamaClient:
+    """Cliente HTTP con pool de conexiones para los servidores Ollama"""
+
+    def __init__(self, pool=ollama_pool, pool_size=None,
+                 connect_timeout=OLLAMA_CONNECT_TIMEOUT,
+                 read_timeout=OLLAMA_READ_TIMEOUT,
+                 retries=OLLAMA_CONNECT_RETRIES, on_done=None):
+        if pool_size is None:
+            pool_size = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+        self.pool = pool
+        self.on_done = on_done
+        self.timeout = (connect_timeout, read_timeout)
+
+        # Solo se reintentan fallos de conexión: una generación ya
+        # iniciada nunca se repite
+        retry = Retry(total=retries, connect=retries, read=0, status=0,
+                      other=0, backoff_factor=0.2, allowed_methods=None)
+        adapter = HTTPAdapter(pool_connections=len(pool.backends), pool_maxsize=pool_size,
+                              pool_block=False, max_retries=retry)
+        # Diccionario nuevo: el de urllib3 es compartido por todos los PoolManager
+        adapter.poolmanager.pool_classes_by_scheme = {"http": _HTTPConnectionPool,
+                                                      "https": _HTTPSConnectionPool}
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _request(self, method, path, model=None, route_key=None, handle=None, **kwargs):
+        """
+        Petición al backend que elija el pool, probando con otro si falla
+        la conexión. Devuelve (backend, response); el llamador libera el
+        backend con pool.release() al terminar.
+        """
+        tried = []
+        while True:
+            backend = self.pool.pick(model, route_key, exclude=tried)
+            _current.handle = handle
+            try:
+                response = self.session.request(method, f"{backend.url}{path}",
+                                                timeout=self.timeout, **kwargs)
+                return backend, response
+            except requests.ConnectionError as e:
+                if handle is not None and handle.aborted:
+                    # Cortada a propósito: ni failover ni fallo del backend
+                    self.pool.release(backend)
+                    raise
+                self.pool.release(backend, e)
+                tried.append(backend)
+                if len(tried) >= len(self.pool.backends):
+                    raise
+            except Exception as e:
+                # ReadTimeout esperando las cabeceras (prefill colgado)
+                self.pool.release(backend, backend_error(e))
+                raise
+            finally:
+                _current.handle = None
+
+    def generate_stream(self, payload, route_key=None, handle=None):
+        """
+        Itera los mensajes JSON de /api/generate en streaming.
+
+        route_key (id de la conversación) mantiene los turnos en el mismo
+        backend. La respuesta HTTP se cierra siempre al terminar (o al
+        cerrar el iterador), devolviendo la conexión al pool. handle
+        (StreamHandle) permite cortarla desde otro hilo.
+        """
+        payload = dict(payload, stream=True)
+        backend, response = self._request("POST", "/api/generate", payload.get("model"),
+                                          route_key, handle=handle, json=payload, stream=True)
+        error = None
+        try:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    message = json.loads(line)
+                    if message.get("done") and self.on_done is not None:
+                        self.on_done(backend, message)
+                    yield message
+        except Exception as e:
+            # Un corte con abort() no es culpa del backend (GeneratorExit
+            # al cerrar el iterador tampoco llega aquí)
+            if handle is None or not handle.aborted:
+                error = backend_error(e)
+            raise
+        finally:
+            if handle is not None:
+                handle.detach()
+            response.close()
+            self.pool.release(backend, error)
+
+    def tags(self):
+        """Lista de modelos disponibles (/api/tags)"""
+        backend, response = self._request("GET", "/api/tags")
+        error = None
+        try:
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            error = backend_error(e)
+            raise
+        finally:
+            self.pool.release(backend, error)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncOllamaClient:
+    """Versión asyncio del cliente (modo ASGI), sobre httpx.AsyncClient"""
+
+    def __init__(self, pool=ollama_pool, pool_size=None,
+                 connect_timeout=OLLAMA_CONNECT_TIMEOUT,
+                 read_timeout=OLLAMA_READ_TIMEOUT,
+                 retries=OLLAMA_CONNECT_RETRIES, on_done=None):
+        if pool_size is None:
+            pool_size = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+        self.pool = pool
+        self.on_done = on_done
+        self.pool_size = pool_size
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.retries = retries
+        # El AsyncClient queda ligado al event loop: se crea en el primer uso
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            # El límite de httpx es global: pool_size conexiones por backend
+            connections = self.pool_size * len(self.pool.backends)
+            limits = httpx.Limits(max_connections=connections,
+                                  max_keepalive_connections=connections)
+            # retries de httpx solo aplica a errores de conexión
+            transport = httpx.AsyncHTTPTransport(retries=self.retries, limits=limits)
+            self._client = httpx.AsyncClient(timeout=self.timeout, transport=transport)
+        return self._client
+
+    async def _send(self, method, path, model=None, route_key=None, stream=False, **kwargs):
+        """Como OllamaClient._request: (backend, response) con failover de conexión"""
+        tried = []
+        while True:
+            backend = self.pool.pick(model, route_key, exclude=tried)
+            request = self.client.build_request(method, f"{backend.url}{path}", **kwargs)
+            try:
+                return backend, await self.client.send(request, stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                self.pool.release(backend, e)
+                tried.append(backend)
+                if len(tried) >= len(self.pool.backends):
+                    raise
+            except Exception as e:
+                self.pool.release(backend, backend_error(e))
+                raise
+            except BaseException:
+                # Cancelada mientras Ollama hace el prefill
+                self.pool.release(backend)
+                raise
+
+    async def generate_stream(self, payload, route_key=None):
+        """Itera de forma asíncrona los mensajes JSON de /api/generate"""
+        payload = dict(payload, stream=True)
+        backend, response = await self._send("POST", "/api/generate", payload.get("model"),
+                                             route_key, stream=True, json=payload)
+        error = None
+        try:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line:
+                    message = json.loads(line)
+                    if message.get("done") and self.on_done is not None:
+                        self.on_done(backend, message)
+                    yield message
+        except Exception as e:
+            # CancelledError/GeneratorExit (cliente que se va) no llegan aquí
+            error = backend_error(e)
+            raise
+        finally:
+            await response.aclose()
+            self.pool.release(backend, error)
+
+    async def tags(self):
+        backend, response = await self._send("GET", "/api/tags")
+        error = None
+        try:
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            error = backend_error(e)
+            raise
+        finally:
+            self.pool.release(backend, error)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
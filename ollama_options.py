@@ -0,0 +1,160 @@
+"""
+Elección de las options de Ollama (num_ctx, num_thread) por petición.
+
+- num_ctx: el bucket más pequeño de OLLAMA_CTX_BUCKETS donde caben el
+  prompt (estimado), el context de la sesión (exacto) y la respuesta
+  (OLLAMA_RESPONSE_TOKENS)
+- num_thread: núcleos físicos del host, dejando OLLAMA_RESERVED_CORES
+  para la app. OLLAMA_NUM_THREAD (run.sh) lo fija; con servidores Ollama
+  remotos no se envía y cada uno usa su valor por defecto
+
+Ollama recarga el modelo cuando cambian num_ctx o num_thread, y espera a
+que terminen las generaciones en curso. Por eso el planner nunca reduce
+num_ctx mientras hay generaciones en marcha: el bucket solo crece con la
+petición que lo necesita, y baja (al mayor que se haya necesitado en
+los últimos OLLAMA_CTX_SHRINK_AFTER segundos) cuando Ollama está libre.
+El refresco de keep_alive de model_manager.py usa las mismas options,
+así que esa recarga ocurre fuera del camino de las peticiones.
+"""
+import math
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import psutil
+
+from app_log import get_logger
+from ollama_pool import ollama_pool
+
+log = get_logger("ollama")
+
+OLLAMA_CTX_BUCKETS = sorted(int(b) for b in os.environ.get("OLLAMA_CTX_BUCKETS",
+                                                           "1024,2048,4096,8192").split(","))
+# Bucket con el que se precarga el modelo (el num_ctx fijo de antes)
+OLLAMA_CTX_INITIAL = int(os.environ.get("OLLAMA_CTX_INITIAL", "2048"))
+OLLAMA_RESPONSE_TOKENS = int(os.environ.get("OLLAMA_RESPONSE_TOKENS", "768"))
+OLLAMA_CTX_SHRINK_AFTER = float(os.environ.get("OLLAMA_CTX_SHRINK_AFTER", "600"))
+OLLAMA_RESERVED_CORES = int(os.environ.get("OLLAMA_RESERVED_CORES", "1"))
+OLLAMA_NUM_THREAD = os.environ.get("OLLAMA_NUM_THREAD")
+
+# Estimación conservadora: el tokenizer de Llama 3 da ~4 caracteres por
+# token en inglés, menos en español, JSON e identificadores de AWS
+CHARS_PER_TOKEN = 3.0
+
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1", "0.0.0.0"}
+
+
+def estimate_tokens(text):
+    """Tokens aproximados de un texto (por exceso)"""
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def detect_threads(urls, reserved=OLLAMA_RESERVED_CORES):
+    """num_thread para los servidores Ollama, o None si no se puede saber"""
+    if OLLAMA_NUM_THREAD:
+        return int(OLLAMA_NUM_THREAD)
+    if not all(urlparse(url).hostname in LOCAL_HOSTS for url in urls):
+        return None
+    # llama.cpp rinde mejor con un hilo por núcleo físico
+    cores = psutil.cpu_count(logical=False) or psutil.cpu_count() or 1
+    return max(1, cores - reserved)
+
+
+class OptionsPlanner:
+
+    def __init__(self, pool=ollama_pool, buckets=OLLAMA_CTX_BUCKETS,
+                 initial_ctx=OLLAMA_CTX_INITIAL, response_tokens=OLLAMA_RESPONSE_TOKENS,
+                 shrink_after=OLLAMA_CTX_SHRINK_AFTER, num_thread=None):
+        self.pool = pool
+        self.buckets = buckets
+        self.response_tokens = response_tokens
+        self.shrink_after = shrink_after
+        self.num_thread = num_thread or detect_threads([b.url for b in pool.backends])
+        self._lock = threading.Lock()
+        # num_ctx con el que está (o estará) cargado el modelo
+        self._num_ctx = initial_ctx
+        # bucket -> última vez que una petición lo necesitó
+        self._last_needed = {}
+        self._counters = {"planned": 0, "grown": 0, "shrunk": 0, "truncated": 0}
+
+    def bucket_for(self, tokens):
+        """Bucket más pequeño para tokens de prompt + la respuesta"""
+        needed = tokens + self.response_tokens
+        for bucket in self.buckets:
+            if bucket >= needed:
+                return bucket
+        return self.buckets[-1]
+
+    @property
+    def num_ctx(self):
+        """num_ctx con el que está (o estará) cargado el modelo"""
+        return self._num_ctx
+
+    def running(self):
+        """Generaciones en curso en los servidores Ollama"""
+        return sum(b.outstanding for b in self.pool.backends)
+
+    def plan(self, payload):
+        """
+        Pone num_ctx y num_thread en payload["options"] según el prompt y
+        el context de la sesión. Devuelve el payload.
+        """
+        tokens = estimate_tokens(payload.get("prompt")) + len(payload.get("context") or [])
+        needed = self.bucket_for(tokens)
+        # Ni el bucket mayor alcanza: Ollama recortará el principio del prompt
+        truncated = tokens + self.response_tokens > needed
+        if truncated:
+            log.warning("Prompt of ~%s tokens does not fit in num_ctx=%s", tokens, needed)
+        now = time.time()
+        with self._lock:
+            self._counters["planned"] += 1
+            if truncated:
+                self._counters["truncated"] += 1
+            self._last_needed[needed] = now
+            # Nunca se reduce aquí: la recarga la pagaría esta petición
+            if needed > self._num_ctx:
+                self._num_ctx = needed
+                self._counters["grown"] += 1
+            num_ctx = self._num_ctx
+        options = dict(payload.get("options") or {}, num_ctx=num_ctx)
+        if self.num_thread:
+            options["num_thread"] = self.num_thread
+        payload["options"] = options
+        return payload
+
+    def _shrink(self):
+        """Baja al mayor bucket que se ha necesitado últimamente (con el lock)"""
+        now = time.time()
+        target = max((bucket for bucket, last in self._last_needed.items()
+                      if now - last <= self.shrink_after), default=self.bucket_for(0))
+        if target < self._num_ctx:
+            self._num_ctx = target
+            self._counters["shrunk"] += 1
+
+    def runner_options(self):
+        """
+        Options con las que cargar el modelo (precarga y keep_alive). Si
+        Ollama está libre aprovecha para reducir num_ctx.
+        """
+        with self._lock:
+            if self.running() == 0:
+                self._shrink()
+            options = {"num_ctx": self._num_ctx}
+        if self.num_thread:
+            options["num_thread"] = self.num_thread
+        return options
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters,
+                        num_ctx=self._num_ctx,
+                        num_thread=self.num_thread,
+                        buckets=self.buckets,
+                        response_tokens=self.response_tokens)
+
+
+# Compartido por las dos apps y model_manager.py
+options_planner = OptionsPlanner()
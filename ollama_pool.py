@@ -0,0 +1,203 @@
+"""
+Pool de servidores Ollama con balanceo y health checks.
+
+OLLAMA_HOSTS es la lista de servidores separada por comas (por defecto
+solo OLLAMA_HOST_URL):
+
+- Cada generación va al backend sano con menos peticiones en curso; a
+  igualdad, al que ya tiene el modelo cargado (/api/ps) y después por
+  turnos
+- Una conversación se queda en el mismo backend (sticky por session_id)
+  para que Ollama reutilice el KV cache de los turnos anteriores
+- Un hilo consulta /api/tags y /api/ps de cada backend cada
+  OLLAMA_PROBE_INTERVAL segundos. Tras OLLAMA_EJECT_AFTER fallos
+  seguidos (sondeos o conexiones) el backend sale del reparto, y vuelve
+  en cuanto un sondeo responde
+"""
+import os
+import threading
+import time
+
+import requests
+
+from app_log import get_logger
+from session_store import SESSION_IDLE_TIMEOUT, SESSION_MAX_COUNT
+from ttl_cache import TTLCache
+
+log = get_logger("ollama")
+
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST_URL", "http://localhost:11434")
+OLLAMA_HOSTS = [h.strip().rstrip('/') for h in os.environ.get("OLLAMA_HOSTS", OLLAMA_HOST).split(",")
+                if h.strip()]
+OLLAMA_PROBE_INTERVAL = float(os.environ.get("OLLAMA_PROBE_INTERVAL", "5"))
+OLLAMA_PROBE_TIMEOUT = float(os.environ.get("OLLAMA_PROBE_TIMEOUT", "2"))
+OLLAMA_EJECT_AFTER = int(os.environ.get("OLLAMA_EJECT_AFTER", "2"))
+
+
+def model_name(name):
+    """Nombre como lo lista Ollama: sin tag explícito es ':latest'"""
+    return name if ":" in name else f"{name}:latest"
+
+
+class OllamaBackend:
+    """Estado de un servidor Ollama"""
+
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True  # hasta que un sondeo o una conexión digan lo contrario
+        self.outstanding = 0
+        self.failures = 0  # fallos consecutivos
+        self.models = set()  # disponibles (/api/tags)
+        self.loaded = set()  # en memoria (/api/ps)
+        self.last_probe = None
+        self.last_error = None
+        self.counters = {"requests": 0, "errors": 0, "ejections": 0}
+
+    def status(self):
+        return dict(self.counters,
+                    url=self.url,
+                    healthy=self.healthy,
+                    outstanding=self.outstanding,
+                    consecutive_failures=self.failures,
+                    models=sorted(self.models),
+                    loaded=sorted(self.loaded),
+                    last_probe=self.last_probe,
+                    last_error=self.last_error)
+
+
+class OllamaPool:
+
+    def __init__(self, urls=OLLAMA_HOSTS, probe_interval=OLLAMA_PROBE_INTERVAL,
+                 probe_timeout=OLLAMA_PROBE_TIMEOUT, eject_after=OLLAMA_EJECT_AFTER,
+                 sticky_ttl=SESSION_IDLE_TIMEOUT):
+        self.backends = [OllamaBackend(url) for url in urls]
+        self._by_url = {b.url: b for b in self.backends}
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.eject_after = eject_after
+        # session_id -> url del backend; caduca con la sesión
+        self._sticky = TTLCache("ollama_sticky", ttl=sticky_ttl, max_entries=SESSION_MAX_COUNT)
+        self._lock = threading.Lock()
+        self._turn = 0
+        self._session = requests.Session()
+        self._thread = None
+
+    def start(self):
+        """Arranca el hilo de sondeo (idempotente)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="ollama-probe", daemon=True)
+            self._thread.start()
+
+    # ------------------------------------------------------------------
+    # Reparto
+    # ------------------------------------------------------------------
+
+    def pick(self, model=None, route_key=None, exclude=()):
+        """
+        Backend para una petición (cuenta como en curso hasta release()).
+        Si no queda ninguno sano se usa igualmente el menos cargado.
+        """
+        sticky_url = self._sticky.get(route_key) if route_key else None
+        with self._lock:
+            backend = self._by_url.get(sticky_url)
+            if backend is None or not backend.healthy or backend in exclude:
+                backend = self._least_outstanding(model, exclude)
+            backend.outstanding += 1
+            backend.counters["requests"] += 1
+        if route_key and backend.url != sticky_url:
+            self._sticky.set(route_key, backend.url)
+        return backend
+
+    def _least_outstanding(self, model, exclude):
+        candidates = [b for b in self.backends if b not in exclude] or self.backends
+        candidates = [b for b in candidates if b.healthy] or candidates
+        if model:
+            name = model_name(model)
+            # Sin /api/tags todavía se asume que lo tiene
+            candidates = [b for b in candidates if not b.models or name in b.models] or candidates
+        self._turn += 1
+        count = len(self.backends)
+        return min(candidates, key=lambda b: (
+            b.outstanding,
+            bool(model) and model_name(model) not in b.loaded,
+            (self.backends.index(b) - self._turn) % count
+        ))
+
+    def release(self, backend, error=None):
+        """Fin de la petición; error = fallo de conexión con el backend"""
+        with self._lock:
+            backend.outstanding -= 1
+        if error is None:
+            self.record_success(backend)
+        else:
+            self.record_failure(backend, error)
+
+    def forget(self, route_key):
+        """La conversación terminó: ya no hace falta mantenerla en su backend"""
+        if route_key:
+            self._sticky.invalidate(route_key)
+
+    # ------------------------------------------------------------------
+    # Salud
+    # ------------------------------------------------------------------
+
+    def record_success(self, backend):
+        with self._lock:
+            backend.failures = 0
+            readmitted = not backend.healthy
+            backend.healthy = True
+        if readmitted:
+            log.info("Backend %s readmitted", backend.url)
+
+    def record_failure(self, backend, error):
+        with self._lock:
+            backend.failures += 1
+            backend.counters["errors"] += 1
+            backend.last_error = str(error)
+            ejected = backend.healthy and backend.failures >= self.eject_after
+            if ejected:
+                backend.healthy = False
+                backend.counters["ejections"] += 1
+        if ejected:
+            log.warning("Backend %s ejected: %s", backend.url, error)
+
+    def probe(self, backend):
+        """Consulta /api/tags (salud y modelos) y /api/ps (modelos cargados)"""
+        try:
+            response = self._session.get(f"{backend.url}/api/tags", timeout=self.probe_timeout)
+            response.raise_for_status()
+            models = {m.get("name") for m in response.json().get("models", [])}
+            # /api/ps no existe en versiones antiguas de Ollama: no es un fallo
+            response = self._session.get(f"{backend.url}/api/ps", timeout=self.probe_timeout)
+            loaded = {m.get("name") for m in response.json().get("models", [])} if response.ok else set()
+        except (requests.RequestException, ValueError) as e:
+            self.record_failure(backend, e)
+            return False
+        with self._lock:
+            backend.models = models
+            backend.loaded = loaded
+            backend.last_probe = time.time()
+        self.record_success(backend)
+        return True
+
+    def _run(self):
+        while True:
+            for backend in self.backends:
+                self.probe(backend)
+            time.sleep(self.probe_interval)
+
+    def stats(self):
+        with self._lock:
+            backends = [b.status() for b in self.backends]
+        return {
+            "backends": backends,
+            "healthy": sum(1 for b in backends if b["healthy"]),
+            "probe_interval": self.probe_interval,
+            "sticky_sessions": self._sticky.stats()
+        }
+
+
+# Instancia compartida por los clientes sync y async
+ollama_pool = OllamaPool()
@@ -0,0 +1,163 @@
+"""
+Validación incremental de la respuesta del LLM mientras se genera.
+
+La salida se parte en ventanas solapadas (por número de tokens o al
+cerrar una frase) que se envían a GuardTrail en paralelo mientras los
+tokens siguen llegando. En cuanto una ventana vuelve como Block el
+llamador corta el stream de Ollama.
+
+Los tokens se retienen hasta tener veredicto: verified() solo entrega
+los que ya pasaron por una ventana Allow (y todas las anteriores) y no
+van a repetirse en el solape de la siguiente. Un Block nunca llega al
+cliente, a cambio de que el texto salga por ventanas, con la latencia de
+GuardTrail, y no token a token; mientras tanto Ollama sigue generando y
+lo retenido crece con lo que adelante a los veredictos.
+"""
+import asyncio
+import os
+from collections import deque
+
+OUTPUT_GUARD_WINDOW_TOKENS = int(os.environ.get("OUTPUT_GUARD_WINDOW_TOKENS", "48"))
+OUTPUT_GUARD_OVERLAP_TOKENS = int(os.environ.get("OUTPUT_GUARD_OVERLAP_TOKENS", "12"))
+# Mínimo de tokens nuevos para cerrar una ventana en fin de frase
+OUTPUT_GUARD_MIN_SENTENCE_TOKENS = 16
+
+SENTENCE_ENDINGS = ('.', '!', '?', '\n')
+
+
+class OutputWindows:
+    """Divide el stream de tokens en ventanas solapadas de tamaño acotado"""
+
+    def __init__(self, window_tokens=OUTPUT_GUARD_WINDOW_TOKENS,
+                 overlap_tokens=OUTPUT_GUARD_OVERLAP_TOKENS):
+        self.overlap = min(overlap_tokens, window_tokens - 1)
+        self.stride = window_tokens - self.overlap
+        self._tokens = deque(maxlen=window_tokens)
+        self._new = 0  # tokens todavía no incluidos en ninguna ventana
+
+    def _window(self):
+        size = min(len(self._tokens), self._new + self.overlap)
+        self._new = 0
+        return "".join(list(self._tokens)[-size:])
+
+    def add(self, token):
+        """Añade un token; devuelve el texto de la ventana si se cierra una"""
+        self._tokens.append(token)
+        self._new += 1
+        if self._new >= self.stride:
+            return self._window()
+        if self._new >= OUTPUT_GUARD_MIN_SENTENCE_TOKENS and token.rstrip(' ').endswith(SENTENCE_ENDINGS):
+            return self._window()
+        return None
+
+    def flush(self):
+        """Ventana final con los tokens pendientes (o None)"""
+        return self._window() if self._new else None
+
+
+def _is_block(result):
+    return result.get("action") == "Block"
+
+
+class _GuardedOutput:
+    """Ventanas pendientes de veredicto y tokens retenidos hasta tenerlo"""
+
+    def __init__(self, windows=None):
+        self.windows = windows or OutputWindows()
+        self._pending = deque()  # (future, tokens que libera su Allow), en orden
+        self._held = deque()
+        self._fed = 0
+        self._released = 0
+        self._safe = 0  # tokens ya verificados
+        self.windows_checked = 0
+
+    def feed(self, token):
+        self._held.append(token)
+        self._fed += 1
+        window = self.windows.add(token)
+        if window is not None:
+            # El solape vuelve a ir en la siguiente ventana: se retiene
+            self._submit(window, self._fed - self.windows.overlap)
+
+    def _submit(self, text, safe):
+        self._pending.append((self._verify(text), safe))
+        self.windows_checked += 1
+
+    def blocked(self):
+        """Resultado Block de alguna ventana ya verificada, o None"""
+        for future, _ in self._pending:
+            if future.done() and _is_block(future.result()):
+                return future.result()
+        # Los Allow liberan tokens en orden: una ventana posterior no
+        # cubre los tokens de una anterior que sigue pendiente
+        while self._pending and self._pending[0][0].done():
+            _, safe = self._pending.popleft()
+            self._safe = max(self._safe, safe)
+        return None
+
+    def verified(self):
+        """Tokens ya validados que pueden enviarse al cliente (se entregan una vez)"""
+        tokens = []
+        while self._released < self._safe:
+            tokens.append(self._held.popleft())
+            self._released += 1
+        return tokens
+
+    def _flush(self):
+        window = self.windows.flush()
+        if window is not None:
+            self._submit(window, self._fed)
+
+    def _all_allowed(self):
+        self._pending.clear()
+        self._safe = self._fed
+
+    def cancel(self):
+        for future, _ in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._held.clear()
+
+
+class StreamingOutputGuard(_GuardedOutput):
+    """Versión con hilos: guard_fn se ejecuta en un ThreadPoolExecutor"""
+
+    def __init__(self, guard_fn, executor, windows=None):
+        super().__init__(windows)
+        self.guard_fn = guard_fn
+        self.executor = executor
+
+    def _verify(self, text):
+        return self.executor.submit(self.guard_fn, text)
+
+    def finish(self):
+        """Verifica el final de la respuesta y espera todas las ventanas"""
+        self._flush()
+        for future, _ in self._pending:
+            result = future.result()
+            if _is_block(result):
+                self.cancel()
+                return result
+        self._all_allowed()
+        return None
+
+
+class AsyncStreamingOutputGuard(_GuardedOutput):
+    """Versión asyncio: cada ventana es una task con guard_fn (corrutina)"""
+
+    def __init__(self, guard_fn, windows=None):
+        super().__init__(windows)
+        self.guard_fn = guard_fn
+
+    def _verify(self, text):
+        return asyncio.ensure_future(self.guard_fn(text))
+
+    async def finish(self):
+        self._flush()
+        for task, _ in self._pending:
+            result = await task
+            if _is_block(result):
+                self.cancel()
+                return result
+        self._all_allowed()
+        return None
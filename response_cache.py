@@ -0,0 +1,183 @@
+"""
+Cache de respuestas del LLM por coincidencia exacta.
+
+La clave es un hash de (modelo, prompt final, options): el mismo prompt
+con los mismos parámetros devuelve la misma secuencia de tokens, que se
+reproduce por SSE con los mismos eventos `token`/`done` que una
+generación real. También se guarda el `context` final de Ollama para
+poder continuar una sesión desde una respuesta cacheada.
+
+- En memoria: LRU acotada por bytes, con TTL
+- En disco (opcional, RESPONSE_CACHE_DIR): un JSON por clave, para que
+  las entradas sobrevivan a un reinicio
+- Los prompts con contexto del sistema (métricas en vivo, credenciales)
+  o con historial de sesión no se cachean: ver prompt_is_cacheable()
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+from app_log import get_logger
+from ttl_cache import TTLCache
+
+log = get_logger("cache")
+
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "600"))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ENTRIES = 4096
+# Directorio para persistir entradas ("" = solo memoria)
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR", "")
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_DISK_MAX_BYTES", str(64 * 1024 * 1024)))
+# Options del runner que elige ollama_options.py según la carga: no
+# cambian la respuesta mientras el prompt quepa en num_ctx
+RUNNER_OPTIONS = ("num_ctx", "num_thread")
+
+
+def _entry_size(entry):
+    """Memoria aproximada de los tokens y el context de una entrada"""
+    tokens = entry["tokens"]
+    size = sys.getsizeof(tokens) + sum(sys.getsizeof(t) for t in tokens)
+    if entry.get("context"):
+        size += sys.getsizeof(entry["context"]) + 28 * len(entry["context"])
+    return size
+
+
+def prompt_is_cacheable(user_message, payload):
+    """
+    Solo prompts sin contexto del sistema ni historial de sesión: el
+    contexto lleva métricas en vivo y credenciales, y una respuesta
+    cacheada quedaría obsoleta (y escribiría secretos a disco).
+    """
+    return payload["prompt"] == user_message and not payload.get("context")
+
+
+class ResponseCache:
+
+    def __init__(self, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_MAX_BYTES,
+                 disk_dir=RESPONSE_CACHE_DIR, disk_max_bytes=RESPONSE_CACHE_DISK_MAX_BYTES,
+                 enabled=RESPONSE_CACHE_ENABLED):
+        self.ttl = ttl
+        self.enabled = enabled
+        self.cache = TTLCache("llm_responses", ttl=ttl, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                              max_bytes=max_bytes, sizeof=_entry_size)
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._lock = threading.Lock()
+        self._counters = {"disk_hits": 0, "disk_writes": 0, "disk_evictions": 0, "bypassed": 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key(payload):
+        """sha256 de (modelo, prompt, options sin las del runner)"""
+        options = {k: v for k, v in payload.get("options", {}).items() if k not in RUNNER_OPTIONS}
+        material = json.dumps({
+            "model": payload.get("model"),
+            "prompt": payload.get("prompt"),
+            "options": options
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, payload, bypass=False):
+        """
+        Entrada cacheada {"tokens": [...], "context": [...]} para payload,
+        o None (bypass: ignorar la cache)
+        """
+        if not self.enabled:
+            return None
+        if bypass:
+            with self._lock:
+                self._counters["bypassed"] += 1
+            return None
+        key = self.key(payload)
+        entry = self.cache.get(key)
+        if entry is None and self.disk_dir:
+            entry = self._disk_get(key)
+        return entry
+
+    def put(self, payload, tokens, context=None):
+        if not self.enabled or not tokens:
+            return
+        key = self.key(payload)
+        entry = {"tokens": tokens, "context": context}
+        self.cache.set(key, entry)
+        if self.disk_dir:
+            self._disk_put(key, entry, time.time() + self.ttl)
+
+    # ------------------------------------------------------------------
+    # Disco
+    # ------------------------------------------------------------------
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key + ".json")
+
+    def _disk_get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        remaining = entry.get("expires_at", 0) - time.time()
+        if remaining <= 0:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        entry = {"tokens": entry["tokens"], "context": entry.get("context")}
+        # Promocionar a memoria con el TTL que le queda
+        self.cache.set(key, entry, ttl=remaining)
+        with self._lock:
+            self._counters["disk_hits"] += 1
+        return entry
+
+    def _disk_put(self, key, entry, expires_at):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(dict(entry, expires_at=expires_at), f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.error("Error writing %s: %s", path, e)
+            return
+        with self._lock:
+            self._counters["disk_writes"] += 1
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """Borra los ficheros más antiguos si el directorio supera el límite"""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self._counters["disk_evictions"] += 1
+
+    # ------------------------------------------------------------------
+    # Estadísticas
+    # ------------------------------------------------------------------
+
+    def stats(self):
+        stats = self.cache.stats()
+        with self._lock:
+            stats.update(self._counters)
+        stats["enabled"] = self.enabled
+        stats["disk_dir"] = self.disk_dir or None
+        return stats
@@ -82,7 +82,9 @@ if command -v lsof &> /dev/null; then
     fi
 fi
 
-nohup python3 app.py > logs/app.log 2>&1 &
+# La app escribe y rota logs/app.log; stdout/stderr (trazas de arranque) van a app.out
+export LOG_FILE=logs/app.log
+nohup python3 app.py > logs/app.out 2>&1 &
 APP_PID=$!
 sleep 3
 
@@ -91,7 +93,7 @@ if ps -p $APP_PID > /dev/null 2>&1; then
     echo -e "${GREEN}✓ Application started (PID: $APP_PID)${NC}"
 else
     echo -e "${RED}✗ Error starting application${NC}"
-    echo "Check logs/app.log for details"
+    echo "Check logs/app.out for details"
     exit 1
 fi
 
@@ -56,7 +56,9 @@ fi
 
 # Run app_guardtrail.py
 echo "Starting app with AI Guard..."
-nohup python3 app_guardtrail.py > logs/app.log 2>&1 &
+# La app escribe y rota logs/app.log; stdout/stderr (trazas de arranque) van a app.out
+export LOG_FILE=logs/app.log
+nohup python3 app_guardtrail.py > logs/app.out 2>&1 &
 PID=$!
 echo $PID > logs/app.pid
 
@@ -70,5 +72,5 @@ if ps -p $PID > /dev/null; then
     echo "Stop: ./stop.sh"
 else
     echo "❌ Error starting application"
-    tail -20 logs/app.log
+    tail -20 logs/app.out
 fi
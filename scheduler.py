@@ -0,0 +1,333 @@
+"""
+Control de admisión delante de Ollama.
+
+Ollama solo atiende OLLAMA_NUM_PARALLEL generaciones a la vez; el resto
+se reparte el mismo CPU y todos los streams se ralentizan. El scheduler
+limita las generaciones simultáneas a ese número de slots y pone el
+resto en una cola acotada:
+
+- Reparto round-robin entre clientes: un cliente con muchas peticiones
+  no deja sin turno a los demás
+- Cola llena (global o por cliente): QueueFull con el Retry-After
+  estimado, que las rutas devuelven como HTTP 429
+- El llamador recibe su posición en la cola mientras espera (eventos
+  SSE `queued`)
+- Métricas de profundidad de cola y tiempos de espera/servicio
+- cancel() registra que el cliente se desconectó (en cola o generando)
+  y cuánto tardó en liberarse su slot
+
+Un Ticket representa una petición admitida. Cuando la generación pasa
+al StreamCoalescer, transfer() le entrega la liberación del slot (se
+libera al terminar la generación, no al irse un suscriptor).
+
+Las rutas solo piden ticket cuando van a lanzar una generación nueva:
+respuestas fijas, cacheadas, bloqueadas por el guard o unidas a una
+generación en curso no ocupan slot ni sitio en la cola.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+SCHEDULER_MAX_CONCURRENCY = int(os.environ.get("SCHEDULER_MAX_CONCURRENCY",
+                                               os.environ.get("OLLAMA_NUM_PARALLEL", "4")))
+SCHEDULER_MAX_QUEUE = int(os.environ.get("SCHEDULER_MAX_QUEUE", "32"))
+SCHEDULER_MAX_QUEUE_PER_CLIENT = int(os.environ.get("SCHEDULER_MAX_QUEUE_PER_CLIENT", "4"))
+# Cada cuánto se revisa la posición para el evento `queued`
+QUEUE_EVENT_INTERVAL = 1.0
+
+# Muestras para percentiles de espera y media de servicio
+METRICS_WINDOW = 500
+DEFAULT_SERVICE_SECONDS = 10.0
+
+
+class QueueFull(Exception):
+    """Cola llena: la petición se rechaza con 429 + Retry-After"""
+
+    def __init__(self, retry_after, reason="queue full"):
+        super().__init__(f"Server busy ({reason}), retry in {retry_after}s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+def _percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Ticket:
+    """Petición admitida: en cola o ejecutándose"""
+
+    def __init__(self, scheduler, client):
+        self.scheduler = scheduler
+        self.client = client
+        self.state = "queued"  # queued -> running -> done
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self._granted = threading.Event()
+        self._async_waiter = None  # (loop, future) de wait_async
+        self._transferred = False
+        self.cancelled_at = None
+
+    @property
+    def granted(self):
+        return self._granted.is_set()
+
+    def _grant(self):
+        # Llamado con el lock del scheduler
+        self.state = "running"
+        self.started_at = time.monotonic()
+        self._granted.set()
+        if self._async_waiter is not None:
+            loop, future = self._async_waiter
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+    def position(self):
+        """Posición en la cola (1 = siguiente), 0 si ya tiene slot"""
+        return self.scheduler._position(self)
+
+    # ------------------------------------------------------------------
+    # Espera
+    # ------------------------------------------------------------------
+
+    def wait(self, timeout=None):
+        return self._granted.wait(timeout)
+
+    async def wait_async(self, timeout=None):
+        if self.granted:
+            return True
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.scheduler._lock:
+            if self.granted:
+                return True
+            self._async_waiter = (loop, future)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def queue_positions(self, interval=QUEUE_EVENT_INTERVAL):
+        """
+        Genera la posición en la cola cada interval segundos hasta obtener
+        slot. Se repite aunque no cambie: escribir el evento es lo que
+        detecta que el cliente se ha ido mientras espera.
+        """
+        first = True
+        while not self.wait(0 if first else interval):
+            first = False
+            position = self.position()
+            if position:
+                yield position
+
+    async def queue_positions_async(self, interval=QUEUE_EVENT_INTERVAL):
+        first = True
+        while not await self.wait_async(0 if first else interval):
+            first = False
+            position = self.position()
+            if position:
+                yield position
+
+    # ------------------------------------------------------------------
+    # Liberación
+    # ------------------------------------------------------------------
+
+    def release(self):
+        """Libera el slot (o abandona la cola). Idempotente"""
+        self.scheduler._release(self)
+
+    def transfer(self):
+        """Cede la liberación a quien ejecuta la generación; close() deja de liberar"""
+        self._transferred = True
+        return self.release
+
+    def close(self):
+        """Fin de la petición HTTP: libera salvo que el slot se haya transferido"""
+        if not self._transferred:
+            self.release()
+
+    def cancel(self):
+        """
+        El cliente se desconectó. Libera el slot si sigue siendo de la
+        petición; si se transfirió, lo libera el fin de la generación
+        (el coalescer la corta cuando se va el último suscriptor).
+        """
+        self.scheduler._cancelled(self)
+        self.close()
+
+
+class Scheduler:
+
+    def __init__(self, max_concurrency=SCHEDULER_MAX_CONCURRENCY, max_queue=SCHEDULER_MAX_QUEUE,
+                 max_queue_per_client=SCHEDULER_MAX_QUEUE_PER_CLIENT):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_client = max_queue_per_client
+        self._lock = threading.Lock()
+        self._running = 0
+        self._queued = 0
+        self._queues = OrderedDict()  # cliente -> deque de tickets (orden de turno)
+        self._wait_times = deque(maxlen=METRICS_WINDOW)
+        self._service_times = deque(maxlen=METRICS_WINDOW)
+        # Desconexión del cliente -> slot libre
+        self._cancel_release_times = deque(maxlen=METRICS_WINDOW)
+        self._counters = {
+            "admitted": 0,
+            "queued_total": 0,
+            "rejected": 0,
+            "abandoned_in_queue": 0,
+            "completed": 0,
+            "cancelled": 0,
+            "cancelled_in_queue": 0,
+            "max_queue_depth": 0
+        }
+
+    # ------------------------------------------------------------------
+    # Admisión
+    # ------------------------------------------------------------------
+
+    def enter(self, client):
+        """Ticket con slot inmediato o en cola; QueueFull si no cabe"""
+        with self._lock:
+            ticket = Ticket(self, client)
+            if self._running < self.max_concurrency and self._queued == 0:
+                self._running += 1
+                self._counters["admitted"] += 1
+                self._wait_times.append(0.0)
+                ticket._grant()
+                return ticket
+
+            if self._queued >= self.max_queue:
+                self._counters["rejected"] += 1
+                raise QueueFull(self._retry_after(), "queue full")
+            client_queue = self._queues.get(client)
+            if client_queue is not None and len(client_queue) >= self.max_queue_per_client:
+                self._counters["rejected"] += 1
+                raise QueueFull(self._retry_after(), "too many queued requests from this client")
+
+            if client_queue is None:
+                client_queue = self._queues[client] = deque()
+            client_queue.append(ticket)
+            self._queued += 1
+            self._counters["queued_total"] += 1
+            self._counters["max_queue_depth"] = max(self._counters["max_queue_depth"], self._queued)
+            return ticket
+
+    def try_enter(self, client):
+        """Ticket solo si hay slot libre ahora mismo; None sin hacer cola ni rechazar"""
+        with self._lock:
+            if self._running >= self.max_concurrency or self._queued:
+                return None
+            ticket = Ticket(self, client)
+            self._running += 1
+            self._counters["admitted"] += 1
+            self._wait_times.append(0.0)
+            ticket._grant()
+            return ticket
+
+    def _dispatch(self):
+        """Asigna slots libres por turnos entre clientes (con el lock)"""
+        while self._running < self.max_concurrency and self._queued:
+            client, client_queue = next(iter(self._queues.items()))
+            ticket = client_queue.popleft()
+            if client_queue:
+                self._queues.move_to_end(client)
+            else:
+                del self._queues[client]
+            self._queued -= 1
+            self._running += 1
+            self._counters["admitted"] += 1
+            self._wait_times.append(time.monotonic() - ticket.enqueued_at)
+            ticket._grant()
+
+    def _cancelled(self, ticket):
+        with self._lock:
+            if ticket.cancelled_at is not None:
+                return
+            ticket.cancelled_at = time.monotonic()
+            self._counters["cancelled"] += 1
+            if ticket.state == "queued":
+                self._counters["cancelled_in_queue"] += 1
+            elif ticket.state == "done":
+                # La generación ya se había cortado y liberado el slot
+                self._cancel_release_times.append(0.0)
+
+    def _release(self, ticket):
+        with self._lock:
+            if ticket.state == "running":
+                now = time.monotonic()
+                self._running -= 1
+                if ticket.cancelled_at is not None:
+                    self._cancel_release_times.append(now - ticket.cancelled_at)
+                else:
+                    self._counters["completed"] += 1
+                    self._service_times.append(now - ticket.started_at)
+            elif ticket.state == "queued":
+                client_queue = self._queues.get(ticket.client)
+                if client_queue is not None and ticket in client_queue:
+                    client_queue.remove(ticket)
+                    if not client_queue:
+                        del self._queues[ticket.client]
+                    self._queued -= 1
+                    self._counters["abandoned_in_queue"] += 1
+            ticket.state = "done"
+            self._dispatch()
+
+    # ------------------------------------------------------------------
+    # Posición y estimaciones
+    # ------------------------------------------------------------------
+
+    def _position(self, ticket):
+        """Tickets que se atenderán antes que éste con el reparto por turnos"""
+        with self._lock:
+            if ticket.state != "queued":
+                return 0
+            own_queue = self._queues.get(ticket.client)
+            if own_queue is None or ticket not in own_queue:
+                return 0
+            index = own_queue.index(ticket)
+            ahead = index
+            before_own = True
+            for client, client_queue in self._queues.items():
+                if client == ticket.client:
+                    before_own = False
+                    continue
+                # Los clientes anteriores en el turno también pasan en la ronda actual
+                ahead += min(len(client_queue), index + (1 if before_own else 0))
+            return ahead + 1
+
+    def _avg_service(self):
+        if not self._service_times:
+            return DEFAULT_SERVICE_SECONDS
+        return sum(self._service_times) / len(self._service_times)
+
+    def _retry_after(self):
+        """Segundos estimados hasta que haya hueco en la cola (con el lock)"""
+        rounds = (self._queued + 1) / max(1, self.max_concurrency)
+        return max(1, math.ceil(self._avg_service() * rounds))
+
+    # ------------------------------------------------------------------
+    # Métricas
+    # ------------------------------------------------------------------
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queue_depth": self._queued,
+                "queued_clients": len(self._queues),
+                "wait_ms_p50": round(_percentile(self._wait_times, 0.5) * 1000, 1),
+                "wait_ms_p95": round(_percentile(self._wait_times, 0.95) * 1000, 1),
+                "wait_ms_max": round(max(self._wait_times, default=0) * 1000, 1),
+                "service_ms_avg": round(self._avg_service() * 1000, 1) if self._service_times else None,
+                "cancel_release_ms_max": round(max(self._cancel_release_times, default=0) * 1000, 1)
+            })
+        return stats
@@ -0,0 +1,99 @@
+"""
+Security groups de la instancia actual, compartido por ambas apps.
+
+En lugar de un describe_security_groups por grupo (N+1 llamadas), los
+grupos de la VPC se describen de una vez con el paginador y se cachean;
+el detalle (reglas de entrada/salida) sale de esa cache.
+"""
+import os
+
+from ttl_cache import TTLCache
+
+SG_CACHE_TTL = float(os.environ.get("SG_CACHE_TTL", "60"))
+
+
+def _group_record(group):
+    return {
+        "id": group['GroupId'],
+        "nombre": group['GroupName'],
+        "descripcion": group.get('Description', 'N/A'),
+        "vpc_id": group.get('VpcId', 'N/A'),
+        "reglas_entrada": len(group.get('IpPermissions', [])),
+        "reglas_salida": len(group.get('IpPermissionsEgress', []))
+    }
+
+
+class SecurityGroupService:
+
+    def __init__(self, client_factory, metadata_fn, ttl=SG_CACHE_TTL):
+        """
+        client_factory(region) devuelve un cliente EC2;
+        metadata_fn() devuelve los metadatos IMDS de la instancia.
+        """
+        self.client_factory = client_factory
+        self.metadata_fn = metadata_fn
+        self.cache = TTLCache("security_groups", ttl=ttl, max_entries=64)
+
+    def _attached(self, ec2, instance_id):
+        """(id, nombre) de los grupos asociados a la instancia"""
+        response = ec2.describe_instances(InstanceIds=[instance_id])
+        if not response['Reservations']:
+            return []
+        instance = response['Reservations'][0]['Instances'][0]
+        return [(sg['GroupId'], sg['GroupName']) for sg in instance.get('SecurityGroups', [])]
+
+    def _vpc_groups(self, ec2, vpc_id):
+        """Todos los grupos de la VPC en una sola consulta paginada"""
+        groups = {}
+        paginator = ec2.get_paginator('describe_security_groups')
+        for page in paginator.paginate(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}]):
+            for group in page['SecurityGroups']:
+                groups[group['GroupId']] = _group_record(group)
+        return groups
+
+    def _by_ids(self, ec2, group_ids):
+        """Un único describe_security_groups para todos los ids"""
+        response = ec2.describe_security_groups(GroupIds=list(group_ids))
+        return {g['GroupId']: _group_record(g) for g in response['SecurityGroups']}
+
+    def for_instance(self):
+        """Security groups de la instancia actual con sus conteos de reglas"""
+        try:
+            metadata = self.metadata_fn()
+            region = metadata.get('region', 'us-east-1')
+            instance_id = metadata.get('instance_id')
+            vpc_id = metadata.get('vpc_id')
+
+            if not instance_id:
+                return {"error": "No se pudo obtener el ID de instancia"}
+
+            ec2 = self.client_factory(region)
+            attached = self.cache.get_or_load(("attached", instance_id),
+                                              lambda: self._attached(ec2, instance_id))
+            attached_ids = [group_id for group_id, _ in attached]
+
+            if vpc_id:
+                details = self.cache.get_or_load(("vpc", region, vpc_id),
+                                                 lambda: self._vpc_groups(ec2, vpc_id))
+                missing = [g for g in attached_ids if g not in details]
+                if missing:
+                    # Grupo creado después de cachear la VPC: se invalida
+                    self.cache.invalidate(("vpc", region, vpc_id))
+                    details = dict(details, **self._by_ids(ec2, missing))
+            elif attached_ids:
+                key = ("ids", region) + tuple(sorted(attached_ids))
+                details = self.cache.get_or_load(key, lambda: self._by_ids(ec2, attached_ids))
+            else:
+                details = {}
+
+            security_groups = []
+            for group_id, group_name in attached:
+                record = details.get(group_id, {"id": group_id, "nombre": group_name})
+                security_groups.append(record)
+            return security_groups
+
+        except Exception as e:
+            return {"error": str(e)}
+
+    def invalidate(self):
+        self.cache.invalidate()
@@ -0,0 +1,73 @@
+"""
+Sesiones de conversación en el servidor.
+
+Cada sesión guarda el array `context` que Ollama devuelve en el mensaje
+final (`done`) de /api/generate. En el siguiente turno se envía de
+vuelta con el prompt nuevo, así Ollama conserva la conversación y solo
+evalúa los tokens nuevos en lugar de re-procesar todo el historial.
+
+- El context se guarda como array('I') (4 bytes por token)
+- Expiran tras SESSION_IDLE_TIMEOUT segundos sin un turno nuevo
+- Memoria total acotada en bytes; al superarla se descartan las
+  sesiones usadas hace más tiempo (LRU)
+"""
+import os
+import sys
+import uuid
+from array import array
+
+from ttl_cache import TTLCache
+
+SESSION_IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_TIMEOUT", "1800"))
+SESSION_MAX_BYTES = int(os.environ.get("SESSION_MAX_BYTES", str(32 * 1024 * 1024)))
+SESSION_MAX_COUNT = int(os.environ.get("SESSION_MAX_COUNT", "1000"))
+
+# Objeto de sesión + tupla + id, aparte del array
+SESSION_OVERHEAD_BYTES = 200
+
+
+def _session_size(session):
+    return sys.getsizeof(session[1]) + SESSION_OVERHEAD_BYTES
+
+
+class SessionStore:
+
+    def __init__(self, idle_timeout=SESSION_IDLE_TIMEOUT, max_bytes=SESSION_MAX_BYTES,
+                 max_count=SESSION_MAX_COUNT):
+        # Valor: (modelo, array('I') con el context de Ollama)
+        self.cache = TTLCache("chat_sessions", ttl=idle_timeout, max_entries=max_count,
+                              max_bytes=max_bytes, sizeof=_session_size)
+
+    @staticmethod
+    def new_id():
+        return uuid.uuid4().hex
+
+    def context(self, session_id, model):
+        """context de la sesión para model, o None (sin sesión, caducada u otro modelo)"""
+        if not session_id:
+            return None
+        session = self.cache.get(session_id)
+        if session is None or session[0] != model:
+            return None
+        return session[1].tolist()
+
+    def save(self, session_id, model, context):
+        """
+        Guarda el context del último turno y devuelve el id de la sesión.
+
+        Con session_id None se crea una sesión nueva; sin context (p. ej.
+        respuesta incompleta) no se guarda nada.
+        """
+        if not context:
+            return session_id
+        if not session_id:
+            session_id = self.new_id()
+        self.cache.set(session_id, (model, array("I", context)))
+        return session_id
+
+    def drop(self, session_id):
+        if session_id:
+            self.cache.invalidate(session_id)
+
+    def stats(self):
+        return self.cache.stats()
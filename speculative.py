@@ -0,0 +1,108 @@
+"""
+Generación especulativa: arranca el stream de Ollama antes de conocer el
+veredicto de GuardTrail sobre el prompt, para solapar el prefill con la
+llamada al guard.
+
+Los mensajes se acumulan en una cola y no se entregan a nadie hasta que
+el llamador empieza a iterar (solo tras un Allow). El stream se crea al
+momento (stream_factory no bloquea: ver StreamCoalescer.stream) y
+cancel() lo cierra enseguida, aunque Ollama siga en el prefill; el slot
+del scheduler lo libera el on_finish del stream al terminar la generación.
+idle_timeout funciona como en stream_coalescer.py (mensaje vacío si no
+llega nada en el plazo). Cada stream tiene su propio hilo, que vive lo
+que la generación: en un pool compartido dejaría sin hilos al resto.
+"""
+import asyncio
+import queue
+import threading
+
+_END = object()
+
+
+class SpeculativeStream:
+    """Versión con hilos: stream_factory() devuelve el iterador de Ollama"""
+
+    def __init__(self, stream_factory, idle_timeout=None):
+        self.idle_timeout = idle_timeout
+        self._queue = queue.Queue()
+        self._cancelled = threading.Event()
+        self._stream = stream_factory()
+        threading.Thread(target=self._pump, daemon=True).start()
+
+    def _pump(self):
+        try:
+            for item in self._stream:
+                if self._cancelled.is_set():
+                    break
+                self._queue.put(item)
+        except Exception as e:
+            self._queue.put(e)
+        finally:
+            self._stream.close()
+            self._queue.put(_END)
+
+    def __iter__(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle_timeout() if self.idle_timeout else None)
+            except queue.Empty:
+                yield {}
+                continue
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def cancel(self):
+        self._cancelled.set()
+        # Desde este hilo: _pump puede estar bloqueado esperando a Ollama
+        self._stream.close()
+
+    # Misma interfaz que el generador de OllamaClient
+    close = cancel
+
+
+class AsyncSpeculativeStream:
+    """Versión asyncio: stream_factory() devuelve un async iterator"""
+
+    def __init__(self, stream_factory, idle_timeout=None):
+        self.idle_timeout = idle_timeout
+        self._queue = asyncio.Queue()
+        self._stream = stream_factory()
+        self._task = asyncio.ensure_future(self._pump())
+
+    async def _pump(self):
+        try:
+            async for item in self._stream:
+                self._queue.put_nowait(item)
+        except Exception as e:
+            self._queue.put_nowait(e)
+        finally:
+            await self._stream.aclose()
+            self._queue.put_nowait(_END)
+
+    async def __aiter__(self):
+        while True:
+            if self.idle_timeout is None:
+                item = await self._queue.get()
+            else:
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), self.idle_timeout())
+                except asyncio.TimeoutError:
+                    yield {}
+                    continue
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def cancel(self):
+        self._task.cancel()
+        # También si la task no llegó a ejecutarse: el último suscriptor
+        # que se va cancela la generación
+        self._stream.close()
+
+    async def aclose(self):
+        self.cancel()
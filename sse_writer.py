@@ -0,0 +1,149 @@
+"""
+Escritura de los eventos SSE de /api/chat agrupando tokens.
+
+Antes cada token de Ollama era un frame "data: {...}\\n\\n" con su propio
+json.dumps (y los mensajes fijos se enviaban carácter a carácter): una
+escritura al socket y un evento en el navegador por token.
+
+- El primer token sale en cuanto llega (no empeora el TTFT), igual que
+  cualquier token que llegue tras SSE_FLUSH_INTERVAL_MS sin escribir
+- Los tokens que llegan más rápido se acumulan y salen juntos en un solo
+  frame {"token": "..."} cuando pasa la ventana o se juntan
+  SSE_FLUSH_BYTES caracteres, lo que ocurra antes
+- Los mensajes fijos (rechazos, respuestas cacheadas) van en un frame
+- Sin nada que enviar durante SSE_HEARTBEAT_INTERVAL segundos (carga del
+  modelo, prefill de un prompt largo) se escribe un comentario SSE
+  ": ping" para que los proxies no cierren la conexión
+
+El writer no tiene hilo propio: el bucle del chat lee el stream de Ollama
+con idle_timeout=writer.timeout (ver stream_coalescer.py), que entrega un
+mensaje vacío cuando vence el plazo, y entonces llama a tick().
+
+start_stream() ejecuta el generador de una respuesta hasta su primer
+frame antes de enviar las cabeceras: lo que lance antes (QueueFull) aún
+puede responderse con un error HTTP, como HttpError en asgi_server.py.
+"""
+import json
+import os
+import time
+
+SSE_FLUSH_INTERVAL = float(os.environ.get("SSE_FLUSH_INTERVAL_MS", "30")) / 1000
+SSE_FLUSH_BYTES = int(os.environ.get("SSE_FLUSH_BYTES", "512"))
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get("SSE_HEARTBEAT_INTERVAL", "15"))
+
+HEARTBEAT = ": ping\n\n"
+
+
+def sse_event(event):
+    """Un frame SSE con el evento como JSON"""
+    return f"data: {json.dumps(event)}\n\n"
+
+
+class _StartedStream:
+    """Frames de un generador ya arrancado; close() llega al generador"""
+
+    def __init__(self, first, generator):
+        self._first = first
+        self._generator = generator
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._first is not None:
+            first, self._first = self._first, None
+            return first
+        return next(self._generator)
+
+    def close(self):
+        self._generator.close()
+
+
+def start_stream(generator):
+    """Arranca el generador hasta su primer frame; sus excepciones llegan al llamador"""
+    try:
+        first = next(generator)
+    except StopIteration:
+        first = None
+    return _StartedStream(first, generator)
+
+
+class SseWriter:
+    """
+    Frames de una respuesta. Cada método devuelve el texto a escribir
+    ("" si no toca escribir nada todavía).
+    """
+
+    def __init__(self, interval=SSE_FLUSH_INTERVAL, max_bytes=SSE_FLUSH_BYTES,
+                 heartbeat=SSE_HEARTBEAT_INTERVAL):
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.heartbeat = heartbeat
+        self._pending = []
+        self._pending_bytes = 0
+        # Sin frames de tokens todavía: el primero sale al momento
+        self._last_flush = float("-inf")
+        self._last_write = time.monotonic()
+        self.frames = 0
+        self.tokens = 0
+
+    def token(self, text):
+        """Añade un token; devuelve el frame si toca enviarlo ya"""
+        self._pending.append(text)
+        self._pending_bytes += len(text)
+        self.tokens += 1
+        if (self._pending_bytes >= self.max_bytes
+                or time.monotonic() - self._last_flush >= self.interval):
+            return self.flush()
+        return ""
+
+    def text(self, text):
+        """Mensaje completo (respuesta fija o cacheada) en un solo frame"""
+        self.tokens += 1
+        self._pending.append(text)
+        return self.flush()
+
+    def event(self, event):
+        """Evento de control (done, error, bloqueo...) tras los tokens pendientes"""
+        return self.raw(sse_event(event))
+
+    def raw(self, frame):
+        """Frame ya formateado (sse_done, sse_queued) tras los tokens pendientes"""
+        frames = self.flush() + frame
+        self.frames += 1
+        self._last_write = time.monotonic()
+        return frames
+
+    def flush(self):
+        if not self._pending:
+            return ""
+        frame = sse_event({'token': "".join(self._pending)})
+        self._pending.clear()
+        self._pending_bytes = 0
+        self.frames += 1
+        self._last_flush = self._last_write = time.monotonic()
+        return frame
+
+    def discard(self):
+        """Descarta los tokens sin enviar (respuesta bloqueada por el guard)"""
+        self._pending.clear()
+        self._pending_bytes = 0
+
+    def timeout(self):
+        """Segundos hasta el próximo tick(): fin de la ventana o heartbeat"""
+        now = time.monotonic()
+        if self._pending:
+            return max(0.0, self._last_flush + self.interval - now)
+        return max(0.0, self._last_write + self.heartbeat - now)
+
+    def tick(self):
+        """Sin mensajes de Ollama: cierra la ventana vencida o envía un heartbeat"""
+        now = time.monotonic()
+        if self._pending:
+            if now - self._last_flush >= self.interval:
+                return self.flush()
+            return ""
+        if now - self._last_write >= self.heartbeat:
+            self._last_write = now
+            return HEARTBEAT
+        return ""
@@ -1,5 +1,7 @@
 let currentModel = 'llama3.2';
 let isStreaming = false;
+let sessionId = null;  // conversación en el servidor (context de Ollama)
+let chatAbort = null;  // cancela el stream en curso (el servidor libera su slot)
 
 // Auto-resize textarea
 const messageInput = document.getElementById('messageInput');
@@ -39,17 +41,29 @@ async function sendMessage() {
     isStreaming = true;
     updateSendButton(true);
     
+    chatAbort = new AbortController();
+    
     try {
         const response = await fetch('/api/chat', {
             method: 'POST',
+            signal: chatAbort.signal,
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ message: message })
+            body: JSON.stringify({ message: message, session_id: sessionId })
         });
         
+        // Server busy: queue is full (429 + Retry-After)
+        if (!response.ok) {
+            const body = await response.json().catch(() => ({}));
+            const retry = body.retry_after ? ` (${body.retry_after}s)` : '';
+            throw new Error((body.error || `HTTP ${response.status}`) + retry);
+        }
+        
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
+        // A frame can arrive split across reads: keep the incomplete last line
+        let buffer = '';
         let aiResponse = '';
         
         // Remove typing indicator
@@ -67,8 +81,9 @@ async function sendMessage() {
             const { done, value } = await reader.read();
             if (done) break;
             
-            const chunk = decoder.decode(value);
-            const lines = chunk.split('\n');
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
             
             for (const line of lines) {
                 if (line.startsWith('data: ')) {
@@ -94,6 +109,12 @@ async function sendMessage() {
                             break;
                         }
                         
+                        // Waiting for a free Ollama slot
+                        if (data.queued) {
+                            contentDiv.innerHTML = `<em>⏳ En cola (posición ${data.position})…</em>`;
+                            continue;
+                        }
+                        
                         if (data.token) {
                             aiResponse += data.token;
                             contentDiv.innerHTML = formatMessage(aiResponse);
@@ -101,6 +122,9 @@ async function sendMessage() {
                         }
                         
                         if (data.done) {
+                            if (data.session_id) {
+                                sessionId = data.session_id;
+                            }
                             break;
                         }
                     } catch (e) {
@@ -111,12 +135,16 @@ async function sendMessage() {
         }
         
     } catch (error) {
+        if (error.name === 'AbortError') {
+            return;
+        }
         console.error('Error:', error);
         const contentDiv = aiMessageDiv.querySelector('.message-content') || 
                           aiMessageDiv.appendChild(document.createElement('div'));
         contentDiv.className = 'message-content';
         contentDiv.innerHTML = `<span style="color: var(--trend-red-light);">Error: ${error.message}</span>`;
     } finally {
+        chatAbort = null;
         isStreaming = false;
         updateSendButton(false);
     }
@@ -205,6 +233,13 @@ function sendSuggestion(text) {
 
 // New chat
 function newChat() {
+    if (chatAbort) {
+        chatAbort.abort();
+    }
+    if (sessionId) {
+        fetch(`/api/session/${sessionId}`, { method: 'DELETE' }).catch(() => {});
+        sessionId = null;
+    }
     const messagesContainer = document.getElementById('messagesContainer');
     messagesContainer.innerHTML = `
         <div class="welcome-screen">
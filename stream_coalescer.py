@@ -0,0 +1,356 @@
+"""
+Coalescencia de generaciones idénticas en curso (single-flight de streams).
+
+Si llega un payload idéntico a otro que Ollama ya está generando, no se
+lanza una segunda generación: la nueva petición se suscribe al stream
+existente y recibe también los mensajes ya producidos. Cada suscriptor
+itera a su ritmo sobre el buffer compartido (su propio stream SSE).
+
+Cuando el último suscriptor se va, la generación se cancela y se corta
+en ese momento la petición a Ollama (también durante el prefill, sin
+esperar al siguiente mensaje); al terminar, la entrada desaparece y la
+siguiente petición igual empieza de cero (o sale de response_cache).
+on_finish (p. ej. liberar el slot del scheduler) se llama cuando termina
+la generación de Ollama, o al momento si la petición se une a una ya en
+curso y no genera nada. Los demás argumentos de stream() (route_key) se
+pasan a stream_fn; en una generación compartida mandan los de la primera.
+join() solo se une a una generación en curso (None si no la hay) y no
+tiene nada que ver con el scheduler: unirse no ocupa slot, así que las
+rutas lo intentan antes de pedir turno y solo quien no puede unirse
+entra en la cola antes de llamar a stream().
+
+Con idle_timeout (función que devuelve segundos, p. ej. SseWriter.timeout)
+el suscriptor entrega un mensaje vacío ({}) si en ese plazo no llega
+nada: el chat aprovecha para enviar tokens pendientes o un heartbeat.
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+
+from ollama_client import StreamHandle
+
+
+def payload_key(payload):
+    """sha256 del payload completo (modelo, prompt, options, context...)"""
+    material = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class _Stats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {"generations": 0, "coalesced": 0, "cancelled": 0}
+
+    def count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def snapshot(self, flights):
+        with self._lock:
+            stats = dict(self._counters)
+        stats["in_flight"] = len(flights)
+        stats["subscribers"] = sum(f.subscribers for f in list(flights.values()))
+        return stats
+
+
+# ==================================================================
+# VERSIÓN CON HILOS
+# ==================================================================
+
+class _Flight:
+    """Generación en curso: mensajes producidos hasta ahora y suscriptores"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.messages = []
+        self.finished = False
+        self.cancelled = False
+        self.error = None
+        self.subscribers = 0
+        self.on_finish = None
+        # Para cortar la petición a Ollama desde _leave()
+        self.handle = StreamHandle()
+
+
+class _Subscriber:
+    """Iterador de un suscriptor; close() lo da de baja (idempotente)"""
+
+    def __init__(self, coalescer, key, flight, idle_timeout=None):
+        self._coalescer = coalescer
+        self._key = key
+        self._flight = flight
+        self._index = 0
+        self._closed = False
+        self.idle_timeout = idle_timeout
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        flight = self._flight
+        with flight.cond:
+            deadline = None
+            if self.idle_timeout is not None:
+                deadline = time.monotonic() + self.idle_timeout()
+            while self._index >= len(flight.messages) and not flight.finished and not self._closed:
+                if deadline is None:
+                    flight.cond.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return {}
+                flight.cond.wait(remaining)
+            if not self._closed and self._index < len(flight.messages):
+                message = flight.messages[self._index]
+                self._index += 1
+                return message
+            error = flight.error
+        self.close()
+        if error is not None:
+            raise error
+        raise StopIteration
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._coalescer._leave(self._key, self._flight)
+            # Despierta a __next__ si otro hilo está esperando mensajes
+            with self._flight.cond:
+                self._flight.cond.notify_all()
+
+
+class StreamCoalescer:
+    """stream_fn(payload, **kwargs) es el generador de OllamaClient.generate_stream"""
+
+    def __init__(self, stream_fn):
+        self.stream_fn = stream_fn
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = _Stats()
+
+    def join(self, payload, idle_timeout=None):
+        """
+        Suscriptor de la generación en curso para payload, o None si no la
+        hay. Comprobar y suscribirse es atómico: la generación no puede
+        terminar entre medias y dejar a la petición generando sin turno.
+        """
+        key = payload_key(payload)
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                return None
+            flight.subscribers += 1
+        self._stats.count("coalesced")
+        return _Subscriber(self, key, flight, idle_timeout)
+
+    def stream(self, payload, on_finish=None, idle_timeout=None, **stream_kwargs):
+        """Iterador de mensajes de Ollama para payload (compartido si ya está en curso)"""
+        key = payload_key(payload)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                flight.on_finish = on_finish
+            flight.subscribers += 1
+        self._stats.count("generations" if leader else "coalesced")
+        if leader:
+            threading.Thread(target=self._pump, args=(key, flight, payload, stream_kwargs),
+                             daemon=True).start()
+        elif on_finish is not None:
+            on_finish()
+        return _Subscriber(self, key, flight, idle_timeout)
+
+    def _pump(self, key, flight, payload, stream_kwargs):
+        stream = None
+        try:
+            stream = self.stream_fn(payload, handle=flight.handle, **stream_kwargs)
+            for message in stream:
+                if flight.cancelled:
+                    break
+                with flight.cond:
+                    flight.messages.append(message)
+                    # Con 'done' la generación está completa aunque los
+                    # suscriptores se vayan antes de cerrar la respuesta
+                    flight.finished = bool(message.get("done"))
+                    flight.cond.notify_all()
+                if flight.finished:
+                    break
+        except Exception as e:
+            # Cancelada: el error es el corte de la conexión, nadie lo espera
+            if not flight.cancelled:
+                flight.error = e
+        finally:
+            if stream is not None and hasattr(stream, "close"):
+                # Cerrar la respuesta detiene la generación en Ollama
+                stream.close()
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            with flight.cond:
+                flight.finished = True
+                flight.cond.notify_all()
+            if flight.on_finish is not None:
+                flight.on_finish()
+
+    def _leave(self, key, flight):
+        with self._lock:
+            flight.subscribers -= 1
+            if flight.subscribers > 0:
+                return
+            # Último suscriptor: nadie más puede unirse a esta generación
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            abandoned = not flight.finished
+            flight.cancelled = True
+        if abandoned:
+            self._stats.count("cancelled")
+            # _pump puede estar bloqueado esperando a Ollama (prefill): el
+            # corte detiene ya la generación y libera el slot con on_finish
+            flight.handle.abort()
+
+    def stats(self):
+        with self._lock:
+            flights = dict(self._flights)
+        return self._stats.snapshot(flights)
+
+
+# ==================================================================
+# VERSIÓN ASYNCIO (modo ASGI)
+# ==================================================================
+
+class _AsyncFlight:
+
+    def __init__(self):
+        self.cond = asyncio.Condition()
+        self.messages = []
+        self.finished = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self.on_finish = None
+
+
+class _AsyncSubscriber:
+
+    def __init__(self, coalescer, key, flight, idle_timeout=None):
+        self._coalescer = coalescer
+        self._key = key
+        self._flight = flight
+        self._index = 0
+        self._closed = False
+        self.idle_timeout = idle_timeout
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        flight = self._flight
+
+        def ready():
+            return self._index < len(flight.messages) or flight.finished or self._closed
+
+        async with flight.cond:
+            if self.idle_timeout is None:
+                await flight.cond.wait_for(ready)
+            elif not ready():
+                try:
+                    await asyncio.wait_for(flight.cond.wait_for(ready), self.idle_timeout())
+                except asyncio.TimeoutError:
+                    return {}
+            if not self._closed and self._index < len(flight.messages):
+                message = flight.messages[self._index]
+                self._index += 1
+                return message
+            error = flight.error
+        self.close()
+        if error is not None:
+            raise error
+        raise StopAsyncIteration
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._coalescer._leave(self._key, self._flight)
+
+    async def aclose(self):
+        self.close()
+
+
+class AsyncStreamCoalescer:
+    """stream_fn(payload, **kwargs) es el async generator de AsyncOllamaClient.generate_stream"""
+
+    def __init__(self, stream_fn):
+        self.stream_fn = stream_fn
+        self._flights = {}
+        self._stats = _Stats()
+
+    def join(self, payload, idle_timeout=None):
+        key = payload_key(payload)
+        flight = self._flights.get(key)
+        if flight is None:
+            return None
+        flight.subscribers += 1
+        self._stats.count("coalesced")
+        return _AsyncSubscriber(self, key, flight, idle_timeout)
+
+    def stream(self, payload, on_finish=None, idle_timeout=None, **stream_kwargs):
+        key = payload_key(payload)
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = self._flights[key] = _AsyncFlight()
+            flight.on_finish = on_finish
+            flight.task = asyncio.ensure_future(self._pump(key, flight, payload, stream_kwargs))
+            # También si la task se cancela antes de empezar a ejecutarse
+            flight.task.add_done_callback(lambda _: self._done(key, flight))
+        elif on_finish is not None:
+            on_finish()
+        flight.subscribers += 1
+        self._stats.count("generations" if leader else "coalesced")
+        return _AsyncSubscriber(self, key, flight, idle_timeout)
+
+    async def _pump(self, key, flight, payload, stream_kwargs):
+        stream = self.stream_fn(payload, **stream_kwargs)
+        try:
+            async for message in stream:
+                async with flight.cond:
+                    flight.messages.append(message)
+                    flight.finished = bool(message.get("done"))
+                    flight.cond.notify_all()
+                if flight.finished:
+                    break
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            flight.error = e
+        finally:
+            await stream.aclose()
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            async with flight.cond:
+                flight.finished = True
+                flight.cond.notify_all()
+
+    def _done(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if flight.on_finish is not None:
+            flight.on_finish()
+
+    def _leave(self, key, flight):
+        flight.subscribers -= 1
+        if flight.subscribers > 0:
+            return
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not flight.finished:
+            # La cancelación de la task aborta también la petición a Ollama
+            flight.task.cancel()
+            self._stats.count("cancelled")
+
+    def stats(self):
+        return self._stats.snapshot(dict(self._flights))
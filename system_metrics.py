@@ -0,0 +1,132 @@
+"""
+Muestreo en segundo plano de métricas del sistema (CPU, RAM, disco, red).
+
+Un hilo daemon toma una muestra cada METRICS_SAMPLE_INTERVAL segundos y la
+guarda en un buffer circular; las rutas leen la última muestra sin
+bloquear (antes cpu_percent(interval=0.5) bloqueaba 500 ms por llamada).
+"""
+import os
+import platform
+import threading
+import time
+from collections import deque
+
+import psutil
+
+from app_log import get_logger
+
+log = get_logger("metrics")
+
+METRICS_SAMPLE_INTERVAL = float(os.environ.get("METRICS_SAMPLE_INTERVAL", "5"))
+METRICS_HISTORY_SIZE = int(os.environ.get("METRICS_HISTORY_SIZE", "720"))  # 1 h a 5 s
+
+# Campos numéricos resumidos en el historial
+HISTORY_FIELDS = [
+    "cpu_uso_porcentaje",
+    "ram_disponible_gb",
+    "ram_uso_porcentaje",
+    "disco_libre_gb",
+    "disco_uso_porcentaje",
+    "bytes_enviados_mb",
+    "bytes_recibidos_mb"
+]
+
+
+def _static_info():
+    """Datos que no cambian mientras vive el proceso"""
+    return {
+        "sistema_operativo": platform.system(),
+        "version_os": platform.release(),
+        "distribucion": platform.platform(),
+        "arquitectura": platform.machine(),
+        "cpu_nucleos": psutil.cpu_count(logical=False),
+        "cpu_threads": psutil.cpu_count(logical=True)
+    }
+
+
+def take_sample():
+    """Una lectura de CPU, RAM, disco y red (una llamada psutil por recurso)"""
+    vm = psutil.virtual_memory()
+    disk = psutil.disk_usage('/')
+    net = psutil.net_io_counters()
+    return {
+        "timestamp": time.time(),
+        # Sin intervalo: % de CPU desde la muestra anterior
+        "cpu_uso_porcentaje": psutil.cpu_percent(interval=None),
+        "ram_total_gb": round(vm.total / (1024**3), 2),
+        "ram_disponible_gb": round(vm.available / (1024**3), 2),
+        "ram_uso_porcentaje": vm.percent,
+        "disco_total_gb": round(disk.total / (1024**3), 2),
+        "disco_usado_gb": round(disk.used / (1024**3), 2),
+        "disco_libre_gb": round(disk.free / (1024**3), 2),
+        "disco_uso_porcentaje": disk.percent,
+        "bytes_enviados_mb": round(net.bytes_sent / (1024**2), 2),
+        "bytes_recibidos_mb": round(net.bytes_recv / (1024**2), 2),
+        "paquetes_enviados": net.packets_sent,
+        "paquetes_recibidos": net.packets_recv
+    }
+
+
+class SystemSampler:
+    """Hilo de muestreo con buffer circular de las últimas muestras"""
+
+    def __init__(self, interval=METRICS_SAMPLE_INTERVAL, history_size=METRICS_HISTORY_SIZE):
+        self.interval = interval
+        self.static = _static_info()
+        self._samples = deque(maxlen=history_size)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Arranca el hilo (idempotente)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            # La primera llamada a cpu_percent(None) solo fija la referencia
+            psutil.cpu_percent(interval=None)
+            self._thread = threading.Thread(target=self._run, name="system-sampler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                sample = take_sample()
+                with self._lock:
+                    self._samples.append(sample)
+            except Exception as e:
+                log.warning("Sampling error: %s", e)
+            time.sleep(self.interval)
+
+    def latest(self):
+        """Última muestra; si aún no hay ninguna se toma una al momento"""
+        with self._lock:
+            if self._samples:
+                return self._samples[-1]
+        return take_sample()
+
+    def history(self, minutes):
+        """Resumen min/avg/max de las muestras de los últimos N minutos"""
+        since = time.time() - minutes * 60
+        with self._lock:
+            samples = [s for s in self._samples if s["timestamp"] >= since]
+
+        summary = {}
+        for field in HISTORY_FIELDS:
+            values = [s[field] for s in samples]
+            if values:
+                summary[field] = {
+                    "min": min(values),
+                    "avg": round(sum(values) / len(values), 2),
+                    "max": max(values)
+                }
+        return {
+            "minutos": minutes,
+            "muestras": len(samples),
+            "intervalo_segundos": self.interval,
+            "resumen": summary,
+            "serie": samples
+        }
+
+
+# Instancia compartida por las rutas de la app
+system_sampler = SystemSampler()
@@ -0,0 +1,85 @@
+"""
+Microbenchmark del enrutado por keywords.
+
+Compara el método anterior (un `any(k in msg for k in lista)` por lista)
+con IntentMatcher en mensajes de distinta longitud, y con listas de
+keywords ampliadas para ver cómo escala cada uno. Antes de medir
+comprueba que ambos devuelven las mismas intenciones.
+
+    python tools/bench_intents.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from intent_matcher import INTENTS, IntentMatcher  # noqa: E402
+
+PROSE = ("Hola, me gustaría entender cómo funciona el despliegue de esta aplicación y qué "
+         "pasos debería seguir para configurar el entorno de desarrollo local. I would also "
+         "like a summary of the main design decisions and the tradeoffs that were made. ")
+
+LENGTHS = [200, 2000, 20000, 100000]
+EXTRA_KEYWORDS = [0, 200, 1000]
+REPEAT = 20
+
+
+def naive_match(intents, text):
+    """Método anterior: una pasada por lista y keyword"""
+    msg_lower = text.lower()
+    return frozenset(name for name, keywords in intents.items()
+                     if any(k.lower() in msg_lower for k in keywords))
+
+
+def synthetic_keywords(count, rng):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["zz" + "".join(rng.choice(letters) for _ in range(rng.randint(3, 10)))
+            for _ in range(count)]
+
+
+def make_message(length, rng, keywords):
+    words = PROSE.split()
+    out = []
+    size = 0
+    while size < length:
+        # ~2% de palabras son keywords, como en una pregunta real
+        word = rng.choice(keywords) if rng.random() < 0.02 else rng.choice(words)
+        out.append(word)
+        size += len(word) + 1
+    return " ".join(out)
+
+
+def timeit(fn, *args):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        fn(*args)
+    return (time.perf_counter() - start) / REPEAT * 1e6
+
+
+def main():
+    rng = random.Random(42)
+    all_keywords = [k for keywords in INTENTS.values() for k in keywords]
+
+    # Equivalencia con el método anterior
+    matcher = IntentMatcher(INTENTS)
+    for _ in range(2000):
+        text = make_message(rng.randint(10, 400), rng, all_keywords)
+        assert matcher.match(text) == naive_match(INTENTS, text), text
+    print("OK: mismas intenciones que el método anterior en 2000 mensajes\n")
+
+    print(f"{'keywords':>9} {'chars':>8} {'any() us':>10} {'matcher us':>11} {'ratio':>6}")
+    for extra in EXTRA_KEYWORDS:
+        intents = dict(INTENTS, extra=synthetic_keywords(extra, rng)) if extra else INTENTS
+        matcher = IntentMatcher(intents)
+        for length in LENGTHS:
+            text = make_message(length, rng, all_keywords)
+            naive = timeit(naive_match, intents, text)
+            fast = timeit(matcher.match, text)
+            print(f"{matcher.pattern_count:>9} {len(text):>8} {naive:>10.1f} {fast:>11.1f} "
+                  f"{naive / fast:>6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
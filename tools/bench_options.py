@@ -0,0 +1,191 @@
+"""
+Benchmark de las options de Ollama (num_ctx, num_thread) por tamaño de
+prompt y generaciones simultáneas.
+
+Para cada combinación hace una petición de calentamiento (Ollama
+recarga el modelo al cambiar num_ctx o num_thread: su load_duration se
+muestra aparte) y después --runs rondas de --concurrency generaciones a
+la vez. Mide:
+
+- TTFT: tiempo hasta el primer token visto por el cliente (p50/p95)
+- tok/s por stream: eval_count / eval_duration que devuelve Ollama
+- tok/s agregado: tokens de todas las generaciones / tiempo de la ronda
+
+"auto" en --ctx y --threads es lo que elegiría ollama_options.py.
+
+    python tools/bench_options.py --prompt-tokens 200,1500 --ctx auto,2048,4096 \\
+        --threads auto,2 --concurrency 1,4
+    python tools/bench_options.py --url http://10.0.0.5:11434 --json bench.json
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ollama_options import CHARS_PER_TOKEN, OptionsPlanner  # noqa: E402
+from ollama_pool import OllamaPool  # noqa: E402
+
+SENTENCE = ("La instancia i-0abc123 en us-east-1 tiene el security group sg-0123 abierto al "
+            "puerto 22 desde 0.0.0.0/0; revisa las reglas de entrada y el rol IAM asociado. ")
+
+
+def make_prompt(tokens):
+    """Prompt de ~tokens tokens (misma estimación que el planner)"""
+    chars = int(tokens * CHARS_PER_TOKEN)
+    text = (SENTENCE * (chars // len(SENTENCE) + 1))[:chars]
+    return f"{text}\n\nResume lo anterior en una frase."
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def generate(args, prompt, options):
+    """Una generación en streaming: dict con ttft, tokens y duraciones de Ollama"""
+    payload = {"model": args.model, "prompt": prompt, "stream": True,
+               "options": dict(options, num_predict=args.num_predict, temperature=0, seed=1)}
+    start = time.monotonic()
+    result = {"ttft": None, "tokens": 0}
+    with requests.post(f"{args.url}/api/generate", json=payload, stream=True,
+                       timeout=(3, args.timeout)) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            message = json.loads(line)
+            if message.get("response"):
+                if result["ttft"] is None:
+                    result["ttft"] = time.monotonic() - start
+                result["tokens"] += 1
+            if message.get("done"):
+                result["eval_count"] = message.get("eval_count", result["tokens"])
+                result["eval_s"] = (message.get("eval_duration") or 0) / 1e9
+                result["load_s"] = (message.get("load_duration") or 0) / 1e9
+    result["total_s"] = time.monotonic() - start
+    return result
+
+
+def run_round(args, prompt, options, concurrency):
+    results = [None] * concurrency
+    errors = []
+
+    def worker(i):
+        try:
+            results[i] = generate(args, prompt, options)
+        except (requests.RequestException, ValueError) as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [r for r in results if r], time.monotonic() - start, errors
+
+
+def bench(args, prompt_tokens, num_ctx, num_thread, concurrency):
+    prompt = make_prompt(prompt_tokens)
+    options = {"num_ctx": num_ctx}
+    if num_thread:
+        options["num_thread"] = num_thread
+
+    # Calentamiento: incluye la recarga del modelo si cambian las options
+    warmup = generate(args, prompt, options)
+    results, walls, errors = [], [], []
+    for _ in range(args.runs):
+        round_results, wall, round_errors = run_round(args, prompt, options, concurrency)
+        results.extend(round_results)
+        walls.append(wall)
+        errors.extend(round_errors)
+
+    ttfts = [r["ttft"] for r in results if r["ttft"] is not None]
+    rates = [r["eval_count"] / r["eval_s"] for r in results if r.get("eval_s")]
+    total_tokens = sum(r["eval_count"] for r in results)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "num_ctx": num_ctx,
+        "num_thread": num_thread,
+        "concurrency": concurrency,
+        "reload_ms": round(warmup["load_s"] * 1000, 1),
+        "ttft_ms_p50": round(percentile(ttfts, 0.5) * 1000, 1) if ttfts else None,
+        "ttft_ms_p95": round(percentile(ttfts, 0.95) * 1000, 1) if ttfts else None,
+        "tok_s_stream": round(sum(rates) / len(rates), 1) if rates else None,
+        "tok_s_total": round(total_tokens / sum(walls), 1) if walls and sum(walls) else None,
+        "generations": len(results),
+        "errors": len(errors)
+    }
+
+
+def parse_list(value, auto=None):
+    """'auto,2048' -> [auto, 2048] (auto puede ser None: sin la option)"""
+    out = []
+    for item in value.split(","):
+        item = item.strip()
+        value = auto if item == "auto" else int(item)
+        if value not in out:
+            out.append(value)
+    return out
+
+
+def fmt(value):
+    return "-" if value is None else str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de num_ctx/num_thread en Ollama")
+    parser.add_argument("--url", default=os.environ.get("OLLAMA_HOST_URL", "http://localhost:11434"))
+    parser.add_argument("--model", default="dolphin-llama3")
+    parser.add_argument("--prompt-tokens", default="200,1500", help="tamaños de prompt (tokens)")
+    parser.add_argument("--ctx", default="auto,2048,4096", help="num_ctx a probar")
+    parser.add_argument("--threads", default="auto,2", help="num_thread a probar")
+    parser.add_argument("--concurrency", default="1,4", help="generaciones simultáneas")
+    parser.add_argument("--runs", type=int, default=3, help="rondas por combinación")
+    parser.add_argument("--num-predict", type=int, default=64, help="tokens por respuesta")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--json", help="guardar los resultados en este fichero")
+    args = parser.parse_args()
+    args.url = args.url.rstrip("/")
+
+    planner = OptionsPlanner(pool=OllamaPool([args.url]), response_tokens=args.num_predict)
+    threads = parse_list(args.threads, auto=planner.num_thread)
+    concurrencies = parse_list(args.concurrency)
+    print(f"Ollama {args.url}, model {args.model}; planner: num_thread={planner.num_thread}, "
+          f"buckets={planner.buckets}\n")
+
+    header = (f"{'prompt':>6} {'ctx':>5} {'thr':>4} {'conc':>4} {'reload ms':>9} "
+              f"{'ttft p50':>8} {'ttft p95':>8} {'tok/s':>6} {'total':>6} {'err':>3}")
+    print(header)
+    rows = []
+    for prompt_tokens in parse_list(args.prompt_tokens):
+        for num_ctx in parse_list(args.ctx, auto=planner.bucket_for(prompt_tokens)):
+            if prompt_tokens + args.num_predict > num_ctx:
+                print(f"{prompt_tokens:>6} {num_ctx:>5}  (no cabe: Ollama recortaría el prompt)")
+                continue
+            for num_thread in threads:
+                for concurrency in concurrencies:
+                    row = bench(args, prompt_tokens, num_ctx, num_thread, concurrency)
+                    rows.append(row)
+                    print(f"{prompt_tokens:>6} {num_ctx:>5} {fmt(num_thread):>4} {concurrency:>4} "
+                          f"{row['reload_ms']:>9} {fmt(row['ttft_ms_p50']):>8} "
+                          f"{fmt(row['ttft_ms_p95']):>8} {fmt(row['tok_s_stream']):>6} "
+                          f"{fmt(row['tok_s_total']):>6} {row['errors']:>3}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"url": args.url, "model": args.model, "results": rows}, f, indent=2)
+        print(f"\nResults saved to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
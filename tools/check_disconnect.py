@@ -0,0 +1,175 @@
+"""
+Comprueba que al desconectarse el navegador se corta la generación.
+
+Levanta tools/stub_ollama.py con respuestas largas y la app (Flask o
+ASGI) con un solo slot del scheduler, y:
+
+1. abre un chat, lee el primer token y cierra la conexión: el stub debe
+   ver la generación cancelada y el slot debe quedar libre
+2. con el slot ocupado, encola un segundo chat y lo cierra mientras
+   espera: debe contar como cancelado en cola
+
+    python tools/check_disconnect.py
+    python tools/check_disconnect.py --mode asgi --app app_guardtrail
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TIMEOUT = 5.0
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until(condition, timeout=TIMEOUT):
+    """Segundos hasta que condition() es cierta, o None si no llega"""
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if condition():
+            return time.monotonic() - start
+        time.sleep(0.01)
+    return None
+
+
+def start_stub(script, *args):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "tools", script),
+                                "--port", str(port), *args],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_until(lambda: _port_open(port))
+    return process, port
+
+
+def _port_open(port):
+    try:
+        socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+        return True
+    except OSError:
+        return False
+
+
+def stub_stats(port):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=TIMEOUT)
+    conn.request("GET", "/stats")
+    return json.loads(conn.getresponse().read())
+
+
+def start_app(module, mode):
+    port = free_port()
+    if mode == "asgi":
+        import uvicorn
+        server = uvicorn.Server(uvicorn.Config(module.asgi_app, host="127.0.0.1", port=port,
+                                               lifespan="off", log_level="warning"))
+        threading.Thread(target=server.run, daemon=True).start()
+    else:
+        from werkzeug.serving import make_server
+        server = make_server("127.0.0.1", port, module.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    wait_until(lambda: _port_open(port))
+    return port
+
+
+class ChatClient:
+    """Petición a /api/chat leída evento a evento"""
+
+    def __init__(self, port, message):
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=TIMEOUT * 4)
+        self.conn.request("POST", "/api/chat", json.dumps({"message": message, "no_cache": True}),
+                          {"Content-Type": "application/json"})
+        # http.client suelta conn.sock si la respuesta no es keep-alive
+        self.sock = self.conn.sock
+        self.response = self.conn.getresponse()
+
+    def next_event(self):
+        while True:
+            line = self.response.fp.readline()
+            if not line:
+                return None
+            if line.startswith(b"data: "):
+                return json.loads(line[6:])
+
+    def disconnect(self):
+        """Cierra el socket como un navegador al cerrar la pestaña"""
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.response.close()
+        self.conn.close()
+
+
+def check(label, seconds):
+    status = "OK  " if seconds is not None else "FAIL"
+    detail = f"{seconds * 1000:.0f} ms" if seconds is not None else f"> {TIMEOUT:.0f} s"
+    print(f"{status} {label}: {detail}")
+    return seconds is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cancelación de la generación al desconectarse")
+    parser.add_argument("--app", default="app", choices=["app", "app_guardtrail"])
+    parser.add_argument("--mode", default="wsgi", choices=["wsgi", "asgi"])
+    args = parser.parse_args()
+
+    processes = []
+    ollama, ollama_port = start_stub("stub_ollama.py", "--tokens", "5000", "--token-delay", "0.02")
+    processes.append(ollama)
+    os.environ["OLLAMA_HOST_URL"] = f"http://127.0.0.1:{ollama_port}"
+    os.environ["SCHEDULER_MAX_CONCURRENCY"] = "1"
+    os.environ["RESPONSE_CACHE_ENABLED"] = "0"
+    if args.app == "app_guardtrail":
+        guard, guard_port = start_stub("stub_guardtrail.py", "--delay", "0.01")
+        processes.append(guard)
+        os.environ["GUARDTRAIL_API_URL"] = f"http://127.0.0.1:{guard_port}/guard"
+        os.environ.setdefault("V1_API_KEY", "test")
+
+    try:
+        module = __import__(args.app)
+        scheduler = module.scheduler
+        port = start_app(module, args.mode)
+        ok = True
+
+        # 1. Desconexión a mitad de la respuesta
+        client = ChatClient(port, "hello world 1")
+        while "token" not in (client.next_event() or {"token": None}):
+            pass
+        client.disconnect()
+        ok &= check("Ollama stream closed after disconnect",
+                    wait_until(lambda: stub_stats(ollama_port)["cancelled"] == 1))
+        ok &= check("scheduler slot released",
+                    wait_until(lambda: scheduler.stats()["running"] == 0))
+
+        # 2. Desconexión mientras espera en la cola
+        holder = ChatClient(port, "hello world 2")
+        holder.next_event()
+        waiting = ChatClient(port, "hello world 3")
+        event = waiting.next_event()
+        ok &= check("queued event received", 0.0 if event and event.get("queued") else None)
+        waiting.disconnect()
+        ok &= check("queued request cancelled",
+                    wait_until(lambda: scheduler.stats()["cancelled_in_queue"] == 1))
+        holder.disconnect()
+        ok &= check("holder slot released", wait_until(lambda: scheduler.stats()["running"] == 0))
+
+        stats = scheduler.stats()
+        print(json.dumps({k: stats[k] for k in ("cancelled", "cancelled_in_queue", "running",
+                                               "queue_depth", "cancel_release_ms_max")}))
+        print(json.dumps(stub_stats(ollama_port)))
+        sys.exit(0 if ok else 1)
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Servidor GuardTrail falso para pruebas locales.
+
+Responde como la API de AI Guard ({"action": "Allow"|"Block", ...}) con
+latencia, lentitud ocasional y errores configurables, para probar el
+hedging y el circuit breaker sin llamar a Trend Micro.
+
+    python tools/stub_guardtrail.py --port 8081 --slow-rate 0.1 --slow-delay 3
+    GUARDTRAIL_API_URL=http://localhost:8081/guard V1_API_KEY=test python app_guardtrail.py
+"""
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_handler(args):
+    block_words = [w.lower() for w in args.block_words.split(',') if w]
+    stats = {"requests": 0, "blocked": 0, "errors": 0}
+
+    class GuardHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *log_args):
+            if args.verbose:
+                super().log_message(format, *log_args)
+
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            # Contadores del stub
+            self._send_json(200, stats)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            stats["requests"] += 1
+
+            delay = args.delay
+            if random.random() < args.slow_rate:
+                delay = args.slow_delay
+            time.sleep(delay)
+
+            if random.random() < args.fail_rate:
+                stats["errors"] += 1
+                self._send_json(500, {"error": "stub failure"})
+                return
+
+            text = payload.get("guard", "").lower()
+            reasons = [w for w in block_words if w in text]
+            if reasons:
+                stats["blocked"] += 1
+            self._send_json(200, {
+                "id": str(stats["requests"]),
+                "action": "Block" if reasons else "Allow",
+                "reasons": reasons
+            })
+
+    return GuardHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub de la API de Trend Micro AI Guard")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--delay", type=float, default=0.05, help="latencia normal (s)")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fracción de respuestas lentas")
+    parser.add_argument("--slow-delay", type=float, default=3.0, help="latencia de las respuestas lentas (s)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fracción de respuestas HTTP 500")
+    parser.add_argument("--block-words", default="bomb,malware,exploit",
+                        help="palabras que provocan Block, separadas por comas")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(args))
+    print(f"GuardTrail stub on http://127.0.0.1:{args.port}/guard")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""
+Servidor Ollama falso para pruebas locales.
+
+Implementa lo que usa la app de la API de Ollama (/api/generate en
+streaming NDJSON, /api/tags, /api/ps) con un prefill y una velocidad
+de tokens configurables. Detecta cuando el cliente cierra la conexión
+(también durante el prefill) y lo cuenta como generación cancelada.
+Con --load-delay simula la carga del modelo: la primera generación (o
+la que llega tras vencer su keep_alive, o con otro num_ctx/num_thread)
+tarda más y lo indica en load_duration, y /api/ps solo lista el modelo
+mientras está cargado.
+
+    python tools/stub_ollama.py --port 11435 --tokens 300 --token-delay 0.05
+    OLLAMA_HOST_URL=http://localhost:11435 python app.py
+
+GET /stats devuelve los contadores del stub.
+"""
+import argparse
+import json
+import select
+import socket
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ClientGone(Exception):
+    pass
+
+
+def parse_keep_alive(value, default):
+    """keep_alive de Ollama en segundos: "5m", "1h", "30s", número; negativo = siempre"""
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        units = {"s": 1, "m": 60, "h": 3600}
+        value = value.strip()
+        seconds = float(value[:-1]) * units[value[-1]] if value[-1] in units else float(value)
+    return float("inf") if seconds < 0 else seconds
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Conexiones keep-alive que cierra el cliente: no es un error del stub
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def make_handler(args):
+    lock = threading.Lock()
+    stats = {"generations": 0, "completed": 0, "cancelled": 0, "active": 0, "loads": 0}
+    # Sin --load-delay el modelo está siempre cargado
+    model = {"loaded_until": float("inf") if not args.load_delay else 0.0, "runner": None}
+
+    def count(name, delta=1):
+        with lock:
+            stats[name] += delta
+
+    def now():
+        return datetime.now(timezone.utc).isoformat()
+
+    def is_loaded():
+        return time.monotonic() < model["loaded_until"]
+
+    class OllamaHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *log_args):
+            if args.verbose:
+                super().log_message(format, *log_args)
+
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _wait(self, seconds):
+            """Espera como el servidor real: si el cliente cierra, se aborta"""
+            readable, _, _ = select.select([self.connection], [], [], seconds)
+            if readable:
+                try:
+                    if not self.connection.recv(1, socket.MSG_PEEK):
+                        raise ClientGone()
+                except OSError:
+                    raise ClientGone()
+
+        def _write_chunk(self, body):
+            data = (json.dumps(body) + "\n").encode("utf-8")
+            try:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+            except OSError:
+                raise ClientGone()
+
+        def do_GET(self):
+            if self.path == "/api/tags":
+                self._send_json(200, {"models": [{"name": args.model, "model": args.model}]})
+            elif self.path == "/api/ps":
+                loaded = [{"name": args.model, "model": args.model, "size_vram": 0}]
+                self._send_json(200, {"models": loaded if is_loaded() else []})
+            elif self.path == "/stats":
+                with lock:
+                    self._send_json(200, dict(stats))
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            if self.path != "/api/generate":
+                self._send_json(404, {"error": "not found"})
+                return
+
+            count("generations")
+            count("active")
+            try:
+                self._generate(payload)
+                count("completed")
+            except ClientGone:
+                count("cancelled")
+                self.close_connection = True
+            finally:
+                count("active", -1)
+
+        def _generate(self, payload):
+            context = list(payload.get("context") or [])
+            tokens = [f" tok{i}" for i in range(args.tokens)]
+            load_duration = self._load(payload)
+
+            if not payload.get("prompt"):
+                # Ollama: generate sin prompt solo carga el modelo
+                self._send_json(200, {"model": args.model, "created_at": now(), "response": "",
+                                      "done": True, "done_reason": "load",
+                                      "load_duration": load_duration})
+                return
+            self._wait(args.prefill_delay)
+
+            if not payload.get("stream", True):
+                self._send_json(200, {"model": args.model, "created_at": now(),
+                                      "response": "".join(tokens), "done": True,
+                                      "load_duration": load_duration,
+                                      "context": context + list(range(len(tokens)))})
+                return
+
+            started = time.monotonic()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for token in tokens:
+                self._write_chunk({"model": args.model, "created_at": now(),
+                                   "response": token, "done": False})
+                self._wait(args.token_delay)
+            self._write_chunk({"model": args.model, "created_at": now(), "response": "",
+                               "done": True, "eval_count": len(tokens),
+                               "eval_duration": int((time.monotonic() - started) * 1e9),
+                               "load_duration": load_duration,
+                               "context": context + list(range(len(tokens)))})
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _load(self, payload):
+            """
+            Carga el modelo si no está en memoria o si cambian las options
+            del runner; devuelve load_duration en ns
+            """
+            options = payload.get("options") or {}
+            runner = (options.get("num_ctx"), options.get("num_thread"))
+            started = time.monotonic()
+            if not is_loaded() or (args.load_delay and runner != model["runner"]):
+                count("loads")
+                self._wait(args.load_delay)
+            load_duration = int((time.monotonic() - started) * 1e9)
+            ttl = parse_keep_alive(payload.get("keep_alive"), args.keep_alive)
+            if args.load_delay:
+                # Como Ollama: manda el keep_alive de la última petición
+                with lock:
+                    model["loaded_until"] = time.monotonic() + ttl
+                    model["runner"] = runner
+            return load_duration
+
+    return OllamaHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub de la API de Ollama")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--model", default="dolphin-llama3:latest")
+    parser.add_argument("--tokens", type=int, default=200, help="tokens por respuesta")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="segundos entre tokens")
+    parser.add_argument("--prefill-delay", type=float, default=0.2,
+                        help="segundos hasta el primer token")
+    parser.add_argument("--load-delay", type=float, default=0.0,
+                        help="segundos que tarda en cargar el modelo (0 = siempre cargado)")
+    parser.add_argument("--keep-alive", type=float, default=300.0,
+                        help="segundos en memoria sin uso si la petición no trae keep_alive")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server = StubServer(("127.0.0.1", args.port), make_handler(args))
+    print(f"Ollama stub on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
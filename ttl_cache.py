@@ -0,0 +1,195 @@
+"""
+Cache en memoria thread-safe con TTL por clave.
+
+- Expiración independiente por clave y límite de tamaño LRU (número de
+  entradas y, opcionalmente, bytes según una función sizeof)
+- Carga "single-flight": ante una clave ausente o expirada solo un hilo
+  ejecuta el loader; el resto espera ese mismo resultado
+- stale-while-revalidate opcional: dentro de stale_ttl se devuelve el
+  valor caducado y se recarga en segundo plano
+- Contadores de hits, misses y tiempo de carga
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# Todas las caches creadas, para exponer sus estadísticas
+_registry = []
+
+
+class _Flight:
+    """Carga en curso de una clave"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+
+    def __init__(self, name, ttl, max_entries=256, stale_ttl=0, max_bytes=None, sizeof=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data = OrderedDict()  # key -> (value, expires_at)
+        self._sizes = {}  # key -> bytes (solo con max_bytes)
+        self._bytes = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "loads": 0,
+            "load_errors": 0,
+            "load_time_total_ms": 0.0,
+            "evictions": 0
+        }
+        _registry.append(self)
+
+    # ------------------------------------------------------------------
+    # Acceso directo
+    # ------------------------------------------------------------------
+
+    def get(self, key, default=None):
+        """Valor vigente o default, sin cargar"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and entry[1] > time.time():
+                self._stats["hits"] += 1
+                self._data.move_to_end(key)
+                return entry[0]
+            self._stats["misses"] += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def invalidate(self, key=None):
+        """Elimina una clave, o todas si key es None"""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+                self._sizes.clear()
+                self._bytes = 0
+            else:
+                self._data.pop(key, None)
+                self._bytes -= self._sizes.pop(key, 0)
+
+    def _store(self, key, value, ttl):
+        if ttl is None:
+            ttl = self.ttl
+        elif callable(ttl):
+            # TTL según el valor (p. ej. distinto para Allow y Block)
+            ttl = ttl(value)
+        if self.max_bytes is not None:
+            size = self.sizeof(value)
+            self._bytes -= self._sizes.pop(key, 0)
+            if size > self.max_bytes:
+                # Nunca cabría: no se guarda (ni se queda la versión anterior)
+                self._data.pop(key, None)
+                return
+            self._sizes[key] = size
+            self._bytes += size
+        self._data[key] = (value, time.time() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries or (
+                self.max_bytes is not None and self._bytes > self.max_bytes):
+            evicted, _ = self._data.popitem(last=False)
+            self._bytes -= self._sizes.pop(evicted, 0)
+            self._stats["evictions"] += 1
+
+    # ------------------------------------------------------------------
+    # Carga single-flight
+    # ------------------------------------------------------------------
+
+    def get_or_load(self, key, loader, ttl=None, cache_if=None):
+        """
+        Devuelve el valor de key, cargándolo con loader() si hace falta.
+
+        cache_if(value) permite descartar resultados que no deben
+        guardarse (p. ej. diccionarios {"error": ...}); ttl puede ser un
+        número o una función ttl(value).
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._stats["hits"] += 1
+                    self._data.move_to_end(key)
+                    return value
+                if now - expires_at < self.stale_ttl:
+                    # Valor caducado pero servible: recarga en segundo plano
+                    self._stats["stale_hits"] += 1
+                    if key not in self._flights:
+                        flight = self._flights[key] = _Flight()
+                        threading.Thread(target=self._load, daemon=True,
+                                         args=(key, loader, ttl, cache_if, flight)).start()
+                    return value
+
+            self._stats["misses"] += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if leader:
+            self._load(key, loader, ttl, cache_if, flight)
+        else:
+            flight.event.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def _load(self, key, loader, ttl, cache_if, flight):
+        start = time.perf_counter()
+        try:
+            flight.value = loader()
+        except Exception as e:
+            flight.error = e
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        with self._lock:
+            self._stats["loads"] += 1
+            self._stats["load_time_total_ms"] += elapsed_ms
+            if flight.error is not None:
+                self._stats["load_errors"] += 1
+            elif cache_if is None or cache_if(flight.value):
+                self._store(key, flight.value, ttl)
+            self._flights.pop(key, None)
+        flight.event.set()
+
+    # ------------------------------------------------------------------
+    # Estadísticas
+    # ------------------------------------------------------------------
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._data)
+            if self.max_bytes is not None:
+                stats["bytes"] = self._bytes
+                stats["max_bytes"] = self.max_bytes
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["stale_hits"]) / lookups, 3) if lookups else 0.0
+        stats["load_time_avg_ms"] = round(stats["load_time_total_ms"] / stats["loads"], 2) if stats["loads"] else 0.0
+        stats["load_time_total_ms"] = round(stats["load_time_total_ms"], 2)
+        return stats
+
+
+def all_stats():
+    """Estadísticas de todas las caches por nombre"""
+    return {cache.name: cache.stats() for cache in _registry}
+
+
+def is_cacheable(value):
+    """Criterio por defecto: no se cachean resultados {"error": ...}"""
+    return not (isinstance(value, dict) and "error" in value)